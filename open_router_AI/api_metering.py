@@ -1,33 +1,297 @@
-from fastapi import Request, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
-from time import time
-from collections import defaultdict
-
-RATE_LIMITS = defaultdict(lambda: {"count": 0, "start": time()})
-MAX_REQUESTS_PER_MINUTE = 60
-
-class RateLimiterMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        ip = request.client.host
-        usage = RATE_LIMITS[ip]
-        now = time()
-        if now - usage["start"] > 60:
-            usage["count"] = 0
-            usage["start"] = now
-        if usage["count"] >= MAX_REQUESTS_PER_MINUTE:
-            raise HTTPException(status_code=429, detail="Rate limit exceeded")
-        usage["count"] += 1
-        response = await call_next(request)
-        return response
+# api_metering.py
+#
+# Request rate limiting and token accounting.
+#
+# RateLimiter is a pure ASGI middleware (no BaseHTTPMiddleware task or body
+# wrapping) with token-bucket limits. Every request takes one token from
+#
+#   - the client's global bucket      RATE_LIMIT_RPM per minute
+#   - the client's bucket for a route ROUTE_LIMITS (opt-in), matched by whole
+#                                     path segments
+#   - the client's bucket for a model MODEL_LIMITS (opt-in), for chat routes
+#                                     (model_key from the query, the
+#                                     X-Model-Key header or the form or
+#                                     JSON body)
+#
+# where a bucket holds up to `burst` tokens and refills at rpm/60 per second.
+# The default (60/min, burst 60) matches the old fixed-window limiter.
+# A request that finds any bucket empty gets a 429 with Retry-After and takes
+# nothing. Clients are identified by IP, or by RATE_LIMIT_USER_HEADER when the
+# app sits behind a proxy that authenticates users. EXEMPT_PATHS (static
+# files, health checks) skip the limiter entirely.
+#
+# Buckets live in one LRU of at most RATE_LIMIT_MAX_KEYS entries; a bucket
+# idle long enough to have refilled completely is the same as no bucket and is
+# dropped, so memory follows the number of recently active clients.
+#
+# `python api_metering.py` benchmarks the per-request overhead.
 
-TOTAL_TOKENS = defaultdict(int)
+import json
+import math
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict
+from urllib.parse import parse_qs
+
+RATE_LIMIT_RPM = float(os.getenv("RATE_LIMIT_RPM", "60"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "60"))
+# {"path prefix": rpm or [rpm, burst]}, e.g. {"/send-message": 20, "/train-adapters": [2, 1]}
+ROUTE_LIMITS = json.loads(os.getenv("RATE_LIMIT_ROUTES", "{}"))
+# {"model key": rpm or [rpm, burst]}
+MODEL_LIMITS = json.loads(os.getenv("RATE_LIMIT_MODELS", "{}"))
+MODEL_ROUTES = ("/send-message", "/chat")
+EXEMPT_PATHS = tuple(os.getenv("RATE_LIMIT_EXEMPT", "/static,/healthz,/readyz").split(","))
+RATE_LIMIT_USER_HEADER = os.getenv("RATE_LIMIT_USER_HEADER", "").lower().encode()
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Bodies larger than this are not searched for model_key
+MAX_PEEK_BYTES = 64 * 1024
+
+_current = None
+# The value after the part's headers: stop at the first blank line, not the last
+_MULTIPART_MODEL = re.compile(rb'name="model_key"\r\n(?:[^\r\n]+\r\n)*?\r\n([^\r\n]*)')
+
+
+def _under(path, prefixes):
+    """
+    Whether `path` is one of `prefixes` or below one of them, by whole path
+    segments ("/chat" covers "/chat/x" but not "/chat-debug").
+    """
+    for prefix in prefixes:
+        if path.startswith(prefix) and (len(path) == len(prefix) or path[len(prefix)] == "/" or prefix.endswith("/")):
+            return True
+    return False
+
+
+def _limit(spec):
+    """
+    (tokens per second, burst) from an rpm or [rpm, burst] setting.
+    """
+    rpm, burst = (spec, None) if isinstance(spec, (int, float)) else spec
+    return rpm / 60, burst or max(int(rpm // 6), 1)
+
+
+class RateLimiter:
+    def __init__(self, app, rpm=RATE_LIMIT_RPM, burst=RATE_LIMIT_BURST, routes=ROUTE_LIMITS,
+                 models=MODEL_LIMITS, exempt=EXEMPT_PATHS, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.app = app
+        self.default = (rpm / 60, burst)
+        # Longest prefix first, so "/send-message/stream" can be limited apart from "/send-message"
+        self.routes = sorted(((p, _limit(s)) for p, s in routes.items()), key=lambda r: -len(r[0]))
+        self.models = {m: _limit(s) for m, s in models.items()}
+        self.exempt = tuple(p for p in exempt if p)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, last refill, seconds to refill from empty]
+        self.stats = {"allowed": 0, "limited": 0, "exempt": 0, "evicted": 0, "expired": 0}
+        global _current
+        _current = self
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        if _under(path, self.exempt):
+            self.stats["exempt"] += 1
+            return await self.app(scope, receive, send)
+
+        client = self._client(scope)
+        limits = [(("*", client), self.default)]
+        for prefix, limit in self.routes:
+            if _under(path, (prefix,)):
+                limits.append(((prefix, client), limit))
+                break
+        if self.models and _under(path, MODEL_ROUTES):
+            model, receive = await self._model_key(scope, receive)
+            if model in self.models:
+                limits.append((("model", model, client), self.models[model]))
+
+        wait = self.take(limits, time.monotonic())
+        if wait:
+            self.stats["limited"] += 1
+            return await self._reject(send, wait)
+        self.stats["allowed"] += 1
+        return await self.app(scope, receive, send)
+
+    def _client(self, scope):
+        if RATE_LIMIT_USER_HEADER:
+            for name, value in scope["headers"]:
+                if name == RATE_LIMIT_USER_HEADER:
+                    return "user:" + value.decode("latin-1")
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def _model_key(self, scope, receive):
+        """
+        The request's model_key and a `receive` that replays any body read for it.
+        """
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        if "model_key" in query:
+            return query["model_key"][0], receive
+        headers = dict(scope["headers"])
+        if b"x-model-key" in headers:
+            return headers[b"x-model-key"].decode("latin-1"), receive
+        if scope["method"] != "POST" or int(headers.get(b"content-length", b"0") or 0) > MAX_PEEK_BYTES:
+            return None, receive
+
+        messages, body = [], b""
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                break
+            body += message.get("body", b"")
+            if not message.get("more_body") or len(body) > MAX_PEEK_BYTES:
+                break
+
+        async def replay():
+            return messages.pop(0) if messages else await receive()
+
+        content_type = headers.get(b"content-type", b"")
+        model = None
+        if content_type.startswith(b"application/x-www-form-urlencoded"):
+            model = parse_qs(body.decode("latin-1")).get("model_key", [None])[0]
+        elif content_type.startswith(b"multipart/form-data"):
+            match = _MULTIPART_MODEL.search(body)
+            model = match.group(1).decode("utf-8", "replace") if match else None
+        elif content_type.startswith(b"application/json"):
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            model = data.get("model_key") if isinstance(data, dict) else None
+        return model, replay
+
+    def take(self, limits, now):
+        """
+        Take a token from every bucket in `limits` ((key, (rate, burst))
+        pairs), or from none of them. Returns 0 on success, else the seconds
+        until all of them would have one.
+        """
+        buckets = self._buckets
+        self._expire(now)
+        wait = 0
+        states = []
+        for key, (rate, burst) in limits:
+            state = buckets.get(key)
+            if state is None:
+                state = [float(burst), now, burst / rate if rate else math.inf]
+            else:
+                state[0] = min(burst, state[0] + (now - state[1]) * rate)
+                state[1] = now
+            if state[0] < 1:
+                wait = max(wait, (1 - state[0]) / rate if rate else math.inf)
+            states.append((key, state))
+        for key, state in states:
+            if not wait:
+                state[0] -= 1
+            buckets[key] = state
+            buckets.move_to_end(key)
+        while len(buckets) > self.max_keys:
+            buckets.popitem(last=False)
+            self.stats["evicted"] += 1
+        return wait
+
+    def _expire(self, now):
+        # Least recently used first: stop at the first bucket that may still be short
+        buckets = self._buckets
+        while buckets:
+            key, (_, last, refill) = next(iter(buckets.items()))
+            if now - last < refill:
+                break
+            del buckets[key]
+            self.stats["expired"] += 1
 
-from transformers import PreTrainedTokenizer
+    async def _reject(self, send, wait):
+        retry_after = "3600" if math.isinf(wait) else str(max(math.ceil(wait), 1))
+        body = json.dumps({"detail": "Rate limit exceeded", "retry_after": int(retry_after)}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", retry_after.encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
 
-def count_tokens(tokenizer: PreTrainedTokenizer, prompt: str, reply: str, user_id: str):
+    def report(self):
+        stats = dict(self.stats)
+        stats["keys"] = len(self._buckets)
+        stats["max_keys"] = self.max_keys
+        return stats
+
+
+def rate_limit_stats():
+    """
+    Counters of the most recently built RateLimiter (the one serving the app).
+    """
+    return _current.report() if _current is not None else {}
+
+
+TOTAL_TOKENS = defaultdict(int)
+
+def count_tokens(tokenizer, prompt: str, reply: str, user_id: str):
     prompt_ids = tokenizer.encode(prompt)
     reply_ids = tokenizer.encode(reply)
     TOTAL_TOKENS[user_id] += len(prompt_ids) + len(reply_ids)
 
 def get_usage_stats(user_id: str):
     return {"total_tokens": TOTAL_TOKENS.get(user_id, 0)}
+
+
+def benchmark(n=100000, clients=1000):
+    """
+    Per-request overhead of the limiter against a bare ASGI app (and, for
+    comparison, a do-nothing BaseHTTPMiddleware), driving the apps directly.
+    """
+    import asyncio
+
+    from starlette.middleware.base import BaseHTTPMiddleware
+    from starlette.responses import PlainTextResponse
+
+    async def endpoint(scope, receive, send):
+        await PlainTextResponse("ok")(scope, receive, send)
+
+    class PassThrough(BaseHTTPMiddleware):
+        async def dispatch(self, request, call_next):
+            return await call_next(request)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    def scope(i, path):
+        return {
+            "type": "http", "method": "GET", "path": path, "query_string": b"", "headers": [],
+            "client": (f"10.0.{i // 256 % 256}.{i % 256}", 1234), "scheme": "http", "server": ("bench", 80),
+            "root_path": "", "http_version": "1.1", "raw_path": path.encode(),
+        }
+
+    async def run(app, path, count):
+        started = time.perf_counter()
+        for i in range(count):
+            await app(scope(i % clients, path), receive, send)
+        return (time.perf_counter() - started) / count * 1e6
+
+    limiter = RateLimiter(endpoint, rpm=1e9, burst=10 ** 9, routes={"/send-message": [1e9, 10 ** 9]})
+    cases = [
+        ("bare app", endpoint, "/models", n),
+        ("RateLimiter", limiter, "/models", n),
+        ("RateLimiter, route limit", limiter, "/send-message", n),
+        ("RateLimiter, exempt path", limiter, "/static/app.js", n),
+        ("BaseHTTPMiddleware (no-op)", PassThrough(endpoint), "/models", n // 10),
+    ]
+    print(f"{n} requests from {clients} clients")
+    base = None
+    for name, app, path, count in cases:
+        us = asyncio.run(run(app, path, count))
+        base = us if base is None else base
+        print(f"{name:<30} {us:8.2f} us/request  (+{us - base:.2f})")
+    print("limiter keys:", limiter.report()["keys"])
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,31 +1,70 @@
+import asyncio
 import json
+import os
+import threading
+import time
 import uuid
 from pathlib import Path
 from datetime import datetime
 
-import torch
-import requests
+import httpx
 from fastapi import FastAPI, Request, Form, Query, BackgroundTasks, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from sqlalchemy import func
+from starlette.concurrency import run_in_threadpool
 from fastapi import Body, HTTPException, status
-from utils import save_persona, load_persona
+from utils import save_persona
 
 from external_api import router as external_router
-from models.db import init_db, SessionLocal, Chat, Message
-from models.registry import load_models, get_model, MODEL_REGISTRY
-from prompt_templates import format_prompt
-from utils import (
-    load_persona,
-    maybe_summarize,
-    save_persona,
-    reflect_on_session,
+from models.db import (
+    init_db,
+    SessionLocal,
+    Chat,
+    Message,
+    to_turns,
 )
-from vector_memory import store_message, retrieve_similar
-from api_metering import RateLimiterMiddleware, count_tokens, get_usage_stats
-from train_lora_adapters import train_lora_for_character
+from models.registry import load_models, get_model, adapter_stats, ModelNotReady, MODEL_REGISTRY
+from inference import (
+    InferenceBusy,
+    close_client,
+    generate_reply,
+    inference_stats,
+    shutdown_executor,
+    stream_reply,
+)
+from batching import batching_stats, close_schedulers
+import cancellation
+from cancellation import CancelToken, TurnCancelled, cancellation_stats, watch_disconnect
+from prompt_templates import format_prompt, persona_prefix, stop_sequences
+from prompt_tokens import build_prompt, prompt_token_stats
+from stop_sequences import stop_stats
+import readiness
+from response_cache import bucket_key, response_cache, split_cache_settings
+from vector_memory import retrieve_similar, embedding_service, warm_up as warm_up_memory
+from memory_compaction import compaction_stats
+from post_processing import enqueue_post_processing
+from character_memory import (
+    add as add_character_memory,
+    character_memory_stats,
+    select as select_character_memory,
+)
+from context_packer import (
+    TURN_OVERHEAD_TOKENS,
+    context_budget,
+    count_cached,
+    ensure_token_counts,
+    get_counter,
+    pack_context,
+    packer_stats,
+)
+from summarizer import HISTORY_TURNS, summarizer_stats, summary_for_prompt, window_rows
+import work_queue
+from api_metering import RateLimiter, count_tokens, get_usage_stats, rate_limit_stats
 from persona_startup import autopopulate_defaults
+from persona_store import persona_store
+from session_cache import session_cache
 from pydantic import BaseModel
 class ChatRequest(BaseModel):
     character: str
@@ -35,15 +74,37 @@ class ChatRequest(BaseModel):
 
 # FastAPI setup
 app = FastAPI()
-app.add_middleware(RateLimiterMiddleware)
+app.add_middleware(RateLimiter)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
+def warm_up():
+    """
+    Load models and the embedder in the background so the port answers
+    immediately; /readyz reports when they are done.
+    """
+    for component, load in (("models", load_models), ("embedder", warm_up_memory)):
+        try:
+            with readiness.track(component):
+                load()
+        except Exception as e:
+            logger.error(f"[STARTUP] {component} failed to load: {e}")
+
 @app.on_event("startup")
 async def on_startup():
-    autopopulate_defaults()
-    load_models()
-    init_db()
+    with readiness.track("db"):
+        init_db()
+    with readiness.track("personas"):
+        autopopulate_defaults()
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    work_queue.start_worker()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    work_queue.stop_worker()
+    close_schedulers()
+    await close_client()
+    shutdown_executor()
 
 # ───────────────────── ROUTES ──────────────<iS>──────
 from fastapi import Body, HTTPException, status
@@ -52,87 +113,359 @@ from fastapi.middleware.cors import CORSMiddleware
 # In-memory store for last replies (for demo; use DB for production)
 LAST_REPLIES = {}
 
+DEFAULT_GENERATION_PARAMS = {"max_new_tokens": 300, "temperature": 0.7, "top_p": 0.9}
+
+def resolve_persona(character):
+    """
+    Return the persona for `character`, creating a default persona for unknown
+    characters. Blocking (file IO), call through run_in_threadpool from async routes.
+    """
+    persona = persona_store.get(character)
+    if persona is None:
+        logger.warning(f"Persona '{character}' not found. Creating default...")
+        persona = {
+            "name": character,
+            "persona": f"{character} is a helpful, friendly assistant.",
+            "image_url": "",
+            "character_memory": [],
+            "generation_params": dict(DEFAULT_GENERATION_PARAMS),
+            "template": "plain"
+        }
+        save_persona(character, persona)
+    return persona
+
+def get_chat(new_session_id, character, session_id=None):
+    """
+    Find (or create) the chat row for this session. Returns
+    (chat_id, summary, summary_upto, turns).
+    """
+    db = SessionLocal()
+    try:
+        chat = db.query(Chat).filter_by(session_id=session_id, user_id="demo", character=character).first()
+        if not chat:
+            chat = Chat(session_id=new_session_id, user_id="demo", character=character)
+            db.add(chat)
+            db.commit()
+            db.refresh(chat)
+        return chat.id, chat.summary, chat.summary_upto or 0, chat.turns or 0
+    finally:
+        db.close()
+
+def load_recent(chat_id, counter, turn_count, max_turns=HISTORY_TURNS):
+    """
+    The last `max_turns` turns as {"user", "assistant", "tokens"} dicts, from
+    the session cache or else one indexed query (only messages without a
+    cached count are tokenized). A cached window is only used while it was
+    taken at the chat's current `turn_count` (Chat.turns, as read by get_chat),
+    so turns stored by another worker or a racing save_turn are refetched.
+    """
+    cached = session_cache.get(("chat", chat_id))
+    if cached is not None and cached["counter"] == counter[0] and cached["upto"] == turn_count:
+        return [dict(turn) for turn in cached["turns"]]
+    db = SessionLocal()
+    try:
+        rows = window_rows(db, chat_id, max_turns)
+        ensure_token_counts(db, rows, counter)
+        turns = to_turns(rows)
+    finally:
+        db.close()
+    # A save_turn between get_chat and the query leaves the window newer than
+    # turn_count; the next turn then sees a mismatch and refetches
+    session_cache.put(("chat", chat_id), {"counter": counter[0], "upto": turn_count, "turns": turns})
+    return [dict(turn) for turn in turns]
+
+# Budget (seconds) of each pre-generation stage. A stage that misses it is
+# replaced by its fallback (no history / the stored summary / no memories);
+# its thread still finishes in the background.
+STAGE_TIMEOUTS = {
+    "history": float(os.getenv("STAGE_TIMEOUT_HISTORY", "2")),
+    "summary": float(os.getenv("STAGE_TIMEOUT_SUMMARY", "1.5")),
+    "retrieval": float(os.getenv("STAGE_TIMEOUT_RETRIEVAL", "1")),
+    "character_memory": float(os.getenv("STAGE_TIMEOUT_CHARACTER_MEMORY", "1")),
+}
+STAGE_STATS = {name: {"runs": 0, "timeouts": 0, "errors": 0, "seconds": 0.0} for name in STAGE_TIMEOUTS}
+
+async def run_stage(name, fallback, fn, *args):
+    """
+    Run a blocking pre-generation stage in the threadpool within its budget.
+    """
+    stats = STAGE_STATS[name]
+    stats["runs"] += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(run_in_threadpool(fn, *args), STAGE_TIMEOUTS[name])
+    except asyncio.TimeoutError:
+        stats["timeouts"] += 1
+        logger.warning(f"Stage '{name}' exceeded {STAGE_TIMEOUTS[name]}s, using fallback")
+        return fallback
+    except Exception as e:
+        stats["errors"] += 1
+        logger.warning(f"Stage '{name}' failed ({e}), using fallback")
+        return fallback
+    finally:
+        stats["seconds"] += time.perf_counter() - started
+
+def stage_stats():
+    return {
+        name: dict(s, avg_ms=round(s["seconds"] / (s["runs"] or 1) * 1000, 2), timeout_s=STAGE_TIMEOUTS[name])
+        for name, s in STAGE_STATS.items()
+    }
+
+def save_turn(chat_id, message, reply, counter=None):
+    """
+    Write both messages of a turn (with their token counts when `counter` is
+    given); returns the user message id.
+    """
+    db = SessionLocal()
+    try:
+        user_msg = Message(chat_id=chat_id, sender="user", content=message)
+        reply_msg = Message(chat_id=chat_id, sender="assistant", content=reply)
+        if counter:
+            ensure_token_counts(db, [user_msg, reply_msg], counter)
+        db.add_all([user_msg, reply_msg])
+        db.query(Chat).filter_by(id=chat_id).update({Chat.turns: func.coalesce(Chat.turns, 0) + 1})
+        db.commit()
+        turn_count = db.query(Chat.turns).filter_by(id=chat_id).scalar()
+        if counter:
+            turn = {"user": message, "assistant": reply, "tokens": user_msg.token_count + reply_msg.token_count}
+            # Extend the cached window only if it was current right before this
+            # turn; otherwise (another worker wrote in between) drop it
+            session_cache.update(("chat", chat_id), lambda cached: {
+                "counter": cached["counter"],
+                "upto": turn_count,
+                "turns": (cached["turns"] + [turn])[-HISTORY_TURNS:],
+            } if cached["counter"] == counter[0] and cached["upto"] == turn_count - 1 else None)
+        else:
+            session_cache.discard(("chat", chat_id))
+        return user_msg.id
+    finally:
+        db.close()
+
+async def prepare_turn(character, message, model_key, session_id, new_session_id=None):
+    """
+    Everything that happens before generation: persona lookup, chat history,
+    summary + retrieved memories and the prompt. Returns a dict describing the turn.
+    """
+    persona, (chat_id, stored_summary, summary_upto, turns) = await asyncio.gather(
+        run_in_threadpool(resolve_persona, character),
+        run_in_threadpool(get_chat, new_session_id or session_id or str(uuid.uuid4()), character, session_id),
+    )
+
+    model_key = model_key or persona.get("model")
+    model_obj, tokenizer_or_token = get_model(model_key, persona.get("adapter_path"))
+    counter = get_counter(tokenizer_or_token)
+
+    # Independent stages, so this waits for the slowest one rather than their sum
+    recent, summary, snippets, memories = await asyncio.gather(
+        run_stage("history", [], load_recent, chat_id, counter, turns),
+        run_stage("summary", stored_summary, summary_for_prompt, chat_id, stored_summary, summary_upto),
+        run_stage("retrieval", [], retrieve_similar, character, "demo", message, 5),
+        run_stage("character_memory", [], select_character_memory, character, message),
+    )
+
+    template = persona.get("template", "plain")
+    prefix = persona_prefix(template, persona)
+    gen_args, cache_settings = split_cache_settings(persona.get("generation_params", {}))
+    # Only context-free openers are cacheable (see response_cache.py); they are
+    # generated without character memories so the reply only depends on the persona
+    if cache_settings and (recent or summary or snippets):
+        cache_settings = None
+    if cache_settings:
+        memories = []
+
+    fixed_tokens = count_cached(counter, prefix) + counter[1](message) + TURN_OVERHEAD_TOKENS
+    recent, context = pack_context(
+        counter, context_budget(model_key, gen_args), fixed_tokens, recent, summary, snippets, memories
+    )
+    if isinstance(model_obj, str):
+        prompt = format_prompt(template, persona, recent, message, context)
+    else:
+        # Local models get token ids; only the new message is tokenized from scratch
+        _, prompt, prefix = await run_in_threadpool(
+            build_prompt, tokenizer_or_token, template, persona, recent, message, context
+        )
+    return {
+        "character": character,
+        "message": message,
+        "persona": persona,
+        "model_key": model_key,
+        "model": model_obj,
+        "tokenizer_or_token": tokenizer_or_token,
+        "chat_id": chat_id,
+        "recent": recent,
+        "turns": turns,
+        "prompt": prompt,
+        "prefix": prefix,
+        "stop": stop_sequences(template),
+        "counter": counter,
+        "gen_args": gen_args,
+        "cache_settings": cache_settings,
+        "cache_bucket": bucket_key(persona, template, model_key, gen_args) if cache_settings else None,
+    }
+
+async def cached_reply(turn):
+    if not turn["cache_settings"]:
+        return None
+    return await run_in_threadpool(
+        response_cache.lookup, turn["cache_bucket"], turn["message"], turn["cache_settings"]
+    )
+
+async def cache_reply(turn, reply):
+    if turn["cache_settings"] and reply:
+        await run_in_threadpool(
+            response_cache.store, turn["cache_bucket"], turn["message"], reply, turn["cache_settings"]
+        )
+
+def start_cancellable(request):
+    """
+    A CancelToken for the request plus the task that cancels it on disconnect.
+    """
+    token = CancelToken()
+    return token, asyncio.create_task(watch_disconnect(request, token))
+
+def track_turn(turn, token):
+    # A newer message in the same chat cancels this one
+    turn["cancel"] = token
+    cancellation.begin(turn["chat_id"], token)
+
+def release_turn(turn, token, watcher=None):
+    if watcher is not None:
+        watcher.cancel()
+    if turn is not None:
+        cancellation.end(turn["chat_id"], token)
+
+async def generate_turn(turn):
+    reply = await cached_reply(turn)
+    if reply is None:
+        reply = await generate_reply(
+            turn["model"], turn["tokenizer_or_token"], turn["prompt"], turn["gen_args"], turn["prefix"], turn["stop"],
+            turn.get("cancel")
+        )
+        # A reply cut short by cancellation is not worth caching
+        if turn.get("cancel") is not None:
+            turn["cancel"].check()
+        await cache_reply(turn, reply)
+    return reply
+
+async def finish_turn(turn, reply):
+    """
+    Store the turn and queue memory/reflection work; the response does not
+    wait for embeddings or reflections (see post_processing.py). Cancelled
+    turns raise TurnCancelled and leave no trace.
+    """
+    if turn.get("cancel") is not None:
+        turn["cancel"].check()
+    message_id = await run_in_threadpool(save_turn, turn["chat_id"], turn["message"], reply, turn["counter"])
+    await run_in_threadpool(enqueue_post_processing, turn, reply, message_id)
+    LAST_REPLIES[turn["character"]] = reply  # Store last reply for this character
+
 @app.post("/send-message")
 async def send_message(
+    request: Request,
     character: str = Form(...),
     message: str = Form(...),
     model_key: str = Form("hermes"),
     session_id: str = Form(None)
 ):
     # Use the same logic as your /chat endpoint, but return JSON
+    token, watcher = start_cancellable(request)
+    turn = None
     try:
-        personas = list_personas()
-        persona_data = {p: load_persona(p) for p in personas}
-        if character not in persona_data:
-            default_persona = {
-                "name": character,
-                "persona": f"{character} is a helpful, friendly assistant.",
-                "image_url": "",
-                "character_memory": [],
-                "generation_params": {"max_new_tokens": 300, "temperature": 0.7, "top_p": 0.9},
-                "template": "plain"
-            }
-            save_persona(character, default_persona)
-            persona = default_persona
-            persona_data[character] = default_persona
-        else:
-            persona = persona_data[character]
+        turn = await token.run(prepare_turn(character, message, model_key, session_id))
+        track_turn(turn, token)
 
-        model_obj, tokenizer_or_token = get_model(model_key or persona.get("model"))
+        reply = await generate_turn(turn)
 
-        db = SessionLocal()
-        chat = db.query(Chat).filter_by(session_id=session_id, user_id="demo", character=character).first()
-        if not chat:
-            chat = Chat(session_id=session_id or str(uuid.uuid4()), user_id="demo", character=character)
-            db.add(chat)
-            db.commit()
-            db.refresh(chat)
-
-        db_messages = db.query(Message).filter_by(chat_id=chat.id).order_by(Message.timestamp).all()
-        history = []
-        for m in db_messages:
-            if m.sender == "user":
-                history.append({"user": m.content, "assistant": ""})
-            else:
-                history[-1]["assistant"] = m.content
-
-        summary, recent = maybe_summarize(history)
-        snippets = retrieve_similar(character, "demo", message, top_k=5)
-        if snippets:
-            summary = (summary or "") + "\n" + "\n".join(snippets)
-
-        prompt = format_prompt(persona.get("template", "plain"), persona, recent, message, summary)
-        gen_args = persona.get("generation_params", {})
-
-        if isinstance(model_obj, str):
-            headers = {"Authorization": f"Bearer {tokenizer_or_token}"}
-            payload = {"inputs": prompt, "parameters": gen_args}
-            resp = requests.post(model_obj, headers=headers, json=payload, timeout=60)
-            resp.raise_for_status()
-            reply = resp.json()[0]["generated_text"].split("<|assistant|>")[-1].strip()
-        else:
-            inputs = tokenizer_or_token(prompt, return_tensors="pt").to(model_obj.device)
-            with torch.no_grad():
-                outputs = model_obj.generate(**inputs, **gen_args)
-            reply = tokenizer_or_token.decode(
-                outputs[0][inputs["input_ids"].shape[-1]:], skip_special_tokens=True
-            ).strip()
-
-        db.add_all([
-            Message(chat_id=chat.id, sender="user", content=message),
-            Message(chat_id=chat.id, sender="assistant", content=reply)
-        ])
-        db.commit()
-
-        store_message(character, "demo", message, reply)
-        LAST_REPLIES[character] = reply  # Store last reply for this character
+        await finish_turn(turn, reply)
 
         return JSONResponse({"reply": reply})
 
+    except TurnCancelled as e:
+        cancellation.skipped_post_processing()
+        # 499: client closed request (nobody may be listening any more)
+        return JSONResponse({"error": str(e), "reason": e.reason}, status_code=499)
+    except (InferenceBusy, ModelNotReady) as e:
+        return JSONResponse({"error": str(e)}, status_code=503)
     except Exception as e:
         import traceback
         tb = traceback.format_exc()
         return JSONResponse({"error": str(e), "traceback": tb}, status_code=500)
+    finally:
+        release_turn(turn, token, watcher)
+
+def sse_event(data, event=None):
+    payload = f"data: {json.dumps(data)}\n\n"
+    return f"event: {event}\n{payload}" if event else payload
+
+@app.post("/send-message/stream")
+async def send_message_stream(
+    request: Request,
+    character: str = Form(...),
+    message: str = Form(...),
+    model_key: str = Form("hermes"),
+    session_id: str = Form(None)
+):
+    """
+    Server-sent events version of /send-message.
+    Emits `data: {"token": ...}` per chunk, then `event: done` with the full
+    reply once it has been stored (or `event: error`, `event: cancelled`).
+    """
+    token, watcher = start_cancellable(request)
+    try:
+        turn = await token.run(prepare_turn(character, message, model_key, session_id))
+    except TurnCancelled as e:
+        cancellation.skipped_post_processing()
+        return JSONResponse({"error": str(e), "reason": e.reason}, status_code=499)
+    except ModelNotReady as e:
+        return JSONResponse({"error": str(e)}, status_code=503)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+    finally:
+        # From here on a disconnect tears the stream down (handled in events())
+        watcher.cancel()
+    track_turn(turn, token)
+
+    async def events():
+        parts = []
+        try:
+            reply = await cached_reply(turn)
+            if reply is not None:
+                yield sse_event({"token": reply})
+            else:
+                async for chunk in stream_reply(
+                    turn["model"], turn["tokenizer_or_token"], turn["prompt"], turn["gen_args"], turn["stop"], token
+                ):
+                    parts.append(chunk)
+                    yield sse_event({"token": chunk})
+                reply = "".join(parts).strip()
+                token.check()
+                if not reply:
+                    # Nothing was streamed (e.g. a remote endpoint without SSE):
+                    # a blank bot turn would only pollute later prompts
+                    yield sse_event({"error": "The model returned an empty reply"}, event="error")
+                    return
+                await cache_reply(turn, reply)
+            await finish_turn(turn, reply)
+            yield sse_event({"reply": reply}, event="done")
+        except TurnCancelled as e:
+            cancellation.skipped_post_processing()
+            yield sse_event({"reason": e.reason}, event="cancelled")
+        except (asyncio.CancelledError, GeneratorExit):
+            # Starlette tears the response down when the client disconnects
+            token.cancel("disconnected")
+            cancellation.skipped_post_processing()
+            raise
+        except Exception as e:
+            logger.error(f"[STREAM] {character}: {e}")
+            yield sse_event({"error": str(e)}, event="error")
+        finally:
+            release_turn(turn, token)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.get("/last-reply")
 async def last_reply(character: str):
@@ -189,26 +522,70 @@ def list_models():
     return list(MODEL_REGISTRY.keys())
 
 @app.get("/personas")
-def list_personas():
-    return [p.stem for p in Path("personas").glob("*.json")]
+def list_personas(offset: int = 0, limit: int | None = None):
+    names = persona_store.names()
+    if limit is None:
+        return names[offset:]
+    return names[offset:offset + limit]
+
+PERSONAS_PAGE_SIZE = 50
+
+def get_persona_data(page=1, page_size=PERSONAS_PAGE_SIZE):
+    """
+    Catalog context for index.html: every persona name (for the character
+    picker) but full persona data only for the requested page.
+    """
+    page = max(page, 1)
+    names = persona_store.names()
+    page_names, persona_data = persona_store.page((page - 1) * page_size, page_size)
+    return {
+        "personas": names,
+        "page_personas": page_names,
+        "persona_data": persona_data,
+        "page": page,
+        "has_next": page * page_size < len(names),
+    }
 
 @app.get("/stats")
 def stats(user_id: str = "demo"):
     return JSONResponse(get_usage_stats(user_id))
 
-def get_persona_data():
-    personas = list_personas()
-    persona_data = {p: load_persona(p) for p in personas}
-    return personas, persona_data
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok", "uptime_seconds": readiness.report()["uptime_seconds"]}
+
+@app.get("/readyz")
+def readyz():
+    state = readiness.report()
+    return JSONResponse(state, status_code=200 if state["ready"] else 503)
+
+@app.get("/metrics")
+def metrics():
+    return {
+        "inference": inference_stats(),
+        "batching": batching_stats(),
+        "adapters": adapter_stats(),
+        "response_cache": response_cache.report(),
+        "work_queue": work_queue.queue_stats(),
+        "embeddings": embedding_service.report(),
+        "memory_compaction": compaction_stats(),
+        "pregen_stages": stage_stats(),
+        "summarizer": summarizer_stats(),
+        "context_packer": packer_stats(),
+        "prompt_tokens": prompt_token_stats(),
+        "stop_sequences": stop_stats(),
+        "cancellation": cancellation_stats(),
+        "rate_limiter": rate_limit_stats(),
+        "character_memory": character_memory_stats(),
+        "session_cache": session_cache.report(),
+    }
 
 @app.get("/")
-def index(request: Request):
-    personas, persona_data = get_persona_data()
+def index(request: Request, page: int = 1):
     return templates.TemplateResponse("index.html", {
         "request": request,
         "models": list_models(),
-        "personas": personas,
-        "persona_data": persona_data,
+        **get_persona_data(page),
         "selected_character": None,
         "selected_model": None,
         "user_message": "",
@@ -230,121 +607,54 @@ async def chat_post(
     message: str = Form(...),
     session_id: str = Query(default_factory=lambda: str(uuid.uuid4()))
 ):
+    token, watcher = start_cancellable(request)
+    turn = None
     try:
         # Use our logger for visibility
         logger.info(f"[CHAT] Character: {character} | Message: {message}")
 
-        personas = list_personas()
-        persona_data = {p: load_persona(p) for p in personas}
-
-        #  Try to load or create persona if not found
-        if character not in persona_data:
-            logger.warning(f"Persona '{character}' not found. Creating default...")
-            default_persona = {
-                "name": character,
-                "persona": f"{character} is a helpful, friendly assistant.",
-                "image_url": "",
-                "character_memory": [],
-                "generation_params": {"max_new_tokens": 300, "temperature": 0.7, "top_p": 0.9},
-                "template": "plain"
-            }
-            save_persona(character, default_persona)
-            persona = default_persona
-            persona_data[character] = default_persona
-        else:
-            persona = persona_data[character]
-
-        model_obj, tokenizer_or_token = get_model(model_key or persona.get("model"))
-
-        db = SessionLocal()
-        chat = db.query(Chat).filter_by(session_id=session_id, user_id="demo", character=character).first()
-        if not chat:
-            chat = Chat(session_id=session_id, user_id="demo", character=character)
-            db.add(chat)
-            db.commit()
-            db.refresh(chat)
-
-        db_messages = db.query(Message).filter_by(chat_id=chat.id).order_by(Message.timestamp).all()
-        history = []
-        for m in db_messages:
-            if m.sender == "user":
-                history.append({"user": m.content, "assistant": ""})
-            else:
-                history[-1]["assistant"] = m.content
-
-
-        summary, recent = maybe_summarize(history)
-        
-        snippets = retrieve_similar(character, "demo", message, top_k=5)
-        if snippets:
-            summary = (summary or "") + "\n" + "\n".join(snippets)
-
         if message.startswith("<<character info>>"):
             info = message.replace("<<character info>>", "").strip()
             if info:
-                persona.setdefault("character_memory", []).append(info)
-                save_persona(character, persona)
+                await run_in_threadpool(resolve_persona, character)
+                await run_in_threadpool(add_character_memory, character, info, "info")
             return RedirectResponse(url="/", status_code=303)
 
-        prompt = format_prompt(persona.get("template", "plain"), persona, recent, message, summary)
-        gen_args = persona.get("generation_params", {})
-
-        if isinstance(model_obj, str):
-            headers = {"Authorization": f"Bearer {tokenizer_or_token}"}
-            payload = {"inputs": prompt, "parameters": gen_args}
-            try:
-                resp = requests.post(model_obj, headers=headers, json=payload, timeout=60)
-                resp.raise_for_status()
-                reply = resp.json()[0]["generated_text"].split("<|assistant|>")[-1].strip()
-            except requests.exceptions.HTTPError as http_err:
-                if resp.status_code == 429:
-                    error_msg = "The model API is currently rate-limited (Too Many Requests). Please try again in a moment."
-                    return templates.TemplateResponse("index.html", {
-                        "request": request,
-                        "models": list_models(),
-                        "personas": personas,
-                        "persona_data": persona_data,
-                        "selected_character": character,
-                        "selected_model": model_key,
-                        "user_message": message,
-                        "reply": None,
-                        "reflection": None,
-                        "error": error_msg
-                    })
-                else:
-                    raise
-        else:
-            inputs = tokenizer_or_token(prompt, return_tensors="pt").to(model_obj.device)
-            with torch.no_grad():
-                outputs = model_obj.generate(**inputs, **gen_args)
-            reply = tokenizer_or_token.decode(
-                outputs[0][inputs["input_ids"].shape[-1]:], skip_special_tokens=True
-            ).strip()
+        turn = await token.run(prepare_turn(character, message, model_key, session_id, new_session_id=session_id))
+        track_turn(turn, token)
+
+        try:
+            reply = await generate_turn(turn)
+        except httpx.HTTPStatusError as http_err:
+            if http_err.response.status_code == 429:
+                error_msg = "The model API is currently rate-limited (Too Many Requests). Please try again in a moment."
+                return templates.TemplateResponse("index.html", {
+                    "request": request,
+                    "models": list_models(),
+                    **(await run_in_threadpool(get_persona_data)),
+                    "selected_character": character,
+                    "selected_model": model_key,
+                    "user_message": message,
+                    "reply": None,
+                    "reflection": None,
+                    "error": error_msg
+                })
+            else:
+                raise
 
         # Print the response to the console
         logger.info(f"[RESPONSE] Character: {character} | Message: {message} | Response: {reply}")
 
-        db.add_all([
-            Message(chat_id=chat.id, sender="user", content=message),
-            Message(chat_id=chat.id, sender="assistant", content=reply)
-        ])
-        db.commit()
-
-        store_message(character, "demo", message, reply)
+        await finish_turn(turn, reply)
        # count_tokens(tokenizer_or_token, prompt, reply, "demo")
 
-        if len(history) % 5 == 0:
-            refl = reflect_on_session(model_obj, tokenizer_or_token, persona, recent)
-            persona.setdefault("character_memory", []).append(refl)
-            save_persona(character, persona)
-        else:
-            refl = None
+        # Reflections now run in the background work queue
+        refl = None
 
         return templates.TemplateResponse("index.html", {
             "request": request,
             "models": list_models(),
-            "personas": personas,
-            "persona_data": persona_data,
+            **(await run_in_threadpool(get_persona_data)),
             "selected_character": character,
             "selected_model": model_key,
             "user_message": message,
@@ -352,14 +662,23 @@ async def chat_post(
             "reflection": refl
         })
 
+    except TurnCancelled as e:
+        cancellation.skipped_post_processing()
+        return HTMLResponse(f"<h2>Cancelled</h2><p>{e}</p>", status_code=499)
+    except (InferenceBusy, ModelNotReady) as e:
+        return HTMLResponse(f"<h2>Server busy</h2><p>{e}</p>", status_code=503)
     except Exception as e:
         import traceback
         tb = traceback.format_exc()
         logger.error(tb)
         return HTMLResponse(f"<h2>Internal Error</h2><pre>{tb}</pre>", status_code=500)
+    finally:
+        release_turn(turn, token, watcher)
 
 @app.post("/train-adapters/{character}")
 async def train_adapters(character: str, background_tasks: BackgroundTasks):
+    from train_lora_adapters import train_lora_for_character
+
     path = Path("personas") / f"{character}.json"
     if not path.exists():
         raise HTTPException(status_code=404, detail="Persona not found")
@@ -368,11 +687,10 @@ async def train_adapters(character: str, background_tasks: BackgroundTasks):
 
 @app.get("/persona/{name}")
 def get_persona(name: str):
-    path = Path("personas") / f"{name}.json"
-    if not path.exists():
+    persona = persona_store.get(name)
+    if persona is None:
         raise HTTPException(status_code=404, detail="Persona not found")
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return persona
 
 # Mount external API endpoints
 app.include_router(external_router)
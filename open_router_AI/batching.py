@@ -0,0 +1,189 @@
+# batching.py
+#
+# Request scheduler in front of local models.
+#
+# Concurrent chat turns for the same model are collected for a short window
+# (or until the batch is full), grouped by their generation params, padded into
+# one tensor and run through a single generate() call on the inference pool.
+# While a batch is running new turns keep queueing, and the next batch drains
+# everything that arrived in the meantime, so under load the model always
+# works on as many conversations as it can fit.
+
+import asyncio
+import json
+import os
+
+from cancellation import TurnCancelled
+from inference import InferenceBusy, INFERENCE_QUEUE_LIMIT, run_inference
+from lora_utils import AdapterBinding
+from models.registry import MODEL_REGISTRY
+from prefix_cache import generate_with_prefix_cache, prefix_cache
+from prompt_tokens import encode_batch
+from stop_sequences import finish_local, stopping_criteria
+
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+
+_schedulers = {}
+
+
+def _params_key(gen_args):
+    return json.dumps(gen_args or {}, sort_keys=True, default=str)
+
+
+def _generate_batch(model, tokenizer, prompts, gen_args, stops, cancels):
+    import torch
+
+    inputs = encode_batch(tokenizer, prompts, model.device)
+    prompt_len = inputs["input_ids"].shape[-1]
+    gen_args = {"pad_token_id": tokenizer.pad_token_id, **gen_args}
+    with torch.no_grad():
+        outputs = model.generate(
+            **inputs, stopping_criteria=stopping_criteria(tokenizer, stops, prompt_len, cancels), **gen_args
+        )
+    replies = []
+    for out, stop in zip(outputs, stops):
+        # Rows that finished early are padded up to the longest one
+        new_tokens = out[prompt_len:]
+        new_tokens = new_tokens[new_tokens != tokenizer.pad_token_id]
+        replies.append(finish_local(
+            tokenizer.decode(new_tokens, skip_special_tokens=True), stop, len(new_tokens), gen_args
+        ))
+    return replies
+
+
+class BatchScheduler:
+    def __init__(self, model, tokenizer, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.worker = None
+        self.stats = {"requests": 0, "batches": 0, "batched_requests": 0, "max_batch": 0}
+
+        # Decoder-only models must be left padded for batched generation
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+
+    async def submit(self, prompt, gen_args, prefix=None, stop=(), cancel=None):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+        if self.queue.qsize() >= INFERENCE_QUEUE_LIMIT:
+            raise InferenceBusy("Local inference queue is full, try again shortly")
+
+        future = asyncio.get_running_loop().create_future()
+        self.stats["requests"] += 1
+        await self.queue.put((prompt, dict(gen_args or {}), future, prefix, tuple(stop), cancel))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            groups = {}
+            for item in batch:
+                groups.setdefault(_params_key(item[1]), []).append(item)
+            for items in groups.values():
+                await self._run_group(items)
+
+    async def _run_group(self, items):
+        # Callers that gave up (client went away, turn cancelled) do not need a slot
+        live = []
+        for item in items:
+            if item[5] is not None and item[5].cancelled and not item[2].done():
+                item[2].set_exception(TurnCancelled(item[5].reason))
+            elif not item[2].done():
+                live.append(item)
+        items = live
+        if not items:
+            return
+        prompts = [item[0] for item in items]
+        gen_args = items[0][1]
+        self.stats["batches"] += 1
+        self.stats["batched_requests"] += len(items)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(items))
+        try:
+            if len(items) == 1 and prefix_cache.enabled:
+                # A lone turn gains more from reusing its session's KV than from padding
+                replies = [await run_inference(
+                    generate_with_prefix_cache, self.model, self.tokenizer, prompts[0], gen_args, items[0][3],
+                    stop=items[0][4], cancel=items[0][5]
+                )]
+            else:
+                stops = [item[4] for item in items]
+                cancels = [item[5] for item in items]
+                replies = await run_inference(
+                    _generate_batch, self.model, self.tokenizer, prompts, gen_args, stops, cancels
+                )
+        except Exception as e:
+            for item in items:
+                if not item[2].done():
+                    item[2].set_exception(e)
+            return
+        for item, reply in zip(items, replies):
+            future = item[2]
+            if not future.done():
+                future.set_result(reply)
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+
+def get_scheduler(model, tokenizer):
+    """
+    One scheduler per loaded model. Per-model `max_batch_size` / `batch_wait_ms`
+    entries in MODEL_REGISTRY override the BATCH_MAX_SIZE / BATCH_MAX_WAIT_MS env.
+    """
+    scheduler = _schedulers.get(id(model))
+    if scheduler is None:
+        # adapter handles (lora_utils.AdapterBinding) share their base model's settings
+        base = model.manager.base_model if isinstance(model, AdapterBinding) else model
+        config = next((c for c in MODEL_REGISTRY.values() if c.get("model") is base), {})
+        scheduler = BatchScheduler(
+            model,
+            tokenizer,
+            max_batch_size=config.get("max_batch_size", BATCH_MAX_SIZE),
+            max_wait_ms=config.get("batch_wait_ms", BATCH_MAX_WAIT_MS)
+        )
+        _schedulers[id(model)] = scheduler
+    return scheduler
+
+
+def close_schedulers():
+    for scheduler in _schedulers.values():
+        scheduler.close()
+    _schedulers.clear()
+
+
+def batching_stats():
+    stats = {}
+    for scheduler in _schedulers.values():
+        s = dict(scheduler.stats)
+        s["avg_batch"] = s["batched_requests"] / (s["batches"] or 1)
+        s["max_batch_size"] = scheduler.max_batch_size
+        s["max_wait_ms"] = scheduler.max_wait * 1000
+        name = getattr(scheduler.model, "name_or_path", str(id(scheduler.model)))
+        adapter = getattr(scheduler.model, "adapter_name", None)
+        stats[f"{name}+{adapter}" if adapter else name] = s
+    return stats
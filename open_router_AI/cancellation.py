@@ -0,0 +1,148 @@
+# cancellation.py
+#
+# Cancelling chat turns nobody is waiting for any more.
+#
+# Every /send-message request gets a CancelToken. It is cancelled when
+#
+#   disconnected - the client went away (polled every DISCONNECT_POLL_SECONDS,
+#                  or the SSE response was torn down)
+#   superseded   - a newer message arrived for the same chat
+#   deadline     - REQUEST_DEADLINE seconds passed (0 disables)
+#
+# A cancelled token ends local generate() at the next token (a stopping
+# criterion, per row in a batch), aborts the remote HTTP request and makes the
+# endpoint skip storing the turn and all post-processing.
+
+import asyncio
+import os
+import threading
+import time
+
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "120"))
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+
+_active = {}  # chat id -> token of the turn being generated
+_lock = threading.Lock()
+STATS = {"started": 0, "disconnected": 0, "superseded": 0, "deadline": 0, "skipped_post_processing": 0}
+
+
+class TurnCancelled(Exception):
+    """Raised when a turn is cancelled while it is being generated."""
+
+    def __init__(self, reason):
+        super().__init__(f"Turn cancelled ({reason})")
+        self.reason = reason
+
+
+class CancelToken:
+    def __init__(self, deadline=REQUEST_DEADLINE):
+        self.reason = None
+        self.deadline = time.monotonic() + deadline if deadline else None
+        self._event = threading.Event()
+        self._loop = asyncio.get_running_loop()
+        self._async_event = asyncio.Event()
+        STATS["started"] += 1
+
+    def cancel(self, reason):
+        """
+        Thread-safe; only the first reason counts.
+        """
+        with _lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            STATS[reason] += 1
+        self._loop.call_soon_threadsafe(self._async_event.set)
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() > self.deadline:
+            self.cancel("deadline")
+        return self._event.is_set()
+
+    def remaining(self):
+        return None if self.deadline is None else max(self.deadline - time.monotonic(), 0)
+
+    async def run(self, coro):
+        """
+        Await `coro` unless the token is cancelled first, in which case the
+        coroutine is cancelled and TurnCancelled raised.
+        """
+        task = asyncio.ensure_future(coro)
+        waiter = asyncio.ensure_future(self._async_event.wait())
+        try:
+            done, _ = await asyncio.wait(
+                {task, waiter}, timeout=self.remaining(), return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            waiter.cancel()
+        if task in done:
+            return task.result()
+        task.cancel()
+        if not self.cancelled:
+            self.cancel("deadline")
+        raise TurnCancelled(self.reason)
+
+    def check(self):
+        if self.cancelled:
+            raise TurnCancelled(self.reason)
+
+
+def begin(chat_id, token):
+    """
+    Register `token` as the chat's current turn, cancelling the one it replaces.
+    """
+    with _lock:
+        previous = _active.get(chat_id)
+        _active[chat_id] = token
+    if previous is not None and previous is not token:
+        previous.cancel("superseded")
+
+
+def end(chat_id, token):
+    with _lock:
+        if _active.get(chat_id) is token:
+            del _active[chat_id]
+
+
+async def watch_disconnect(request, token):
+    """
+    Cancel `token` once the client of `request` disconnects. Run as a task and
+    cancel it when the response is done.
+    """
+    while not token.cancelled:
+        if await request.is_disconnected():
+            token.cancel("disconnected")
+            return
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+
+def cancel_criterion(tokens):
+    """
+    StoppingCriteria that ends the rows whose token (one per row, or None) is
+    cancelled, or None when no row can be.
+    """
+    if not any(tokens):
+        return None
+    import torch
+    from transformers import StoppingCriteria
+
+    class StopOnCancel(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            done = [t is not None and t.cancelled for t in tokens]
+            return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    return StopOnCancel()
+
+
+def skipped_post_processing():
+    STATS["skipped_post_processing"] += 1
+
+
+def cancellation_stats():
+    with _lock:
+        stats = dict(STATS)
+        stats["active"] = len(_active)
+    stats["deadline_seconds"] = REQUEST_DEADLINE
+    return stats
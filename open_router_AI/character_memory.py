@@ -0,0 +1,225 @@
+# character_memory.py
+#
+# What a character remembers across all its chats: reflections written by the
+# model every few turns and facts given with `<<character info>>`.
+#
+# These used to be appended to the persona JSON forever (junk included) and all
+# of them went into every prompt. Now they live in the `character_memories`
+# table of chat.db:
+#
+# - skipped/failed reflections and empty text are never stored,
+# - an entry equal to (or, by embedding, nearly the same as) an existing one
+#   only bumps that entry,
+# - each character keeps at most CHARACTER_MEMORY_CAP entries, the least
+#   recently used are dropped,
+# - a turn only gets the CHARACTER_MEMORY_TOP_N entries most relevant to its
+#   message. Their last_used_at is refreshed through the work queue, and only
+#   once it is CHARACTER_MEMORY_TOUCH_SECONDS old, so selecting is read-only.
+
+import hashlib
+import logging
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy.exc import IntegrityError
+
+import work_queue
+from models.db import SessionLocal, CharacterMemory
+
+logger = logging.getLogger(__name__)
+
+CHARACTER_MEMORY_CAP = int(os.getenv("CHARACTER_MEMORY_CAP", "200"))
+CHARACTER_MEMORY_TOP_N = int(os.getenv("CHARACTER_MEMORY_TOP_N", "5"))
+CHARACTER_MEMORY_DEDUPE = float(os.getenv("CHARACTER_MEMORY_DEDUPE", "0.92"))
+# last_used_at only drives eviction order, so it may lag this much behind
+CHARACTER_MEMORY_TOUCH_SECONDS = float(os.getenv("CHARACTER_MEMORY_TOUCH_SECONDS", "3600"))
+
+# What reflect_on_session and friends return when they did not reflect
+_JUNK = re.compile(r"^\[(reflection|error|warn)[^\]]*\]$", re.IGNORECASE)
+
+STATS = {"added": 0, "duplicates": 0, "rejected": 0, "evicted": 0, "selected": 0, "touched": 0}
+
+
+def is_junk(text):
+    text = (text or "").strip()
+    return len(text) < 3 or bool(_JUNK.match(text))
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+
+def _digest(text):
+    return hashlib.sha1(_normalize(text).encode("utf-8")).hexdigest()
+
+
+def _embed(texts):
+    """
+    Unit float32 vectors, or None when the embedder is unavailable (exact
+    dedupe and recency ordering still work without it).
+    """
+    try:
+        from vector_memory import embed_many
+        vectors = np.stack([np.asarray(v, dtype=np.float32) for v in embed_many(texts)])
+    except Exception as e:
+        logger.warning(f"Character memory embeddings unavailable: {e}")
+        return None
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+
+
+def _vectors(rows):
+    return [np.frombuffer(r.embedding, dtype=np.float32) if r.embedding else None for r in rows]
+
+
+def add(character, text, source="reflection", embed=True):
+    """
+    Remember `text` for `character`. Returns True if a new entry was stored.
+    Blocking (DB + embedding), call through run_in_threadpool from async routes.
+    With embed=False the embedding is computed the first time select() runs.
+    """
+    text = (text or "").strip()
+    if is_junk(text):
+        STATS["rejected"] += 1
+        return False
+
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        digest = _digest(text)
+        rows = db.query(CharacterMemory).filter_by(character=character).all()
+        duplicate = next((r for r in rows if r.digest == digest), None)
+        vectors = _embed([text]) if embed else None
+        vector = vectors[0] if vectors is not None else None
+        if duplicate is None and vector is not None:
+            for row, other in zip(rows, _vectors(rows)):
+                if other is not None and float(other @ vector) >= CHARACTER_MEMORY_DEDUPE:
+                    duplicate = row
+                    break
+        if duplicate is not None:
+            duplicate.hits = (duplicate.hits or 1) + 1
+            duplicate.last_used_at = now
+            db.commit()
+            STATS["duplicates"] += 1
+            return False
+
+        db.add(CharacterMemory(
+            character=character, text=text, digest=digest, source=source,
+            embedding=vector.tobytes() if vector is not None else None,
+            created_at=now, last_used_at=now
+        ))
+        overflow = len(rows) + 1 - CHARACTER_MEMORY_CAP
+        if overflow > 0:
+            for row in sorted(rows, key=lambda r: (r.last_used_at or r.created_at, r.hits or 1))[:overflow]:
+                db.delete(row)
+            STATS["evicted"] += overflow
+        try:
+            db.commit()
+        except IntegrityError:
+            # Same text added concurrently (reflection job vs. <<character info>>)
+            db.rollback()
+            STATS["duplicates"] += 1
+            return False
+        STATS["added"] += 1
+        return True
+    finally:
+        db.close()
+
+
+def select(character, query, top_n=CHARACTER_MEMORY_TOP_N):
+    """
+    The `top_n` memories of `character` most relevant to `query` (most recently
+    used first when there are no embeddings).
+    """
+    db = SessionLocal()
+    try:
+        rows = db.query(CharacterMemory).filter_by(character=character).all()
+        if not rows:
+            return []
+        query_vector = _embed([query]) if query else None
+        vectors = _vectors(rows)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if query_vector is not None and missing:
+            # One-off backfill for entries stored with embed=False
+            filled = _embed([rows[i].text for i in missing])
+            if filled is not None:
+                for i, vector in zip(missing, filled):
+                    rows[i].embedding = vector.tobytes()
+                    vectors[i] = vector
+                db.commit()
+        if query_vector is not None and all(v is not None for v in vectors):
+            scores = np.stack(vectors) @ query_vector[0]
+            chosen = [rows[i] for i in np.argsort(-scores)[:top_n]]
+        else:
+            chosen = sorted(rows, key=lambda r: r.last_used_at or r.created_at, reverse=True)[:top_n]
+        now = datetime.utcnow()
+        stale = [
+            row.id for row in chosen
+            if row.last_used_at is None or (now - row.last_used_at).total_seconds() > CHARACTER_MEMORY_TOUCH_SECONDS
+        ]
+        if stale:
+            work_queue.enqueue("touch_character_memory", {"ids": stale, "at": now.isoformat()})
+        STATS["selected"] += len(chosen)
+        return [row.text for row in chosen]
+    finally:
+        db.close()
+
+
+def touch_batch(payloads):
+    """
+    Apply the last_used_at updates queued by select(), one commit per batch.
+    """
+    latest = {}
+    for p in payloads:
+        at = datetime.fromisoformat(p["at"])
+        for memory_id in p["ids"]:
+            latest[memory_id] = max(at, latest.get(memory_id, at))
+    db = SessionLocal()
+    try:
+        for row in db.query(CharacterMemory).filter(CharacterMemory.id.in_(list(latest))).all():
+            row.last_used_at = max(latest[row.id], row.last_used_at or latest[row.id])
+        db.commit()
+        STATS["touched"] += len(latest)
+    finally:
+        db.close()
+
+
+def import_persona_memories(persona_store, save_persona):
+    """
+    Move `character_memory` lists left in persona JSON files into the store
+    (dropping junk) and empty them. A one-off migration, run with
+    `python character_memory.py import-personas`; a no-op once migrated.
+    """
+    moved = 0
+    for name in persona_store.names():
+        persona = persona_store.get(name)
+        entries = (persona or {}).get("character_memory") or []
+        if not entries:
+            continue
+        for text in entries:
+            moved += add(name, text, source="imported", embed=False)
+        persona["character_memory"] = []
+        save_persona(name, persona)
+    return moved
+
+
+def character_memory_stats():
+    return dict(STATS)
+
+
+work_queue.register("touch_character_memory", touch_batch)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["import-personas"]:
+        from models.db import init_db
+        from persona_store import persona_store
+        from utils import save_persona
+
+        init_db()
+        print(f"Imported {import_persona_memories(persona_store, save_persona)} memories")
+    else:
+        print("usage: python character_memory.py import-personas")
@@ -0,0 +1,146 @@
+# context_packer.py
+#
+# Fits a turn's context into the model's context window.
+#
+# The budget is the model's `context_window` (MODEL_REGISTRY, else the
+# CONTEXT_WINDOW env) minus the reply's max_new_tokens and a safety margin.
+# The persona header and the new message always go in; the rest is added in
+# priority order while it fits:
+#
+#   rolling summary -> recent turns (newest first) -> retrieved memories
+#   -> character memories (most relevant first)
+#
+# Recent turns that do not fit are not lost: they are appended to the summary
+# as a topic list. Token counts of stored messages are cached in
+# messages.token_count (with the tokenizer that produced them in
+# messages.token_counter), so a turn only tokenizes text it has not seen.
+
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from models.registry import MODEL_REGISTRY
+from summarizer import topics_fold
+
+CONTEXT_WINDOW = int(os.getenv("CONTEXT_WINDOW", "4096"))
+# Share of the window kept free for tokenizer differences and template tags
+CONTEXT_MARGIN = float(os.getenv("CONTEXT_MARGIN", "0.05"))
+# Role tags and separators a template adds around each turn / context line
+TURN_OVERHEAD_TOKENS = 8
+LINE_OVERHEAD_TOKENS = 2
+
+_prefix_counts = OrderedDict()  # (counter name, text) -> tokens
+_lock = threading.Lock()
+STATS = {"packed": 0, "prompt_tokens": 0, "dropped_turns": 0, "dropped_snippets": 0, "dropped_memories": 0, "dropped_summary": 0}
+
+
+def _estimate(text):
+    # ~4 characters per token for English text with BPE tokenizers
+    return math.ceil(len(text) / 4)
+
+
+def get_counter(tokenizer_or_token):
+    """
+    (name, count(text) -> int) for the model's tokenizer; remote models, which
+    have no local tokenizer, get a character-based estimate.
+    """
+    if hasattr(tokenizer_or_token, "encode"):
+        name = getattr(tokenizer_or_token, "name_or_path", None) or type(tokenizer_or_token).__name__
+        return name, lambda text: len(tokenizer_or_token.encode(text, add_special_tokens=False))
+    return "estimate", _estimate
+
+
+def count_cached(counter, text):
+    """
+    Token count of a text that repeats across turns (the persona header).
+    """
+    key = (counter[0], text)
+    with _lock:
+        n = _prefix_counts.get(key)
+        if n is not None:
+            _prefix_counts.move_to_end(key)
+            return n
+    n = counter[1](text)
+    with _lock:
+        _prefix_counts[key] = n
+        while len(_prefix_counts) > 256:
+            _prefix_counts.popitem(last=False)
+    return n
+
+
+def ensure_token_counts(db, rows, counter):
+    """
+    Fill in messages.token_count for rows counted with another tokenizer (or
+    never counted). Commits only when something changed.
+    """
+    name, count = counter
+    stale = [m for m in rows if m.token_count is None or m.token_counter != name]
+    for m in stale:
+        m.token_count = count(m.content or "")
+        m.token_counter = name
+    if stale:
+        db.commit()
+
+
+def context_budget(model_key, gen_args):
+    config = MODEL_REGISTRY.get(model_key, {})
+    window = config.get("context_window", CONTEXT_WINDOW)
+    reserved = gen_args.get("max_new_tokens", 0) + int(window * CONTEXT_MARGIN)
+    return max(window - reserved, 0)
+
+
+def pack_context(counter, budget, fixed_tokens, recent, summary, snippets, memories):
+    """
+    Choose what goes into the prompt. `fixed_tokens` is the persona header plus
+    the new message; `recent` turns carry their cached "tokens".
+    Returns (recent, context text or None).
+    """
+    count = counter[1]
+    left = budget - fixed_tokens
+
+    summary_tokens = count(summary) + LINE_OVERHEAD_TOKENS if summary else 0
+    if summary_tokens > left:
+        summary, summary_tokens = None, 0
+        STATS["dropped_summary"] += 1
+    left -= summary_tokens
+
+    kept = []
+    for turn in reversed(recent):
+        cost = turn.get("tokens")
+        if cost is None:
+            cost = count(turn["user"]) + count(turn["assistant"])
+        cost += TURN_OVERHEAD_TOKENS
+        if cost > left:
+            break
+        kept.append(turn)
+        left -= cost
+    kept.reverse()
+    dropped = recent[:len(recent) - len(kept)]
+    if dropped:
+        STATS["dropped_turns"] += len(dropped)
+        listed = topics_fold(summary, dropped)
+        extra = count(listed) + LINE_OVERHEAD_TOKENS - summary_tokens
+        if extra <= left:
+            summary = listed
+            left -= extra
+
+    lines = [summary] if summary else []
+    for name, items in (("snippets", snippets), ("memories", memories)):
+        for item in items:
+            cost = count(item) + LINE_OVERHEAD_TOKENS
+            if cost > left:
+                STATS[f"dropped_{name}"] += 1
+                continue
+            lines.append(item)
+            left -= cost
+
+    STATS["packed"] += 1
+    STATS["prompt_tokens"] += budget - left
+    return kept, "\n".join(lines) or None
+
+
+def packer_stats():
+    stats = dict(STATS)
+    stats["avg_prompt_tokens"] = round(stats["prompt_tokens"] / (stats["packed"] or 1), 1)
+    return stats
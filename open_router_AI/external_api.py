@@ -1,8 +1,7 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from utils import build_prompt_with_history
-from models.registry import get_model
-import torch
+from models.registry import ModelNotReady, get_model
 
 router = APIRouter()
 
@@ -37,7 +36,12 @@ def generate_reply(data: GenerateRequest):
 
     prompt = build_prompt_with_history(persona, structured_history, data.user_prompt)
 
-    model, tokenizer = get_model(persona["model"])
+    import torch
+
+    try:
+        model, tokenizer = get_model(persona["model"])
+    except ModelNotReady as e:
+        raise HTTPException(status_code=503, detail=str(e))
     inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
     with torch.no_grad():
         outputs = model.generate(**inputs, **persona["generation_params"])
@@ -0,0 +1,323 @@
+# inference.py
+#
+# Generation backends used by the chat endpoints.
+#
+# Remote models go through one pooled httpx.AsyncClient and local
+# `model.generate` calls run on a dedicated, size-bounded thread pool, so a
+# slow reply never blocks the uvicorn event loop (and /models, /personas etc.
+# keep answering while a chat is being generated).
+
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from prefix_cache import generate_with_prefix_cache, prefix_cache
+from prompt_tokens import encode_inputs
+from stop_sequences import StreamTrimmer, finish_local, finish_remote, record_stop, stopping_criteria
+
+# Number of local generate() calls that may run at the same time. One is the
+# safe default for a single GPU; raise it for CPU boxes with spare cores.
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+# Local requests allowed to wait for a worker before we answer 503.
+INFERENCE_QUEUE_LIMIT = int(os.getenv("INFERENCE_QUEUE_LIMIT", "32"))
+# Route local chat turns through the batching scheduler (batching.py).
+BATCHING_ENABLED = os.getenv("BATCHING_ENABLED", "1") == "1"
+REMOTE_TIMEOUT = float(os.getenv("REMOTE_TIMEOUT", "60"))
+REMOTE_MAX_CONNECTIONS = int(os.getenv("REMOTE_MAX_CONNECTIONS", "20"))
+
+inference_executor = ThreadPoolExecutor(
+    max_workers=INFERENCE_WORKERS,
+    thread_name_prefix="inference"
+)
+
+_client = None
+_stats_lock = threading.Lock()
+
+STATS = {
+    "local_pending": 0,
+    "local_running": 0,
+    "local_peak_concurrency": 0,
+    "local_completed": 0,
+    "local_rejected": 0,
+    "local_wait_seconds": 0.0,
+    "local_run_seconds": 0.0,
+    "remote_in_flight": 0,
+    "remote_peak_concurrency": 0,
+    "remote_completed": 0,
+    "remote_failed": 0,
+    "remote_seconds": 0.0,
+}
+
+
+class InferenceBusy(Exception):
+    """Raised when the local inference queue is full."""
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=REMOTE_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=REMOTE_MAX_CONNECTIONS,
+                max_keepalive_connections=REMOTE_MAX_CONNECTIONS
+            )
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def shutdown_executor():
+    inference_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def submit_inference(fn, *args, **kwargs):
+    """
+    Submit a blocking model call to the inference executor and return its
+    concurrent.futures.Future. The call counts against INFERENCE_QUEUE_LIMIT
+    until it has finished running, whether or not anybody still waits for it.
+    Thread-safe, so background jobs use it too.
+    Raises InferenceBusy when INFERENCE_QUEUE_LIMIT calls are already pending.
+    """
+    with _stats_lock:
+        if STATS["local_pending"] >= INFERENCE_QUEUE_LIMIT:
+            STATS["local_rejected"] += 1
+            raise InferenceBusy("Local inference queue is full, try again shortly")
+        STATS["local_pending"] += 1
+
+    queued_at = time.perf_counter()
+
+    def job():
+        started = time.perf_counter()
+        with _stats_lock:
+            STATS["local_wait_seconds"] += started - queued_at
+            STATS["local_running"] += 1
+            STATS["local_peak_concurrency"] = max(STATS["local_peak_concurrency"], STATS["local_running"])
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with _stats_lock:
+                STATS["local_running"] -= 1
+                STATS["local_run_seconds"] += time.perf_counter() - started
+
+    def release(future):
+        with _stats_lock:
+            STATS["local_pending"] -= 1
+            if not future.cancelled() and future.exception() is None:
+                STATS["local_completed"] += 1
+
+    try:
+        future = inference_executor.submit(job)
+    except RuntimeError:
+        # Executor shut down
+        with _stats_lock:
+            STATS["local_pending"] -= 1
+        raise
+    future.add_done_callback(release)
+    return future
+
+
+async def run_inference(fn, *args, **kwargs):
+    """
+    Await a blocking model call on the inference executor (submit_inference).
+    Cancelling the caller drops a call that has not started yet.
+    """
+    return await asyncio.wrap_future(submit_inference(fn, *args, **kwargs))
+
+
+def _generate_local_sync(model, tokenizer, prompt, gen_args, stop=(), cancel=None):
+    import torch
+
+    if cancel is not None and cancel.cancelled:
+        return ""
+
+    inputs = encode_inputs(tokenizer, prompt, model.device)
+    prompt_len = inputs["input_ids"].shape[-1]
+    with torch.no_grad():
+        outputs = model.generate(
+            **inputs, stopping_criteria=stopping_criteria(tokenizer, [stop], prompt_len, [cancel]), **gen_args
+        )
+    new_tokens = outputs[0][prompt_len:]
+    return finish_local(tokenizer.decode(new_tokens, skip_special_tokens=True), stop, len(new_tokens), gen_args)
+
+
+async def generate_local(model, tokenizer, prompt, gen_args, prefix=None, stop=(), cancel=None):
+    """
+    `prompt` is text or token ids (prompt_tokens.build_prompt); `prefix` is
+    the persona header of the prompt, used by the KV prefix cache. The reply
+    ends at the first of the `stop` strings, or early once `cancel` (a
+    cancellation.CancelToken) is cancelled.
+    """
+    if BATCHING_ENABLED:
+        from batching import get_scheduler
+        return await get_scheduler(model, tokenizer).submit(prompt, gen_args, prefix, stop, cancel)
+    if prefix_cache.enabled:
+        return await run_inference(
+            generate_with_prefix_cache, model, tokenizer, prompt, gen_args, prefix, stop=stop, cancel=cancel
+        )
+    return await run_inference(_generate_local_sync, model, tokenizer, prompt, gen_args, stop, cancel)
+
+
+def _remote_params(gen_args, stop):
+    # Only the continuation, not prompt + continuation
+    params = {"return_full_text": False, **gen_args}
+    if stop:
+        params["stop"] = list(stop)
+    return params
+
+
+async def generate_remote(url, token, prompt, gen_args, stop=()):
+    """
+    Call a hosted text-generation endpoint through the shared client.
+    Raises httpx.HTTPStatusError on non-2xx answers (e.g. 429).
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    payload = {"inputs": prompt, "parameters": _remote_params(gen_args, stop)}
+    STATS["remote_in_flight"] += 1
+    STATS["remote_peak_concurrency"] = max(STATS["remote_peak_concurrency"], STATS["remote_in_flight"])
+    started = time.perf_counter()
+    try:
+        resp = await get_client().post(url, headers=headers, json=payload)
+        resp.raise_for_status()
+        STATS["remote_completed"] += 1
+    except Exception:
+        STATS["remote_failed"] += 1
+        raise
+    finally:
+        STATS["remote_in_flight"] -= 1
+        STATS["remote_seconds"] += time.perf_counter() - started
+    return finish_remote(resp.json()[0]["generated_text"], stop, gen_args)
+
+
+async def generate_reply(model_obj, tokenizer_or_token, prompt, gen_args, prefix=None, stop=(), cancel=None):
+    """
+    Dispatch to the remote or local backend, depending on what get_model returned.
+    With a `cancel` token the call is abandoned (TurnCancelled) once it is
+    cancelled: remote requests are aborted, local generation stops at the next token.
+    """
+    if isinstance(model_obj, str):
+        call = generate_remote(model_obj, tokenizer_or_token, prompt, gen_args, stop)
+    else:
+        call = generate_local(model_obj, tokenizer_or_token, prompt, gen_args, prefix, stop, cancel)
+    if cancel is None:
+        return await call
+    return await cancel.run(call)
+
+
+async def stream_local(model, tokenizer, prompt, gen_args, stop=(), cancel=None):
+    """
+    Yield decoded text chunks as a local model produces them.
+    generate() runs on the inference executor and feeds a TextIteratorStreamer.
+    """
+    import torch
+    from transformers import TextIteratorStreamer
+
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    inputs = encode_inputs(tokenizer, prompt, model.device)
+    criteria = stopping_criteria(tokenizer, [stop], inputs["input_ids"].shape[-1], [cancel])
+
+    def job():
+        with torch.no_grad():
+            model.generate(**inputs, **gen_args, streamer=streamer, stopping_criteria=criteria)
+
+    def unblock_reader(t):
+        # generate() never started or blew up, so the streamer will not end itself
+        if t.cancelled() or t.exception() is not None:
+            streamer.end()
+
+    task = asyncio.ensure_future(run_inference(job))
+    task.add_done_callback(unblock_reader)
+
+    loop = asyncio.get_running_loop()
+    chunks = iter(streamer)
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        if chunk:
+            yield chunk
+    await task
+
+
+async def stream_remote(url, token, prompt, gen_args, stop=()):
+    """
+    Yield token texts from a hosted endpoint that supports `"stream": true`
+    (server-sent `data:` lines, one token each).
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    payload = {"inputs": prompt, "parameters": _remote_params(gen_args, stop), "stream": True}
+    STATS["remote_in_flight"] += 1
+    STATS["remote_peak_concurrency"] = max(STATS["remote_peak_concurrency"], STATS["remote_in_flight"])
+    started = time.perf_counter()
+    try:
+        async with get_client().stream("POST", url, headers=headers, json=payload) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:"):])
+                token_info = event.get("token") or {}
+                if token_info.get("special"):
+                    continue
+                if token_info.get("text"):
+                    yield token_info["text"]
+        STATS["remote_completed"] += 1
+    except Exception:
+        STATS["remote_failed"] += 1
+        raise
+    finally:
+        STATS["remote_in_flight"] -= 1
+        STATS["remote_seconds"] += time.perf_counter() - started
+
+
+async def stream_reply(model_obj, tokenizer_or_token, prompt, gen_args, stop=(), cancel=None):
+    """
+    Streaming counterpart of generate_reply: an async iterator of text chunks,
+    ending before the first of the `stop` strings. Raises TurnCancelled once
+    `cancel` is cancelled.
+    """
+    if isinstance(model_obj, str):
+        kind, chunks = "remote", stream_remote(model_obj, tokenizer_or_token, prompt, gen_args, stop)
+    else:
+        kind, chunks = "local", stream_local(model_obj, tokenizer_or_token, prompt, gen_args, stop, cancel)
+    trimmer = StreamTrimmer(stop)
+    try:
+        async for chunk in chunks:
+            if cancel is not None:
+                cancel.check()
+            text = trimmer.feed(chunk)
+            if text:
+                yield text
+            if trimmer.stopped:
+                break
+    finally:
+        # Closes the remote stream, so the server stops generating too
+        await chunks.aclose()
+    text = trimmer.flush()
+    if text:
+        yield text
+    if trimmer.stopped:
+        record_stop(kind, gen_args, chars=trimmer.seen)
+
+
+def inference_stats():
+    stats = dict(STATS)
+    done = stats["local_completed"] or 1
+    stats["local_avg_wait_seconds"] = stats["local_wait_seconds"] / done
+    stats["local_avg_run_seconds"] = stats["local_run_seconds"] / done
+    stats["remote_avg_seconds"] = stats["remote_seconds"] / (stats["remote_completed"] or 1)
+    stats["workers"] = INFERENCE_WORKERS
+    stats["queue_limit"] = INFERENCE_QUEUE_LIMIT
+    stats["prefix_cache"] = prefix_cache.report()
+    return stats
@@ -1,12 +1,155 @@
 # lora_utils.py
 
-from peft import PeftModel
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+ADAPTER_BASE_DIR = "adapters"
+# LoRA adapters kept loaded per base model
+ADAPTER_POOL_SIZE = int(os.getenv("ADAPTER_POOL_SIZE", "16"))
+# How long a missing adapter is remembered as missing (it may be trained meanwhile)
+ADAPTER_RECHECK_SECONDS = float(os.getenv("ADAPTER_RECHECK_SECONDS", "60"))
+
 
 def load_lora_adapter(model, adapter_path):
     if not adapter_path:
         return model
+    from peft import PeftModel
     try:
         return PeftModel.from_pretrained(model, adapter_path)
     except Exception as e:
         print(f"[WARN] Failed to load LoRA adapter from {adapter_path}: {e}")
         return model
+
+
+def resolve_adapter_path(adapter_path):
+    """
+    Personas name adapters relative to adapters/ (where train_lora_adapters.py
+    saves them), e.g. "luna_lora" -> "adapters/luna_lora".
+    """
+    if not adapter_path:
+        return None
+    for candidate in (adapter_path, os.path.join(ADAPTER_BASE_DIR, adapter_path)):
+        if os.path.isdir(candidate):
+            return candidate
+    return None
+
+
+class AdapterManager:
+    """
+    Many LoRA adapters over one base model.
+
+    Adapters are loaded once (the first one wraps the base model in a
+    PeftModel, the rest are added with load_adapter), at most `max_resident`
+    stay loaded (LRU), and a request only switches the active adapter with
+    set_adapter. Requests without an adapter run with adapters disabled.
+    The lock is held for the whole generate() so the active adapter cannot
+    change under a running request.
+    """
+
+    def __init__(self, base_model, max_resident=ADAPTER_POOL_SIZE):
+        self.base_model = base_model
+        self.model = base_model
+        self.max_resident = max_resident
+        self.resident = OrderedDict()  # adapter name -> path
+        self.active = None
+        self.lock = threading.RLock()
+        self._bindings = {}
+        self._paths = {}  # persona adapter_path -> (resolved path or None, when resolved)
+        self.stats = {"loads": 0, "evictions": 0, "switches": 0, "failed": 0}
+
+    def binding(self, adapter_path=None):
+        """
+        A model-like handle that generates with `adapter_path` active. The same
+        handle is returned for the same adapter, so batching and the prefix
+        cache see one stable model per (base model, adapter). Called on the
+        event loop, so adapter paths are resolved once, not per request.
+        """
+        path = self._resolve(adapter_path) if adapter_path else None
+        name = re.sub(r"\W", "_", path) if path else None
+        if name not in self._bindings:
+            self._bindings[name] = AdapterBinding(self, name, path)
+        return self._bindings[name]
+
+    def _resolve(self, adapter_path):
+        now = time.monotonic()
+        cached = self._paths.get(adapter_path)
+        if cached is not None and (cached[0] is not None or now - cached[1] < ADAPTER_RECHECK_SECONDS):
+            return cached[0]
+        path = resolve_adapter_path(adapter_path)
+        if path is None:
+            print(f"[WARN] LoRA adapter '{adapter_path}' not found, using the base model")
+        self._paths[adapter_path] = (path, now)
+        return path
+
+    def _ensure_loaded(self, name, path):
+        from peft import PeftModel
+
+        if name in self.resident:
+            self.resident.move_to_end(name)
+            return True
+        try:
+            if isinstance(self.model, PeftModel):
+                self.model.load_adapter(path, adapter_name=name)
+            else:
+                self.model = PeftModel.from_pretrained(self.base_model, path, adapter_name=name)
+        except Exception as e:
+            self.stats["failed"] += 1
+            print(f"[WARN] Failed to load LoRA adapter from {path}: {e}")
+            return False
+        self.resident[name] = path
+        self.stats["loads"] += 1
+        while len(self.resident) > self.max_resident:
+            evicted, _ = self.resident.popitem(last=False)
+            self.model.delete_adapter(evicted)
+            if self.active == evicted:
+                self.active = None
+            self.stats["evictions"] += 1
+        return True
+
+    @contextmanager
+    def use(self, name, path):
+        from peft import PeftModel
+
+        with self.lock:
+            if name is not None and self._ensure_loaded(name, path):
+                if self.active != name:
+                    self.model.set_adapter(name)
+                    self.active = name
+                    self.stats["switches"] += 1
+                yield self.model
+            elif isinstance(self.model, PeftModel):
+                with self.model.disable_adapter():
+                    yield self.model
+            else:
+                yield self.model
+
+    def report(self):
+        return dict(self.stats, resident=list(self.resident), active=self.active)
+
+
+class AdapterBinding:
+    def __init__(self, manager, name, path):
+        self.manager = manager
+        self.adapter_name = name
+        self.adapter_path = path
+
+    @property
+    def device(self):
+        return self.manager.base_model.device
+
+    def generate(self, *args, **kwargs):
+        with self.manager.use(self.adapter_name, self.adapter_path) as model:
+            return model.generate(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        with self.manager.use(self.adapter_name, self.adapter_path) as model:
+            return model(*args, **kwargs)
+
+    def __getattr__(self, item):
+        if item == "manager":
+            raise AttributeError(item)
+        return getattr(self.manager.base_model, item)
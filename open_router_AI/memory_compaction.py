@@ -0,0 +1,192 @@
+# memory_compaction.py
+#
+# Keeps every (character, user) memory partition small and useful.
+#
+# Without this each turn adds one document forever. Compacting a partition:
+#
+# 1. drops memories older than MEMORY_TTL_DAYS (0 disables the TTL),
+# 2. drops near-duplicates (cosine >= MEMORY_DEDUPE_SIMILARITY), keeping the newest,
+# 3. if the partition is still over MEMORY_PARTITION_CAP, merges its oldest turns
+#    into summary chunks of MEMORY_CHUNK_TURNS turns each, and finally drops the
+#    oldest documents that still do not fit.
+#
+# The work queue runs it for a partition every COMPACT_EVERY turns of a chat;
+# `python memory_compaction.py` compacts every partition and prints the report.
+
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+from summarizer import fold
+from vector_memory import embed_many, list_partitions, open_partition, partition_name
+import work_queue
+
+MEMORY_TTL_DAYS = float(os.getenv("MEMORY_TTL_DAYS", "0"))
+MEMORY_DEDUPE_SIMILARITY = float(os.getenv("MEMORY_DEDUPE_SIMILARITY", "0.95"))
+MEMORY_PARTITION_CAP = int(os.getenv("MEMORY_PARTITION_CAP", "500"))
+MEMORY_CHUNK_TURNS = max(2, int(os.getenv("MEMORY_CHUNK_TURNS", "10")))
+COMPACT_EVERY = int(os.getenv("COMPACT_EVERY", "50"))
+
+STATS = {"runs": 0, "partitions": 0, "expired": 0, "duplicates": 0, "merged": 0, "capped": 0, "seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def _size(documents, embeddings):
+    text_bytes = sum(len(d.encode("utf-8")) for d in documents if d)
+    vector_bytes = sum(e.nbytes for e in embeddings)
+    return {"docs": len(documents), "bytes": text_bytes + vector_bytes}
+
+
+def _split_turn(document):
+    user, _, assistant = document.partition("\nAssistant: ")
+    return {"user": user.removeprefix("User: "), "assistant": assistant}
+
+
+def _near_duplicates(order, vectors, threshold):
+    """
+    Indices (into `order`, newest first) of documents too similar to a newer
+    one that is kept.
+    """
+    kept = np.empty((len(order), vectors.shape[1]), dtype=np.float32)
+    n_kept = 0
+    dropped = set()
+    for i in order:
+        if n_kept and float((kept[:n_kept] @ vectors[i]).max()) >= threshold:
+            dropped.add(i)
+            continue
+        kept[n_kept] = vectors[i]
+        n_kept += 1
+    return dropped
+
+
+def compact_partition(partition, cap=MEMORY_PARTITION_CAP, ttl_days=MEMORY_TTL_DAYS,
+                      similarity=MEMORY_DEDUPE_SIMILARITY, chunk_turns=MEMORY_CHUNK_TURNS):
+    """
+    Compact one partition in place and return its report.
+    """
+    data = partition.get(include=["documents", "embeddings", "metadatas"])
+    ids, documents = data["ids"], data["documents"]
+    metadatas = [m or {} for m in data["metadatas"]]
+    embeddings = [np.asarray(e, dtype=np.float32) for e in data["embeddings"]]
+    report = {"before": _size(documents, embeddings), "expired": 0, "duplicates": 0, "merged": 0, "capped": 0}
+    if not ids:
+        report["after"] = report["before"]
+        return report
+
+    vectors = np.stack(embeddings)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+    # Memories stored before timestamps existed count as the oldest
+    ts = [float(m.get("ts") or 0) for m in metadatas]
+    newest_first = sorted(range(len(ids)), key=lambda i: ts[i], reverse=True)
+
+    drop = set()
+    if ttl_days > 0:
+        cutoff = time.time() - ttl_days * 86400
+        drop |= {i for i in range(len(ids)) if ts[i] and ts[i] < cutoff}
+        report["expired"] = len(drop)
+
+    alive = [i for i in newest_first if i not in drop]
+    duplicates = _near_duplicates(alive, vectors, similarity)
+    drop |= duplicates
+    report["duplicates"] = len(duplicates)
+    alive = [i for i in alive if i not in duplicates]
+
+    new_docs = []
+    excess = len(alive) - cap
+    if excess > 0:
+        turns = [i for i in reversed(alive) if metadatas[i].get("kind") != "summary"]  # oldest first
+        # each chunk of k turns becomes one document, saving k - 1
+        n_chunks = math.ceil(excess / (chunk_turns - 1))
+        merge = turns[:n_chunks * chunk_turns]
+        for start in range(0, len(merge), chunk_turns):
+            chunk = merge[start:start + chunk_turns]
+            if len(chunk) < 2:
+                continue
+            summary = fold(None, [_split_turn(documents[i]) for i in chunk])
+            meta = dict(metadatas[chunk[0]], kind="summary", ts=max(ts[i] for i in chunk) or time.time(), turns=len(chunk))
+            new_docs.append((f"sum-{ids[chunk[0]]}", f"Earlier conversation: {summary}", meta))
+            drop |= set(chunk)
+            report["merged"] += len(chunk)
+        alive = [i for i in alive if i not in drop]
+        overflow = len(alive) + len(new_docs) - cap
+        if overflow > 0:
+            oldest = alive[::-1][:overflow]
+            drop |= set(oldest)
+            report["capped"] = len(oldest)
+
+    if new_docs:
+        new_vectors = embed_many([text for _, text, _ in new_docs])
+        partition.upsert(
+            ids=[doc_id for doc_id, _, _ in new_docs],
+            documents=[text for _, text, _ in new_docs],
+            embeddings=[v.tolist() for v in new_vectors],
+            metadatas=[meta for _, _, meta in new_docs]
+        )
+    if drop:
+        partition.delete(ids=[ids[i] for i in sorted(drop)])
+
+    after = partition.get(include=["documents", "embeddings"])
+    report["after"] = _size(after["documents"], [np.asarray(e, dtype=np.float32) for e in after["embeddings"]])
+    return report
+
+
+def _record(report, seconds):
+    with _stats_lock:
+        STATS["partitions"] += 1
+        STATS["seconds"] += seconds
+        for key in ("expired", "duplicates", "merged", "capped"):
+            STATS[key] += report[key]
+
+
+def compact(names):
+    reports = {}
+    for name in names:
+        partition = open_partition(name)
+        if partition is None:
+            continue
+        started = time.perf_counter()
+        reports[name] = compact_partition(partition)
+        _record(reports[name], time.perf_counter() - started)
+    with _stats_lock:
+        STATS["runs"] += 1
+    return reports
+
+
+def compact_all():
+    return compact(list_partitions())
+
+
+def compact_batch(payloads):
+    compact(dict.fromkeys(partition_name(p["character"], p["user"]) for p in payloads))
+
+
+def enqueue_compaction(character, user):
+    """
+    Blocking (one DB insert), coalesced per partition.
+    """
+    name = partition_name(character, user)
+    work_queue.enqueue("compact_memory", {"character": character, "user": user}, coalesce_key=name)
+
+
+def compaction_stats():
+    with _stats_lock:
+        return dict(STATS)
+
+
+work_queue.register("compact_memory", compact_batch)
+
+
+if __name__ == "__main__":
+    reports = compact_all()
+    before = sum(r["before"]["docs"] for r in reports.values())
+    after = sum(r["after"]["docs"] for r in reports.values())
+    for name, r in reports.items():
+        print(
+            f"{name}: {r['before']['docs']} -> {r['after']['docs']} docs, "
+            f"{r['before']['bytes']} -> {r['after']['bytes']} bytes "
+            f"(expired {r['expired']}, duplicates {r['duplicates']}, merged {r['merged']}, capped {r['capped']})"
+        )
+    print(f"[COMPACT] {len(reports)} partitions, {before} -> {after} docs")
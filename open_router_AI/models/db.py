@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Text, DateTime
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Text, DateTime, Index, LargeBinary, inspect, text
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
 from datetime import datetime
 import os
@@ -17,6 +17,10 @@ class Chat(Base):
     session_id = Column(String, index=True)
     character = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Rolling summary of every message with id <= summary_upto
+    summary = Column(Text, nullable=True)
+    summary_upto = Column(Integer, default=0)
+    turns = Column(Integer, default=0)
     messages = relationship("Message", back_populates="chat")
 
 class Message(Base):
@@ -26,8 +30,138 @@ class Message(Base):
     sender = Column(String)
     content = Column(Text)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    # Cached length of content, counted with the tokenizer named in token_counter
+    token_count = Column(Integer)
+    token_counter = Column(String)
 
     chat = relationship("Chat", back_populates="messages")
 
+    __table_args__ = (Index("ix_messages_chat_id_id", "chat_id", "id"),)
+
+class Job(Base):
+    """
+    Durable background work (see work_queue.py).
+    """
+    __tablename__ = "jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, index=True)
+    # Pending jobs with the same kind + coalesce_key are merged into one
+    coalesce_key = Column(String, index=True, nullable=True)
+    payload = Column(Text)
+    status = Column(String, index=True, default="pending")
+    attempts = Column(Integer, default=0)
+    error = Column(Text, nullable=True)
+    # When the running job was claimed; the claim lapses after WORK_LEASE_SECONDS
+    claimed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class CharacterMemory(Base):
+    """
+    Facts and reflections a character keeps across all chats (see character_memory.py).
+    """
+    __tablename__ = "character_memories"
+    id = Column(Integer, primary_key=True, index=True)
+    character = Column(String, index=True)
+    text = Column(Text)
+    # sha1 of the normalized text, for exact dedupe
+    digest = Column(String)
+    source = Column(String)  # "reflection" or "info"
+    embedding = Column(LargeBinary, nullable=True)  # float32 bytes
+    hits = Column(Integer, default=1)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (Index("ix_character_memories_character_digest", "character", "digest", unique=True),)
+
+# Columns added after the first release; create_all() does not touch existing tables.
+# (table, column, DDL type, backfill statement or None)
+_LATE_COLUMNS = [
+    ("chats", "summary", "TEXT", None),
+    ("chats", "summary_upto", "INTEGER DEFAULT 0", None),
+    ("chats", "turns", "INTEGER DEFAULT 0",
+     "UPDATE chats SET turns = (SELECT COUNT(*) FROM messages "
+     "WHERE messages.chat_id = chats.id AND messages.sender = 'user')"),
+    ("messages", "token_count", "INTEGER", None),
+    ("messages", "token_counter", "VARCHAR", None),
+    ("jobs", "claimed_at", "DATETIME", None),
+]
+
+def _add_late_columns():
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    with engine.begin() as conn:
+        for table, column, ddl, backfill in _LATE_COLUMNS:
+            if table not in tables:
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            if column in existing:
+                continue
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            if backfill:
+                conn.execute(text(backfill))
+
+# Indexes added after the first release, same reason: (name, table, columns)
+_LATE_INDEXES = [
+    ("ix_messages_chat_id_id", "messages", "chat_id, id"),
+]
+
+def _add_late_indexes():
+    tables = inspect(engine).get_table_names()
+    with engine.begin() as conn:
+        for name, table, columns in _LATE_INDEXES:
+            if table in tables:
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    _add_late_columns()
+    _add_late_indexes()
+
+def recent_messages(db, chat_id, limit):
+    """
+    The last `limit` messages of a chat, oldest first (one indexed LIMIT query).
+    """
+    rows = (
+        db.query(Message)
+        .filter(Message.chat_id == chat_id)
+        .order_by(Message.id.desc())
+        .limit(limit)
+        .all()
+    )
+    rows.reverse()
+    return rows
+
+def messages_between(db, chat_id, after_id, before_id, limit=None):
+    """
+    Messages with after_id < id < before_id, oldest first. With a limit only the
+    newest `limit` of them are returned.
+    """
+    query = (
+        db.query(Message)
+        .filter(Message.chat_id == chat_id, Message.id > after_id, Message.id < before_id)
+        .order_by(Message.id.desc())
+    )
+    if limit:
+        query = query.limit(limit)
+    rows = query.all()
+    rows.reverse()
+    return rows
+
+def to_turns(rows):
+    """
+    Turn Message rows into [{"user", "assistant", "tokens"}] pairs, skipping a
+    leading assistant message whose user half is outside the rows. "tokens" is
+    the cached token count of both messages, or None if either is not counted.
+    """
+    turns = []
+    for m in rows:
+        if m.sender == "user":
+            turns.append({"user": m.content, "assistant": "", "tokens": m.token_count})
+        elif turns:
+            turns[-1]["assistant"] = m.content
+            if turns[-1]["tokens"] is not None and m.token_count is not None:
+                turns[-1]["tokens"] += m.token_count
+            else:
+                turns[-1]["tokens"] = None
+    return turns
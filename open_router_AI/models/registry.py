@@ -1,11 +1,8 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
 import os
-import torch
-from lora_utils import load_lora_adapter
+from lora_utils import AdapterManager
 from dotenv import load_dotenv
 load_dotenv()
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
 
 HF_API_TOKEN = os.getenv("HF_API_TOKEN")
 HF_MODEL_URL = os.getenv("HF_MODEL_URL", "https://api-inference.huggingface.co/models/nousresearch/hermes-3-llama-3.1-8b")
@@ -14,15 +11,26 @@ MODEL_REGISTRY = {
     "mistral-7b-instruct": {
         "name": "TheBloke/Mistral-7B-Instruct-v0.1-GPTQ",
         "model": None,
-        "tokenizer": None
+        "tokenizer": None,
+        # batching scheduler (batching.py)
+        "max_batch_size": 8,
+        "batch_wait_ms": 10,
+        # prompt + reply token budget (context_packer.py)
+        "context_window": 8192
     },
      "hermes": {
         "type": "remote",
         "url": HF_MODEL_URL,
-        "token": HF_API_TOKEN
+        "token": HF_API_TOKEN,
+        "context_window": 8192
     }
 }
 def load_models():
+    # heavy imports stay out of app startup; this runs in the background warm-up
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
     for key, config in MODEL_REGISTRY.items():
         if config.get("type") != "local":
             continue
@@ -51,6 +59,14 @@ def load_models():
 
 
 
+# model key -> AdapterManager, created the first time a persona asks for an adapter
+ADAPTER_MANAGERS = {}
+
+
+class ModelNotReady(Exception):
+    """Raised for a local model the background warm-up has not loaded (yet)."""
+
+
 def get_model(model_key: str, adapter_path: str = None):
     config = MODEL_REGISTRY.get(model_key)
     if not config:
@@ -59,11 +75,22 @@ def get_model(model_key: str, adapter_path: str = None):
     if config["type"] == "local":
         model = config["model"]
         tokenizer = config["tokenizer"]
-        model = load_lora_adapter(model, adapter_path)
-        return model.to(device), tokenizer
+        if model is None or tokenizer is None:
+            # No AdapterManager either: one built around None would stick for good
+            raise ModelNotReady(f"Model '{model_key}' is not loaded yet, try again shortly")
+        manager = ADAPTER_MANAGERS.get(model_key)
+        if adapter_path and manager is None:
+            manager = ADAPTER_MANAGERS[model_key] = AdapterManager(model)
+        if manager is not None:
+            # once adapters are injected, plain requests must run with them disabled
+            return manager.binding(adapter_path), tokenizer
+        return model, tokenizer
 
     elif config["type"] == "remote":
         return config["url"], config["token"]
 
     raise ValueError(f"Unsupported model type '{config['type']}'")
 
+
+def adapter_stats():
+    return {key: manager.report() for key, manager in ADAPTER_MANAGERS.items()}
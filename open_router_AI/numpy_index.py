@@ -0,0 +1,227 @@
+# numpy_index.py
+#
+# Small, dependency-free vector store for per-(character, user) memory.
+#
+# Each partition is one contiguous float16 (or int8) matrix memory-mapped from
+# <root>/<partition>.vec, one row per memory; the texts, ids and metadata live
+# in <root>/index.db (SQLite). Queries are a single matrix-vector product over
+# the partition followed by argpartition, which for a few thousand rows is
+# faster than an ANN index and needs no server, no background threads and no
+# startup time: opening a partition is an mmap.
+#
+# Partitions expose the subset of the chroma Collection API that
+# vector_memory.py uses (upsert / query / get / delete / count), so either
+# backend can sit behind get_partition().
+
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+# Rows are stored as unit vectors; int8 scales them to [-127, 127]
+DTYPES = {"float16": (np.float16, 1.0), "int8": (np.int8, 127.0)}
+INITIAL_CAPACITY = 256
+
+
+class NumpyPartition:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.path = os.path.join(store.root, f"{name}.vec")
+        self._matrix = None
+        self._capacity = 0
+
+    # -- storage helpers (caller holds store.lock) --------------------------
+
+    def _info(self):
+        row = self.store.db.execute(
+            "SELECT rows, capacity, dim FROM partitions WHERE name = ?", (self.name,)
+        ).fetchone()
+        return row if row else (0, 0, None)
+
+    def _map(self, capacity, dim):
+        if self._matrix is not None and self._capacity == capacity:
+            return self._matrix
+        self._matrix = None
+        if capacity == 0:
+            return None
+        dtype = self.store.dtype
+        nbytes = capacity * dim * np.dtype(dtype).itemsize
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < nbytes:
+            with open(self.path, "ab") as f:
+                f.truncate(nbytes)
+        self._matrix = np.memmap(self.path, dtype=dtype, mode="r+", shape=(capacity, dim))
+        self._capacity = capacity
+        return self._matrix
+
+    def _encode(self, embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+        dtype, scale = DTYPES[self.store.dtype_name]
+        if scale != 1.0:
+            return np.rint(vectors * scale).astype(dtype)
+        return vectors.astype(dtype)
+
+    # -- collection API ------------------------------------------------------
+
+    def count(self):
+        with self.store.lock:
+            return self._info()[0]
+
+    def upsert(self, ids, embeddings, documents, metadatas=None):
+        metadatas = metadatas or [None] * len(ids)
+        vectors = self._encode(embeddings)
+        db = self.store.db
+        with self.store.lock:
+            rows, capacity, dim = self._info()
+            dim = dim or vectors.shape[1]
+            existing = dict(db.execute(
+                f"SELECT id, row FROM docs WHERE partition = ? AND id IN ({','.join('?' * len(ids))})",
+                (self.name, *ids)
+            ).fetchall())
+            new = sum(1 for doc_id in dict.fromkeys(ids) if doc_id not in existing)
+            if rows + new > capacity:
+                capacity = max(INITIAL_CAPACITY, capacity)
+                while capacity < rows + new:
+                    capacity *= 2
+            matrix = self._map(capacity, dim)
+            for doc_id, vector, document, metadata in zip(ids, vectors, documents, metadatas):
+                row = existing.get(doc_id)
+                if row is None:
+                    row = existing[doc_id] = rows
+                    rows += 1
+                matrix[row] = vector
+                db.execute(
+                    "INSERT OR REPLACE INTO docs (partition, id, row, document, metadata) VALUES (?, ?, ?, ?, ?)",
+                    (self.name, doc_id, row, document, json.dumps(metadata) if metadata else None)
+                )
+            matrix.flush()
+            db.execute(
+                "INSERT OR REPLACE INTO partitions (name, rows, capacity, dim) VALUES (?, ?, ?, ?)",
+                (self.name, rows, capacity, dim)
+            )
+            db.commit()
+
+    def query(self, query_embeddings, n_results=3, include=None):
+        """
+        Brute-force cosine top-k. Returns chroma-shaped {"ids", "documents",
+        "distances"} (lists of lists, one per query).
+        """
+        with self.store.lock:
+            rows, capacity, dim = self._info()
+            if not rows:
+                return {"ids": [[]], "documents": [[]], "distances": [[]]}
+            matrix = self._map(capacity, dim)
+            queries = self._encode(query_embeddings).astype(np.float32)
+            scores = (np.asarray(matrix[:rows], dtype=np.float32) @ queries.T).T
+            scores /= DTYPES[self.store.dtype_name][1] ** 2
+            out = {"ids": [], "documents": [], "distances": []}
+            k = min(n_results, rows)
+            for row_scores in scores:
+                top = np.argpartition(-row_scores, k - 1)[:k]
+                top = top[np.argsort(-row_scores[top])]
+                docs = self._rows_to_docs([int(r) for r in top])
+                out["ids"].append([d[0] for d in docs])
+                out["documents"].append([d[1] for d in docs])
+                out["distances"].append([float(1 - row_scores[r]) for r in top])
+            return out
+
+    def _rows_to_docs(self, rows):
+        found = {
+            row: (doc_id, document)
+            for row, doc_id, document in self.store.db.execute(
+                f"SELECT row, id, document FROM docs WHERE partition = ? AND row IN ({','.join('?' * len(rows))})",
+                (self.name, *rows)
+            )
+        }
+        return [found[r] for r in rows]
+
+    def get(self, ids=None, include=("documents", "metadatas"), limit=None, offset=0):
+        with self.store.lock:
+            rows, capacity, dim = self._info()
+            sql = "SELECT id, row, document, metadata FROM docs WHERE partition = ?"
+            params = [self.name]
+            if ids is not None:
+                sql += f" AND id IN ({','.join('?' * len(ids))})"
+                params += list(ids)
+            sql += " ORDER BY row"
+            if limit is not None:
+                sql += " LIMIT ? OFFSET ?"
+                params += [limit, offset]
+            found = self.store.db.execute(sql, params).fetchall()
+            out = {"ids": [r[0] for r in found]}
+            if "documents" in include:
+                out["documents"] = [r[2] for r in found]
+            if "metadatas" in include:
+                out["metadatas"] = [json.loads(r[3]) if r[3] else None for r in found]
+            if "embeddings" in include:
+                matrix = self._map(capacity, dim)
+                scale = DTYPES[self.store.dtype_name][1]
+                out["embeddings"] = [np.asarray(matrix[r[1]], dtype=np.float32) / scale for r in found]
+            return out
+
+    def delete(self, ids):
+        """
+        Remove documents; the last row is moved into each freed slot so the
+        matrix stays contiguous.
+        """
+        db = self.store.db
+        with self.store.lock:
+            rows, capacity, dim = self._info()
+            if not rows:
+                return
+            matrix = self._map(capacity, dim)
+            for doc_id in ids:
+                hit = db.execute(
+                    "SELECT row FROM docs WHERE partition = ? AND id = ?", (self.name, doc_id)
+                ).fetchone()
+                if hit is None:
+                    continue
+                row, last = hit[0], rows - 1
+                db.execute("DELETE FROM docs WHERE partition = ? AND id = ?", (self.name, doc_id))
+                if row != last:
+                    matrix[row] = matrix[last]
+                    db.execute("UPDATE docs SET row = ? WHERE partition = ? AND row = ?", (row, self.name, last))
+                rows -= 1
+            matrix.flush()
+            db.execute("UPDATE partitions SET rows = ? WHERE name = ?", (rows, self.name))
+            db.commit()
+
+
+class NumpyVectorStore:
+    def __init__(self, root, dtype="float16"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported vector dtype {dtype!r}, expected one of {sorted(DTYPES)}")
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.dtype_name = dtype
+        self.dtype = DTYPES[dtype][0]
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(os.path.join(root, "index.db"), check_same_thread=False)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS partitions (
+                name TEXT PRIMARY KEY, rows INTEGER NOT NULL, capacity INTEGER NOT NULL, dim INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS docs (
+                partition TEXT NOT NULL, id TEXT NOT NULL, row INTEGER NOT NULL,
+                document TEXT, metadata TEXT, PRIMARY KEY (partition, id)
+            );
+            CREATE INDEX IF NOT EXISTS ix_docs_partition_row ON docs (partition, row);
+            """
+        )
+
+    def exists(self, name):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM partitions WHERE name = ?", (name,)).fetchone() is not None
+
+    def partition(self, name, create=True):
+        if not create and not self.exists(name):
+            return None
+        return NumpyPartition(self, name)
+
+    def partitions(self):
+        with self.lock:
+            return [r[0] for r in self.db.execute("SELECT name FROM partitions ORDER BY name")]
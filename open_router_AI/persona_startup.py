@@ -2,7 +2,6 @@
 
 import os
 import json
-from train_lora_adapters import train_lora_for_character
 
 # List of default personas to create on startup
 DEFAULT_PERSONAS = [
@@ -50,6 +49,11 @@ def create_persona(name, model, template="plain", adapter_path=None):
         json.dump(persona, f, indent=2)
 
 def autopopulate_defaults():
+    """
+    Write any missing default persona files. Cheap enough for app startup;
+    adapter training is a separate step (train_default_adapters, or
+    POST /train-adapters/{character}).
+    """
     for p in DEFAULT_PERSONAS:
         create_persona(
             name=p["name"],
@@ -57,10 +61,15 @@ def autopopulate_defaults():
             template=p["template"],
             adapter_path=p["adapter_path"]
         )
-        # if there's an adapter to train, kick off training
+
+def train_default_adapters():
+    from train_lora_adapters import train_lora_for_character
+
+    for p in DEFAULT_PERSONAS:
         if p.get("adapter_path"):
             persona_path = os.path.join("personas", f"{p['name']}.json")
             train_lora_for_character(persona_path)
 
 if __name__ == "__main__":
     autopopulate_defaults()
+    train_default_adapters()
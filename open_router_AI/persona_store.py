@@ -0,0 +1,108 @@
+# persona_store.py
+#
+# Cached access to the personas/ directory.
+#
+# The name index is rebuilt only when the directory mtime changes (a file was
+# added, removed or renamed) and each persona JSON is re-parsed only when its
+# own mtime changes, so looking up one character is a single stat() instead of
+# a glob plus a json.load of every persona.
+
+import copy
+import json
+import os
+import threading
+from pathlib import Path
+
+PERSONAS_DIR = os.getenv("PERSONAS_DIR", "personas")
+
+
+class PersonaStore:
+    def __init__(self, directory=PERSONAS_DIR):
+        self.directory = Path(directory)
+        self._lock = threading.RLock()
+        self._names = []
+        self._dir_mtime = None
+        self._cache = {}  # name -> (mtime_ns, persona dict)
+        self.stats = {"hits": 0, "loads": 0, "index_rebuilds": 0}
+
+    def _path(self, name):
+        return self.directory / f"{name}.json"
+
+    def _refresh_index(self):
+        try:
+            mtime = self.directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._names, self._dir_mtime = [], None
+            return
+        if mtime != self._dir_mtime:
+            self._names = sorted(p.stem for p in self.directory.glob("*.json"))
+            self._dir_mtime = mtime
+            self.stats["index_rebuilds"] += 1
+            # forget personas whose file is gone
+            for name in set(self._cache) - set(self._names):
+                del self._cache[name]
+
+    def names(self):
+        with self._lock:
+            self._refresh_index()
+            return list(self._names)
+
+    def count(self):
+        with self._lock:
+            self._refresh_index()
+            return len(self._names)
+
+    def exists(self, name):
+        return self._path(name).is_file()
+
+    def get(self, name):
+        """
+        Return a copy of the persona dict, or None if there is no such persona.
+        Callers are free to mutate the result and pass it back to save().
+        """
+        path = self._path(name)
+        with self._lock:
+            try:
+                mtime = path.stat().st_mtime_ns
+            except FileNotFoundError:
+                self._cache.pop(name, None)
+                return None
+            cached = self._cache.get(name)
+            if cached and cached[0] == mtime:
+                self.stats["hits"] += 1
+                return copy.deepcopy(cached[1])
+            with path.open(encoding="utf-8") as f:
+                data = json.load(f)
+            self._cache[name] = (mtime, data)
+            self.stats["loads"] += 1
+            return copy.deepcopy(data)
+
+    def page(self, offset=0, limit=50):
+        """
+        Return ([names], {name: persona}) for one page of the sorted catalog,
+        only reading the files on that page.
+        """
+        names = self.names()[offset:offset + limit]
+        data = {}
+        for name in names:
+            persona = self.get(name)
+            if persona is not None:
+                data[name] = persona
+        return names, data
+
+    def save(self, name, persona_data):
+        """
+        Write personas/{name}.json atomically and update the cache in place.
+        """
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self._path(name)
+            tmp = path.with_suffix(".json.tmp")
+            with tmp.open("w", encoding="utf-8") as f:
+                json.dump(persona_data, f, indent=2)
+            os.replace(tmp, path)
+            self._cache[name] = (path.stat().st_mtime_ns, copy.deepcopy(persona_data))
+            self._refresh_index()
+
+
+persona_store = PersonaStore()
@@ -0,0 +1,80 @@
+# post_processing.py
+#
+# Work done after a reply has been produced, run by the work_queue worker:
+#
+# - "store_memory": embed finished turns and add them to vector memory, in
+#   batches (one encode() and one insert for everything queued).
+# - "reflect": every few turns, let the model (local models only) reflect on
+#   the conversation and add the result to the character's memory
+#   (character_memory.py). Coalesced per persona, so a burst of turns produces
+#   one reflection.
+# - "compact_memory": every COMPACT_EVERY turns, compact the chat's memory
+#   partition (see memory_compaction.py).
+# - "summarize": fold turns that left the recent-history window into the
+#   chat's rolling summary (see summarizer.py).
+
+import character_memory
+from inference import submit_inference
+from memory_compaction import COMPACT_EVERY, enqueue_compaction
+from models.registry import get_model
+from persona_store import persona_store
+from summarizer import HISTORY_TURNS, enqueue_summary
+from utils import reflect_on_session
+from vector_memory import memory_id, store_messages
+import work_queue
+
+REFLECT_EVERY = 5
+
+
+def store_memory_batch(payloads):
+    store_messages([
+        (p["character"], p["user"], p["message"], p["reply"], p.get("doc_id")) for p in payloads
+    ])
+
+
+def reflect_batch(payloads):
+    for p in payloads:
+        persona = persona_store.get(p["character"])
+        if persona is None:
+            continue
+        model, tokenizer_or_token = get_model(p["model_key"], persona.get("adapter_path"))
+        # Same pool and queue limit as chat generation so reflections never
+        # oversubscribe the model (InferenceBusy fails the job, which is retried)
+        reflection = submit_inference(
+            reflect_on_session, model, tokenizer_or_token, persona, p["recent"]
+        ).result()
+        # None when the model cannot reflect (remote models); junk is rejected by add()
+        if reflection:
+            character_memory.add(p["character"], reflection)
+
+
+def enqueue_post_processing(turn, reply, message_id=None, user="demo"):
+    """
+    Queue everything that follows a finished turn. Blocking (one DB insert per
+    job), call through run_in_threadpool from async routes.
+    """
+    work_queue.enqueue("store_memory", {
+        "character": turn["character"],
+        "user": user,
+        "message": turn["message"],
+        "reply": reply,
+        "doc_id": memory_id(message_id) if message_id else None,
+    })
+    # Only local models can reflect (utils.reflect_on_session)
+    if turn["turns"] % REFLECT_EVERY == 0 and not isinstance(turn["model"], str):
+        recent = turn["recent"] + [{"user": turn["message"], "assistant": reply}]
+        work_queue.enqueue("reflect", {
+            "character": turn["character"],
+            "model_key": turn["model_key"],
+            "recent": recent[-6:],
+        }, coalesce_key=turn["character"])
+    # turns counts the turns before this one
+    if turn["turns"] + 1 > HISTORY_TURNS:
+        enqueue_summary(turn["chat_id"])
+    # After the COMPACT_EVERY-th turn, the 2x-th, ... (never on a new chat)
+    if COMPACT_EVERY and (turn["turns"] + 1) % COMPACT_EVERY == 0:
+        enqueue_compaction(turn["character"], user)
+
+
+work_queue.register("store_memory", store_memory_batch)
+work_queue.register("reflect", reflect_batch)
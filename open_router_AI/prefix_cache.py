@@ -0,0 +1,179 @@
+# prefix_cache.py
+#
+# Reuse of past-key-values across turns for local models.
+#
+# A chat prompt is mostly the same as the previous turn's prompt (persona,
+# memories, examples, earlier turns) and every session of a persona starts with
+# the same persona header. We keep the KV cache of recent prompts and of shared
+# persona prefixes, find the entry with the longest common token prefix for a
+# new prompt, crop it to that length and let generate() prefill only the rest.
+# Entries are evicted LRU once PREFIX_CACHE_MB is exceeded.
+
+import copy
+import os
+import threading
+from collections import OrderedDict
+
+from prompt_tokens import encode_inputs
+from stop_sequences import finish_local, stopping_criteria
+
+PREFIX_CACHE_MB = float(os.getenv("PREFIX_CACHE_MB", "512"))
+# Matches shorter than this are not worth a cache copy
+MIN_REUSE_TOKENS = int(os.getenv("PREFIX_CACHE_MIN_TOKENS", "16"))
+
+
+def _cache_tensors(past):
+    if hasattr(past, "layers"):
+        for layer in past.layers:
+            yield layer.keys
+            yield layer.values
+    elif hasattr(past, "key_cache"):
+        yield from past.key_cache
+        yield from past.value_cache
+
+
+def _nbytes(past):
+    return sum(t.numel() * t.element_size() for t in _cache_tensors(past) if t is not None)
+
+
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    same = a[:n] == b[:n]
+    if bool(same.all()):
+        return n
+    return int(same.int().argmin())
+
+
+class PrefixCache:
+    def __init__(self, budget_mb=PREFIX_CACHE_MB):
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.used = 0
+        self._entries = OrderedDict()  # key -> (namespace, token ids, past, nbytes)
+        self._lock = threading.Lock()
+        self.stats = {
+            "lookups": 0, "hits": 0, "reused_tokens": 0, "prefill_tokens": 0,
+            "stores": 0, "evictions": 0,
+        }
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    def lookup(self, namespace, ids):
+        """
+        Return (n, past) where past is a private copy of the cached KV for the
+        first n tokens of `ids`, or (0, None) when nothing useful is cached.
+        At least one token is always left for generate() to compute.
+        """
+        with self._lock:
+            self.stats["lookups"] += 1
+            best_key, best_len = None, 0
+            for key, (ns, cached_ids, _, _) in self._entries.items():
+                if ns != namespace:
+                    continue
+                n = min(_common_prefix(cached_ids, ids), len(ids) - 1)
+                if n > best_len:
+                    best_key, best_len = key, n
+            if best_key is None or best_len < MIN_REUSE_TOKENS:
+                return 0, None
+            self._entries.move_to_end(best_key)
+            past = copy.deepcopy(self._entries[best_key][2])
+        past.crop(best_len)
+        self.stats["hits"] += 1
+        self.stats["reused_tokens"] += best_len
+        return best_len, past
+
+    def store(self, namespace, ids, past):
+        nbytes = _nbytes(past)
+        if not self.enabled or nbytes > self.budget:
+            return
+        key = (namespace, ids.cpu().numpy().tobytes())
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.used -= old[3]
+            self._entries[key] = (namespace, ids, past, nbytes)
+            self.used += nbytes
+            self.stats["stores"] += 1
+            while self.used > self.budget and self._entries:
+                _, (_, _, _, freed) = self._entries.popitem(last=False)
+                self.used -= freed
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.used = 0
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        stats["used_mb"] = round(self.used / 1024 / 1024, 2)
+        stats["budget_mb"] = round(self.budget / 1024 / 1024, 2)
+        return stats
+
+
+prefix_cache = PrefixCache()
+
+
+def _prefill(model, ids):
+    """
+    Run the model over `ids` once and return the resulting KV cache.
+    """
+    import torch
+    from transformers import DynamicCache
+
+    with torch.no_grad():
+        out = model(input_ids=ids.unsqueeze(0), past_key_values=DynamicCache(), use_cache=True)
+    return out.past_key_values
+
+
+def generate_with_prefix_cache(model, tokenizer, prompt, gen_args, prefix=None, namespace=None, stop=(), cancel=None):
+    """
+    Blocking generate() for one prompt that reuses cached KV for its longest
+    known prefix. `prefix` is the persona header (the prompt rendered without
+    history or message); when nothing is cached yet its KV is computed and kept
+    so other sessions of the same persona can start from it. Both may be text
+    or token ids (prompt_tokens.build_prompt). Generation ends at the first of
+    the `stop` strings, or once `cancel` is cancelled.
+    """
+    import torch
+
+    if cancel is not None and cancel.cancelled:
+        return ""
+
+    namespace = (id(model), namespace)
+    input_ids = encode_inputs(tokenizer, prompt, model.device)["input_ids"]
+    ids = input_ids[0]
+
+    cached_len, past = prefix_cache.lookup(namespace, ids)
+    if past is None and prefix:
+        prefix_ids = encode_inputs(tokenizer, prefix, model.device)["input_ids"][0]
+        shared = min(_common_prefix(prefix_ids, ids), len(ids) - 1)
+        if shared >= MIN_REUSE_TOKENS:
+            prefix_cache.store(namespace, ids[:shared], _prefill(model, ids[:shared]))
+            cached_len, past = prefix_cache.lookup(namespace, ids)
+
+    prefix_cache.stats["prefill_tokens"] += len(ids) - cached_len
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past,
+            return_dict_in_generate=True,
+            stopping_criteria=stopping_criteria(tokenizer, [stop], ids.shape[-1], [cancel]),
+            **gen_args
+        )
+
+    # Keep this turn's KV so the next turn of the session only encodes its suffix
+    sequence = outputs.sequences[0]
+    session_past = outputs.past_key_values
+    if session_past is not None:
+        seq_len = session_past.get_seq_length()
+        prefix_cache.store(namespace, sequence[:seq_len], session_past)
+
+    new_tokens = sequence[ids.shape[-1]:]
+    return finish_local(tokenizer.decode(new_tokens, skip_special_tokens=True), stop, len(new_tokens), gen_args)
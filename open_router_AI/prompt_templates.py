@@ -1,130 +1,263 @@
+# prompt_templates.py
+#
+# Prompt templates as data.
+#
+# A template is a handful of format strings:
+#
+#   system   - the persona header, {persona}
+#   summary  - optional context line (rolling summary, memories), {summary}
+#   turn     - one past turn, {user} and {assistant}
+#   prompt   - the new message and the assistant cue, {message}
+#   join     - what goes between the pieces
+#   stop     - strings that start a turn the model must not write (the next
+#              user line etc.); generation ends there, see stop_sequences.py
+#
+# Each is compiled once into literal/field pieces and a prompt is rendered in
+# one pass, one string per segment (header, summary, each turn, new message),
+# joined at the end. The persona header of a (template, persona) pair is
+# rendered once and cached.
+#
+# Besides the built-ins below, every *.json file in CUSTOM_TEMPLATES_DIR
+# defines a template named after the file, e.g. custom_templates/mytpl.json:
+#
+#   {"system": "### System\n{persona}\n", "turn": "### User\n{user}\n### Bot\n{assistant}\n",
+#    "prompt": "### User\n{message}\n### Bot\n", "summary": "### Notes\n{summary}\n", "join": "",
+#    "stop": ["### User"]}
+#
+# Files are re-read when the directory changes. Unknown names fall back to "plain".
+
+import json
+import os
+import string
+import threading
+from collections import OrderedDict
+
+CUSTOM_TEMPLATES_DIR = os.getenv("CUSTOM_TEMPLATES_DIR", "custom_templates")
+DEFAULT_TEMPLATE = "plain"
+
+BUILTIN_TEMPLATES = {
+    # Persona, context and each turn exactly once
+    "plain": {
+        "system": "<|system|>{persona}",
+        "summary": "<|system|>Summary of previous discussion: {summary}",
+        "turn": "<|user|>{user}<|assistant|>{assistant}",
+        "prompt": "<|user|>{message}<|assistant|>",
+        "join": "",
+        "stop": ["<|user|>", "<|system|>"],
+    },
+    "hermes": {
+        "system": "{persona}\n",
+        "summary": "Summary of previous discussion: {summary}\n",
+        "turn": "User: {user}\nAssistant: {assistant}",
+        "prompt": "User: {message}\nAssistant:",
+        "join": "\n",
+        "stop": ["\nUser:", "\nSystem:"],
+    },
+    "llama2": {
+        "system": "<<SYS>>\n{persona}\n<</SYS>>\n",
+        "summary": "[INST] Summary of earlier chat: {summary} [/INST]\n",
+        "turn": "[INST] {user} [/INST] {assistant}",
+        "prompt": "[INST] {message} [/INST]",
+        "join": "\n",
+        "stop": ["[INST]", "<<SYS>>"],
+    },
+    "chatml": {
+        "system": "<|system|>\n{persona}\n",
+        "summary": "<|system|> Summary: {summary}\n",
+        "turn": "<|user|> {user}\n<|assistant|> {assistant}\n",
+        "prompt": "<|user|> {message}\n<|assistant|>",
+        "join": "",
+        "stop": ["<|user|>", "<|system|>"],
+    },
+    "alpaca": {
+        "system": "### Instruction:\n{persona}\n",
+        "summary": "\n### Note:\n{summary}\n",
+        "turn": "\n### User:\n{user}\n### Response:\n{assistant}\n",
+        "prompt": "\n### User:\n{message}\n### Response:\n",
+        "join": "",
+        "stop": ["\n### User:", "\n### Instruction:", "\n### Note:"],
+    },
+    "oasst": {
+        "system": "<|system|>{persona}<|end|>",
+        "summary": "<|system|>Summary: {summary}<|end|>",
+        "turn": "<|user|>{user}<|end|><|assistant|>{assistant}<|end|>",
+        "prompt": "<|user|>{message}<|end|><|assistant|>",
+        "join": "",
+        "stop": ["<|end|>", "<|user|>", "<|system|>"],
+    },
+    "zephyr": {
+        "system": "<|system|> {persona}\n",
+        "summary": "<|system|> Summary: {summary}\n",
+        "turn": "<|user|> {user}\n<|assistant|> {assistant}\n",
+        "prompt": "<|user|> {message}\n<|assistant|>",
+        "join": "",
+        "stop": ["<|user|>", "<|system|>"],
+    },
+    "deepseek": {
+        "system": "<|system|>\n{persona}\n",
+        "summary": "<|system|> Summary: {summary}\n",
+        "turn": "<|user|> {user}\n<|assistant|> {assistant}\n",
+        "prompt": "<|user|> {message}\n<|assistant|>",
+        "join": "",
+        "stop": ["<|user|>", "<|system|>"],
+    },
+    "huggingface": {
+        "system": "<s>[INST] {persona} [/INST] ",
+        "summary": "<s>[INST] Summary of earlier chat: {summary} [/INST]",
+        "turn": "<s>[INST] {user} [/INST] {assistant} </s>",
+        "prompt": "<s>[INST] {message} [/INST]",
+        "join": "\n",
+        "stop": ["[INST]", "</s>"],
+    },
+    "phi": {
+        "system": "System: {persona}",
+        "summary": "System: Summary of previous discussion: {summary}",
+        "turn": "User: {user}\nAssistant: {assistant}",
+        "prompt": "User: {message}\nAssistant:",
+        "join": "\n",
+        "stop": ["\nUser:", "\nSystem:"],
+    },
+    "falcon": {
+        "system": "<|system|>{persona}\n",
+        "summary": "<|system|>Summary: {summary}\n",
+        "turn": "<|user|>{user}<|end|><|assistant|>{assistant}<|end|>",
+        "prompt": "<|user|>{message}<|end|><|assistant|>",
+        "join": "\n",
+        "stop": ["<|end|>", "<|user|>", "<|system|>"],
+    },
+}
+
+_PARTS = ("system", "summary", "turn", "prompt")
+
+
+def _compile(fmt):
+    """
+    Split a format string into (literal, field name or None) pieces once.
+    """
+    return tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(fmt))
+
+
+def _emit(out, pieces, values):
+    for literal, field in pieces:
+        if literal:
+            out.append(literal)
+        if field is not None:
+            out.append(values[field])
+
+
+class PromptTemplate:
+    def __init__(self, name, spec):
+        missing = [part for part in ("system", "turn", "prompt") if part not in spec]
+        if missing:
+            raise ValueError(f"Template '{name}' is missing {', '.join(missing)}")
+        self.name = name
+        self.spec = spec
+        self.join = spec.get("join", "")
+        stop = spec.get("stop", [])
+        if not isinstance(stop, list) or not all(isinstance(x, str) and x for x in stop):
+            raise ValueError(f"Template '{name}': stop must be a list of non-empty strings")
+        self.stop = tuple(stop)
+        self.pieces = {part: _compile(spec[part]) for part in _PARTS if spec.get(part)}
+        self._headers = OrderedDict()  # persona text -> rendered header
+        self._lock = threading.Lock()
+
+    def header(self, persona_text):
+        with self._lock:
+            header = self._headers.get(persona_text)
+            if header is not None:
+                self._headers.move_to_end(persona_text)
+                return header
+        out = []
+        _emit(out, self.pieces["system"], {"persona": persona_text})
+        header = "".join(out)
+        with self._lock:
+            self._headers[persona_text] = header
+            while len(self._headers) > 512:
+                self._headers.popitem(last=False)
+        return header
+
+    def segments(self, persona, history, message, summary=None):
+        """
+        The prompt as [header, summary, turn..., new message] strings (each
+        but the header starting with the join), for callers that encode the
+        parts separately (prompt_tokens.py).
+        """
+        join = self.join
+        segments = [self.header(persona["persona"].strip())]
+        if summary and "summary" in self.pieces:
+            out = [join]
+            _emit(out, self.pieces["summary"], {"summary": summary.strip()})
+            segments.append("".join(out))
+        turn = self.pieces["turn"]
+        for t in history:
+            out = [join]
+            _emit(out, turn, {"user": t.get("user", ""), "assistant": t.get("assistant", "")})
+            segments.append("".join(out))
+        out = [join]
+        _emit(out, self.pieces["prompt"], {"message": message})
+        segments.append("".join(out))
+        return segments
+
+    def render(self, persona, history, message, summary=None):
+        return "".join(self.segments(persona, history, message, summary))
+
+
+_registry = {name: PromptTemplate(name, spec) for name, spec in BUILTIN_TEMPLATES.items()}
+_custom = {}
+_custom_mtime = None
+_registry_lock = threading.Lock()
+
+
+def _load_custom():
+    """
+    (Re)load CUSTOM_TEMPLATES_DIR when its mtime changed. A broken file is
+    skipped with a warning and does not affect the other templates.
+    """
+    global _custom, _custom_mtime
+    try:
+        mtime = os.stat(CUSTOM_TEMPLATES_DIR).st_mtime
+    except OSError:
+        mtime = None
+    if mtime == _custom_mtime:
+        return
+    with _registry_lock:
+        if mtime == _custom_mtime:
+            return
+        custom = {}
+        if mtime is not None:
+            for filename in sorted(os.listdir(CUSTOM_TEMPLATES_DIR)):
+                if not filename.endswith(".json"):
+                    continue
+                name = filename[:-5]
+                try:
+                    with open(os.path.join(CUSTOM_TEMPLATES_DIR, filename), "r", encoding="utf-8") as f:
+                        custom[name] = PromptTemplate(name, json.load(f))
+                except (OSError, ValueError) as e:
+                    print(f"[WARN] Skipping prompt template {filename}: {e}")
+        _custom, _custom_mtime = custom, mtime
+
+
+def get_template(name):
+    _load_custom()
+    return _custom.get(name) or _registry.get(name) or _registry[DEFAULT_TEMPLATE]
+
+
+def template_names():
+    _load_custom()
+    return sorted(set(_registry) | set(_custom))
+
+
 def format_prompt(template_name, persona, history, message, summary=None):
-    persona_text = persona["persona"].strip()
-
-    # Default to plain
-    if template_name == "plain":
-        persona_text = persona["persona"].strip()
-        lines = []
-
-        # Inject persona into the first user message instead of <|system|>
-        intro = f"You are {persona_text}"  # e.g., "You are Bob, a hard-boiled detective..."
-        lines.append(f"<|user|>{intro}")
-
-        # Optional summary
-        if summary:
-            lines.append(f"<|user|>Summary of previous discussion: {summary.strip()}")
-
-        # System-level persona definition
-        lines.append(f"<|system|>{persona_text}")
-
-        # Optional summary as system-level
-        if summary:
-            lines.append(f"<|system|>Summary of previous discussion: {summary.strip()}")
-
-        # Inject system message version of history
-        for turn in history:
-            user = turn.get("user", "").strip()
-            assistant = turn.get("assistant", "").strip()
-            if user and assistant:
-                lines.append(f"<|system|>User: {user}\nAssistant: {assistant}")
-
-        # Also replay actual conversation history using chat-style tags
-        for turn in history:
-            user = turn.get("user", "").strip()
-            assistant = turn.get("assistant", "").strip()
-            if user:
-                lines.append(f"<|user|>{user}")
-            if assistant:
-                lines.append(f"<|assistant|>{assistant}")
-
-        # Current turn
-        lines.append(f"<|user|>{message.strip()}")
-        lines.append(f"<|assistant|>")
-
-        return "".join(lines)
-
-
-    elif template_name == "hermes":
-        lines = [persona_text, ""]
-        if summary:
-            lines.append(f"Summary of previous discussion: {summary}\n")
-        for turn in history:
-            lines.append(f"User: {turn['user']}")
-            lines.append(f"Assistant: {turn['assistant']}")
-        lines.append(f"User: {message}")
-        lines.append("Assistant:")
-        return "\n".join(lines)
-
-    elif template_name == "llama2":
-        lines = [f"<<SYS>>\n{persona_text}\n<</SYS>>\n"]
-        if summary:
-            lines.append(f"[INST] Summary of earlier chat: {summary} [/INST]\n")
-        for turn in history:
-            lines.append(f"[INST] {turn['user']} [/INST] {turn['assistant']}")
-        lines.append(f"[INST] {message} [/INST]")
-        return "\n".join(lines)
-
-    elif template_name == "chatml":
-        lines = [f"<|system|>\n{persona_text}\n"]
-        if summary:
-            lines.append(f"<|system|> Summary: {summary}\n")
-        for turn in history:
-            lines.append(f"<|user|> {turn['user']}\n<|assistant|> {turn['assistant']}\n")
-        lines.append(f"<|user|> {message}\n<|assistant|>")
-        return "".join(lines)
-
-    elif template_name == "alpaca":
-        base = f"### Instruction:\n{persona_text}\n"
-        if summary:
-            base += f"\n### Note:\n{summary}\n"
-        for turn in history:
-            base += f"\n### User:\n{turn['user']}\n### Response:\n{turn['assistant']}\n"
-        base += f"\n### User:\n{message}\n### Response:\n"
-        return base
-
-    elif template_name == "oasst":
-        lines = [f"<|system|>{persona_text}<|end|>"]
-        for turn in history:
-            lines.append(f"<|user|>{turn['user']}<|end|><|assistant|>{turn['assistant']}<|end|>")
-        lines.append(f"<|user|>{message}<|end|><|assistant|>")
-        return "".join(lines)
-
-    elif template_name == "zephyr":
-        lines = [f"<|system|> {persona_text}\n"]
-        for turn in history:
-            lines.append(f"<|user|> {turn['user']}\n<|assistant|> {turn['assistant']}\n")
-        lines.append(f"<|user|> {message}\n<|assistant|>")
-        return "".join(lines)
-
-    elif template_name == "deepseek":
-        lines = [f"<|system|>\n{persona_text}\n"]
-        if summary:
-            lines.append(f"<|system|> Summary: {summary}\n")
-        for turn in history:
-            lines.append(f"<|user|> {turn['user']}\n<|assistant|> {turn['assistant']}\n")
-        lines.append(f"<|user|> {message}\n<|assistant|>")
-        return "".join(lines)
-
-    elif template_name == "huggingface":
-        lines = [f"<s>[INST] {persona_text} [/INST] "]
-        for turn in history:
-            lines.append(f"<s>[INST] {turn['user']} [/INST] {turn['assistant']} </s>")
-        lines.append(f"<s>[INST] {message} [/INST]")
-        return "\n".join(lines)
-
-    elif template_name == "phi":
-        lines = [f"System: {persona_text}"]
-        for turn in history:
-            lines.append(f"User: {turn['user']}\nAssistant: {turn['assistant']}")
-        lines.append(f"User: {message}\nAssistant:")
-        return "\n".join(lines)
-
-    elif template_name == "falcon":
-        lines = [f"<|system|>{persona_text}\n"]
-        for turn in history:
-            lines.append(f"<|user|>{turn['user']}<|end|><|assistant|>{turn['assistant']}<|end|>")
-        lines.append(f"<|user|>{message}<|end|><|assistant|>")
-        return "\n".join(lines)
-
-    # Fallback
-    return format_prompt("plain", persona, history, message, summary)
+    return get_template(template_name).render(persona, history, message, summary)
+
+
+def persona_prefix(template_name, persona):
+    """
+    The persona header of a prompt. Every turn of every session of the persona
+    starts with this text, which is what the KV prefix cache keys on.
+    """
+    return get_template(template_name).header(persona["persona"].strip())
+
+
+def stop_sequences(template_name):
+    return get_template(template_name).stop
@@ -0,0 +1,211 @@
+# prompt_tokens.py
+#
+# Prompt assembly at the token-ID level for local models.
+#
+# A prompt is rendered as segments (persona header, context line, one segment
+# per past turn, the new message; see PromptTemplate.segments). Each segment
+# is encoded once per tokenizer and cached by its text, so the persona header
+# is encoded once per (persona version, tokenizer) and a past turn once per
+# chat: on the hot path only the new message (and a changed context line) is
+# tokenized.
+#
+# Personas with "template": "native" use the tokenizer's own chat template
+# (tokenizer.chat_template); its output is cut into per-message segments the
+# same way. Tokenizers without one fall back to the "plain" template.
+#
+# Segments after the first are encoded without special tokens. SentencePiece
+# tokenizers (Llama, Mistral) also put a "▁" prefix space in front of every
+# encode, which text in the middle of a prompt does not get; for those, such
+# segments are encoded behind a newline anchor whose ids are then dropped.
+#
+# Encoding segments separately can still differ from encoding the whole string
+# where a token would span a segment boundary. The first prompt of every
+# (tokenizer, template) pair is therefore checked against a full encode; if they
+# differ the pair is always encoded as one string instead.
+
+import os
+import threading
+from collections import OrderedDict
+
+from prompt_templates import get_template
+
+PROMPT_TOKEN_CACHE_SIZE = int(os.getenv("PROMPT_TOKEN_CACHE_SIZE", "8192"))
+NATIVE_TEMPLATE = "native"
+
+_cache = OrderedDict()  # (tokenizer id, add special tokens, continued, text) -> tuple of ids
+_verified = {}  # (tokenizer id, template name) -> segment encoding is exact
+_anchors = {}  # tokenizer id -> ids of ANCHOR, or None without a prefix space
+SPIECE_UNDERLINE = "\u2581"
+ANCHOR = "\n"
+_lock = threading.Lock()
+STATS = {"prompts": 0, "segments": 0, "segment_hits": 0, "reused_tokens": 0, "encoded_tokens": 0, "full_encodes": 0}
+
+
+def _anchor(tokenizer):
+    """
+    Ids of ANCHOR when the tokenizer adds a SentencePiece prefix space to
+    every encode, else None.
+    """
+    key = id(tokenizer)
+    if key not in _anchors:
+        anchor = None
+        convert = getattr(tokenizer, "convert_ids_to_tokens", None)
+        if convert is not None:
+            first = convert(list(tokenizer("a", add_special_tokens=False)["input_ids"][:1]))
+            if first and str(first[0]).startswith(SPIECE_UNDERLINE):
+                anchor = tuple(tokenizer(ANCHOR, add_special_tokens=False)["input_ids"])
+        _anchors[key] = anchor
+    return _anchors[key]
+
+
+def _encode(tokenizer, text, special, continued=False):
+    """
+    Ids of `text`; `continued` text follows other text in the prompt, so it
+    gets no prefix space.
+    """
+    anchor = _anchor(tokenizer) if continued else None
+    if anchor:
+        ids = tokenizer(ANCHOR + text, add_special_tokens=False)["input_ids"]
+        if tuple(ids[:len(anchor)]) == anchor:
+            return tuple(ids[len(anchor):])
+    return tuple(tokenizer(text, add_special_tokens=special)["input_ids"])
+
+
+def _encode_cached(tokenizer, text, special, continued=False):
+    key = (id(tokenizer), special, continued, text)
+    with _lock:
+        ids = _cache.get(key)
+        if ids is not None:
+            _cache.move_to_end(key)
+            STATS["segment_hits"] += 1
+            STATS["reused_tokens"] += len(ids)
+            return ids
+    ids = _encode(tokenizer, text, special, continued)
+    with _lock:
+        _cache[key] = ids
+        STATS["encoded_tokens"] += len(ids)
+        while len(_cache) > PROMPT_TOKEN_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return ids
+
+
+def chat_messages(persona, history, message, summary=None):
+    system = persona["persona"].strip()
+    if summary:
+        system += f"\n\nSummary of previous discussion: {summary.strip()}"
+    messages = [{"role": "system", "content": system}]
+    for turn in history:
+        messages.append({"role": "user", "content": turn.get("user", "")})
+        messages.append({"role": "assistant", "content": turn.get("assistant", "")})
+    messages.append({"role": "user", "content": message})
+    return messages
+
+
+def _apply(tokenizer, messages, generation_prompt):
+    return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=generation_prompt)
+
+
+def native_segments(tokenizer, persona, history, message, summary=None):
+    """
+    The chat-template rendering cut at message boundaries: segment k is what
+    message k adds to the rendering of the messages before it. None when the
+    template does not render prefixes as prefixes of the whole.
+    """
+    messages = chat_messages(persona, history, message, summary)
+    try:
+        _apply(tokenizer, messages[:1], False)
+    except Exception:
+        # Templates without a system role (e.g. Mistral): fold it into the first user message
+        system = messages.pop(0)["content"]
+        messages[0] = {"role": "user", "content": f"{system}\n\n{messages[0]['content']}"}
+
+    full = _apply(tokenizer, messages, True)
+    segments, done = [], ""
+    # The persona header alone, then one segment per past turn (user + assistant)
+    cuts = [1] if messages[0]["role"] == "system" else []
+    cuts += list(range(len(messages) - 1 - 2 * len(history) + 2, len(messages), 2))
+    for cut in cuts:
+        rendered = _apply(tokenizer, messages[:cut], False)
+        if not full.startswith(rendered) or len(rendered) < len(done):
+            return None
+        segments.append(rendered[len(done):])
+        done = rendered
+    segments.append(full[len(done):])
+    return [s for s in segments if s]
+
+
+def build_prompt(tokenizer, template_name, persona, history, message, summary=None):
+    """
+    Returns (prompt text, prompt token ids, persona header ids).
+    """
+    native = template_name == NATIVE_TEMPLATE and getattr(tokenizer, "chat_template", None)
+    segments = None
+    if native:
+        segments = native_segments(tokenizer, persona, history, message, summary)
+        # Chat templates write BOS and friends as text
+        first_special = False
+    if segments is None:
+        template = get_template(template_name)
+        segments = template.segments(persona, history, message, summary)
+        first_special = True
+    text = "".join(segments)
+    key = (id(tokenizer), template_name)
+    STATS["prompts"] += 1
+
+    if _verified.get(key) is False:
+        STATS["full_encodes"] += 1
+        ids = list(_encode(tokenizer, text, first_special))
+        return text, ids, list(_encode_cached(tokenizer, segments[0], first_special))
+
+    if len(segments) == 1:
+        # Header and new message in one segment (a template that folds the
+        # system prompt into the first user turn, on a new chat)
+        parts = [_encode(tokenizer, segments[0], first_special)]
+    else:
+        parts = [_encode_cached(tokenizer, segments[0], first_special)]
+        parts += [_encode_cached(tokenizer, s, False, continued=True) for s in segments[1:-1]]
+        # The new message is seen once, not worth a cache slot
+        parts.append(_encode(tokenizer, segments[-1], False, continued=True))
+    STATS["segments"] += len(parts)
+    STATS["encoded_tokens"] += len(parts[-1])
+    ids = [i for part in parts for i in part]
+
+    if key not in _verified:
+        exact = ids == list(_encode(tokenizer, text, first_special))
+        _verified[key] = exact
+        if not exact:
+            print(f"[WARN] Segment encoding differs from a full encode for template '{template_name}', encoding whole prompts")
+            ids = list(_encode(tokenizer, text, first_special))
+    return text, ids, list(parts[0])
+
+
+def prompt_token_stats():
+    with _lock:
+        stats = dict(STATS)
+        stats["cached_segments"] = len(_cache)
+    stats["exact_templates"] = sum(1 for v in _verified.values() if v)
+    stats["fallback_templates"] = sum(1 for v in _verified.values() if not v)
+    return stats
+
+
+def encode_inputs(tokenizer, prompt, device):
+    """
+    Model inputs for a prompt given as text or as token ids (build_prompt).
+    """
+    import torch
+
+    if isinstance(prompt, str):
+        return tokenizer(prompt, return_tensors="pt").to(device)
+    input_ids = torch.tensor([prompt], dtype=torch.long, device=device)
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+
+def encode_batch(tokenizer, prompts, device):
+    """
+    Left-padded inputs for a batch of prompts (text or token ids, mixed).
+    """
+    ids = [
+        list(_encode(tokenizer, p, True)) if isinstance(p, str) else p
+        for p in prompts
+    ]
+    return tokenizer.pad({"input_ids": ids}, return_tensors="pt").to(device)
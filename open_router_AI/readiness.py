@@ -0,0 +1,60 @@
+# readiness.py
+#
+# Per-component startup state for /healthz and /readyz.
+#
+# Each component goes pending -> loading -> ready | failed, and we record how
+# long it took, so a slow restart shows exactly which part is slow.
+
+import threading
+import time
+from contextlib import contextmanager
+
+PROCESS_STARTED = time.time()
+
+# Components that must be ready before /readyz answers 200
+REQUIRED_COMPONENTS = ("db", "personas", "models", "embedder")
+
+_components = {name: {"state": "pending"} for name in REQUIRED_COMPONENTS}
+_lock = threading.Lock()
+_ready_at = None
+
+
+@contextmanager
+def track(component):
+    """
+    Record the state and duration of one startup step. Failures are recorded
+    and re-raised.
+    """
+    started = time.time()
+    with _lock:
+        _components[component] = {"state": "loading", "started_after": round(started - PROCESS_STARTED, 3)}
+    try:
+        yield
+    except Exception as e:
+        with _lock:
+            _components[component].update(state="failed", error=str(e), seconds=round(time.time() - started, 3))
+        raise
+    with _lock:
+        _components[component].update(state="ready", seconds=round(time.time() - started, 3))
+        _mark_ready_if_done()
+
+
+def _mark_ready_if_done():
+    global _ready_at
+    if _ready_at is None and all(_components[c]["state"] == "ready" for c in REQUIRED_COMPONENTS):
+        _ready_at = time.time()
+
+
+def is_ready():
+    with _lock:
+        return _ready_at is not None
+
+
+def report():
+    with _lock:
+        return {
+            "ready": _ready_at is not None,
+            "uptime_seconds": round(time.time() - PROCESS_STARTED, 3),
+            "startup_seconds": round(_ready_at - PROCESS_STARTED, 3) if _ready_at else None,
+            "components": {name: dict(state) for name, state in _components.items()},
+        }
@@ -0,0 +1,145 @@
+# response_cache.py
+#
+# Optional cache of replies to conversation openers.
+#
+# A lot of traffic is "hi" / "who are you?" sent to a persona with no history.
+# Personas opt in through their generation_params:
+#
+#   "generation_params": {"max_new_tokens": 200, "response_cache": true}
+#   "generation_params": {"response_cache": {"ttl": 3600, "similarity": 0.93}}
+#
+# Lookups go through an exact tier (normalized message) and then an embedding
+# similarity tier using the vector memory embedder. Only turns without any
+# context (no history, summary or retrieved memories) are cached, so a reply
+# never depends on one user's data and is never served to another.
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))
+DEFAULT_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+DEFAULT_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92"))
+
+
+def split_cache_settings(gen_args):
+    """
+    Strip the `response_cache` option from generation params.
+    Returns (gen_args for generate(), cache settings dict or None).
+    """
+    gen_args = dict(gen_args or {})
+    settings = gen_args.pop("response_cache", None)
+    if not settings:
+        return gen_args, None
+    if settings is True:
+        settings = {}
+    return gen_args, {
+        "ttl": float(settings.get("ttl", DEFAULT_TTL)),
+        "similarity": float(settings.get("similarity", DEFAULT_SIMILARITY)),
+        "semantic": bool(settings.get("semantic", True)),
+    }
+
+
+def normalize(message):
+    text = re.sub(r"\s+", " ", message.lower()).strip()
+    return text.rstrip("!?.,;: ")
+
+
+def bucket_key(persona, template, model_key, gen_args):
+    """
+    Everything except the message that determines the reply. The persona text
+    is hashed in so editing a persona invalidates its cached replies.
+    """
+    persona_hash = hashlib.sha1(json.dumps(persona.get("persona", ""), sort_keys=True).encode()).hexdigest()
+    return json.dumps(
+        [persona.get("name"), persona_hash, template, model_key, gen_args],
+        sort_keys=True, default=str
+    )
+
+
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._exact = OrderedDict()  # (bucket, normalized message) -> (expires, reply)
+        self._semantic = {}  # bucket -> OrderedDict(normalized message -> (expires, vector, reply))
+        self._lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    def _embed(self, text):
+        import numpy as np
+        from vector_memory import embed
+
+        # The raw message, not the normalized key: retrieve_similar embeds the
+        # same text, so this is an embedding cache hit
+        vector = np.asarray(embed(text), dtype="float32")
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, bucket, message, settings):
+        key = (bucket, normalize(message))
+        now = time.time()
+        with self._lock:
+            entry = self._exact.get(key)
+            if entry:
+                if entry[0] > now:
+                    self._exact.move_to_end(key)
+                    self.stats["exact_hits"] += 1
+                    return entry[1]
+                self._drop(key)
+                self.stats["expired"] += 1
+            candidates = list(self._semantic.get(bucket, {}).items())
+
+        if settings["semantic"] and candidates:
+            query = self._embed(message)
+            best, best_score = None, settings["similarity"]
+            for text, (expires, vector, reply) in candidates:
+                if expires <= now:
+                    continue
+                score = float(query @ vector)
+                if score >= best_score:
+                    best, best_score = reply, score
+            if best is not None:
+                with self._lock:
+                    self.stats["semantic_hits"] += 1
+                return best
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def store(self, bucket, message, reply, settings):
+        key = (bucket, normalize(message))
+        expires = time.time() + settings["ttl"]
+        vector = self._embed(message) if settings["semantic"] else None
+        with self._lock:
+            self._exact[key] = (expires, reply)
+            self._exact.move_to_end(key)
+            if vector is not None:
+                self._semantic.setdefault(bucket, OrderedDict())[key[1]] = (expires, vector, reply)
+            self.stats["stores"] += 1
+            while len(self._exact) > self.max_entries:
+                oldest, _ = next(iter(self._exact.items()))
+                self._drop(oldest)
+                self.stats["evictions"] += 1
+
+    def _drop(self, key):
+        self._exact.pop(key, None)
+        bucket = self._semantic.get(key[0])
+        if bucket is not None:
+            bucket.pop(key[1], None)
+            if not bucket:
+                del self._semantic[key[0]]
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._exact)
+        hits = stats["exact_hits"] + stats["semantic_hits"]
+        stats["hit_rate"] = round(hits / ((hits + stats["misses"]) or 1), 4)
+        return stats
+
+
+response_cache = ResponseCache()
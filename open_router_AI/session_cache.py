@@ -0,0 +1,182 @@
+# session_cache.py
+#
+# Bounded in-process cache of per-session state.
+#
+# Sessions are kept LRU within SESSION_CACHE_MB (sizes come from a pluggable
+# `sizeof`, by default an estimate of the strings they hold) and
+# SESSION_CACHE_MAX entries, and expire after SESSION_CACHE_TTL seconds idle.
+# Entries put with spill=True are written to SQLite (SESSION_SPILL_PATH) when
+# evicted or expired and restored on their next access, so state that lives
+# nowhere else is not lost; DB-backed entries (chat history) are just dropped.
+# The spill file is opened (and created) on the first spill, not at import.
+#
+# Used as the hot layer in front of the chat.db history query (app.load_recent)
+# and behind utils.get_history / append_history.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SESSION_CACHE_MB = float(os.getenv("SESSION_CACHE_MB", "64"))
+SESSION_CACHE_MAX = int(os.getenv("SESSION_CACHE_MAX", "10000"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "1800"))
+# "" disables spilling
+SESSION_SPILL_PATH = os.getenv("SESSION_SPILL_PATH", "session_spill.db")
+# Spilled sessions not touched for this long are deleted
+SESSION_SPILL_TTL = float(os.getenv("SESSION_SPILL_TTL", str(7 * 86400)))
+
+
+def estimate_size(value):
+    """
+    Rough bytes held by JSON-like `value`.
+    """
+    if isinstance(value, str):
+        return 49 + len(value)
+    if isinstance(value, dict):
+        return 64 + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 56 + sum(estimate_size(v) for v in value)
+    return 28
+
+
+class SessionCache:
+    def __init__(self, max_mb=SESSION_CACHE_MB, max_sessions=SESSION_CACHE_MAX, ttl=SESSION_CACHE_TTL,
+                 spill_path=SESSION_SPILL_PATH, sizeof=estimate_size):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> [value, nbytes, last access, spill]
+        self._lock = threading.RLock()
+        self.spill_path = spill_path
+        self._spill = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "spilled": 0, "restored": 0}
+
+    @staticmethod
+    def _spill_key(key):
+        return json.dumps(key, default=str)
+
+    def _spill_db(self, create=True):
+        """
+        The spill connection, opened on first use. None when spilling is off,
+        or when `create` is false and there is no spill file yet.
+        """
+        if self._spill is None and self.spill_path:
+            if not create and not os.path.exists(self.spill_path):
+                return None
+            self._spill = sqlite3.connect(self.spill_path, check_same_thread=False)
+            self._spill.execute(
+                "CREATE TABLE IF NOT EXISTS spilled_sessions (key TEXT PRIMARY KEY, value TEXT, spilled_at REAL)"
+            )
+            self._spill.execute("DELETE FROM spilled_sessions WHERE spilled_at < ?", (time.time() - SESSION_SPILL_TTL,))
+            self._spill.commit()
+        return self._spill
+
+    def _remove(self, key, reason):
+        value, nbytes, _, spill = self._entries.pop(key)
+        self.bytes -= nbytes
+        self.stats[reason] += 1
+        db = self._spill_db() if spill else None
+        if db is not None:
+            db.execute(
+                "INSERT OR REPLACE INTO spilled_sessions (key, value, spilled_at) VALUES (?, ?, ?)",
+                (self._spill_key(key), json.dumps(value), time.time())
+            )
+            db.commit()
+            self.stats["spilled"] += 1
+
+    def _evict(self):
+        now = time.time()
+        # Oldest first: stop at the first entry that is neither expired nor over budget
+        while self._entries:
+            key, (_, _, touched, _) = next(iter(self._entries.items()))
+            if now - touched > self.ttl:
+                self._remove(key, "expired")
+            elif self.bytes > self.max_bytes or len(self._entries) > self.max_sessions:
+                self._remove(key, "evictions")
+            else:
+                break
+
+    def _restore(self, key):
+        # Misses before anything was ever spilled do not create the file
+        db = self._spill_db(create=False)
+        if db is None:
+            return None
+        skey = self._spill_key(key)
+        row = db.execute("SELECT value FROM spilled_sessions WHERE key = ?", (skey,)).fetchone()
+        if row is None:
+            return None
+        db.execute("DELETE FROM spilled_sessions WHERE key = ?", (skey,))
+        db.commit()
+        self.stats["restored"] += 1
+        value = json.loads(row[0])
+        self._store(key, value, spill=True)
+        return value
+
+    def _store(self, key, value, spill):
+        if key in self._entries:
+            self.bytes -= self._entries.pop(key)[1]
+        nbytes = self.sizeof(value)
+        self._entries[key] = [value, nbytes, time.time(), spill]
+        self.bytes += nbytes
+        self._evict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[2] > self.ttl:
+                self._remove(key, "expired")
+                entry = None
+            if entry is not None:
+                entry[2] = time.time()
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            value = self._restore(key)
+            if value is not None:
+                self.stats["hits"] += 1
+                return value
+            self.stats["misses"] += 1
+            return default
+
+    def put(self, key, value, spill=False):
+        with self._lock:
+            self._store(key, value, spill)
+
+    def update(self, key, fn):
+        """
+        Replace a cached value with fn(value), or drop it when fn returns
+        None; does nothing on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            value = fn(entry[0])
+            if value is None:
+                self.bytes -= self._entries.pop(key)[1]
+            else:
+                self._store(key, value, entry[3])
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["sessions"] = len(self._entries)
+            stats["used_mb"] = round(self.bytes / 1024 / 1024, 2)
+        stats["budget_mb"] = round(self.max_bytes / 1024 / 1024, 2)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / (lookups or 1), 4)
+        return stats
+
+
+session_cache = SessionCache()
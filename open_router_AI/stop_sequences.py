@@ -0,0 +1,141 @@
+# stop_sequences.py
+#
+# Where a reply ends.
+#
+# Every prompt template lists the strings that open a turn other than the
+# assistant's ("stop" in prompt_templates.BUILTIN_TEMPLATES). Once a model
+# writes one of them it is inventing the user's next line, so:
+#
+#   local models   - a StoppingCriteria ends generate() as soon as a stop
+#                    string appears in the new tokens (per row in a batch)
+#   remote models  - the strings are sent as the "stop" parameter
+#
+# and the reply is cut at the first stop string either way (streams hold back
+# any tail that could still become one). STATS counts the replies that ended
+# on a stop string and the tokens of max_new_tokens they did not spend.
+
+import math
+import threading
+
+from cancellation import cancel_criterion
+
+_lock = threading.Lock()
+STATS = {"local_stopped": 0, "remote_stopped": 0, "tokens_saved": 0, "trimmed_chars": 0}
+
+
+def trim(text, stop):
+    """
+    (text before the first stop string, whether one was found).
+    """
+    cut = min((i for i in (text.find(s) for s in stop) if i >= 0), default=-1)
+    if cut < 0:
+        return text, False
+    return text[:cut], True
+
+
+def stopping_criteria(tokenizer, stops, prompt_len, cancels=()):
+    """
+    StoppingCriteriaList for generate(), or None when there is nothing to stop on.
+    `stops` is one tuple of stop strings per row of the batch, `cancels` one
+    CancelToken (or None) per row (cancellation.py).
+    """
+    criteria = []
+    cancel = cancel_criterion(cancels)
+    if cancel is not None:
+        criteria.append(cancel)
+    if any(stops):
+        import torch
+        from transformers import StoppingCriteria
+
+        # A stop string is found within its length in tokens (+1 for a token that
+        # starts before it), so only that tail is decoded at each step
+        window = max(len(s) for row in stops for s in row) + 1
+
+        class StopOnStrings(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                tails = tokenizer.batch_decode(input_ids[:, prompt_len:][:, -window:])
+                done = [any(s in tail for s in row) for tail, row in zip(tails, stops)]
+                return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+        criteria.append(StopOnStrings())
+    if not criteria:
+        return None
+    from transformers import StoppingCriteriaList
+
+    return StoppingCriteriaList(criteria)
+
+
+def record_stop(kind, gen_args, new_tokens=None, chars=0, trimmed_chars=0):
+    """
+    Count a reply of `kind` ("local"/"remote") that ended on a stop string.
+    Without a token count (remote, streams) it is estimated from the `chars`
+    generated at ~4 characters per token.
+    """
+    if new_tokens is None:
+        new_tokens = math.ceil(chars / 4)
+    with _lock:
+        STATS[f"{kind}_stopped"] += 1
+        STATS["trimmed_chars"] += trimmed_chars
+        STATS["tokens_saved"] += max(gen_args.get("max_new_tokens", 0) - new_tokens, 0)
+
+
+def finish_local(text, stop, new_tokens, gen_args):
+    """
+    Cut a decoded local reply at its stop string and record what that saved.
+    """
+    trimmed, stopped = trim(text, stop)
+    if stopped:
+        record_stop("local", gen_args, new_tokens, trimmed_chars=len(text) - len(trimmed))
+    return trimmed.strip()
+
+
+def finish_remote(text, stop, gen_args):
+    """
+    Same for a remote reply. Servers that honour "stop" end on (and usually
+    include) the stop string.
+    """
+    trimmed, stopped = trim(text, stop)
+    if stopped:
+        record_stop("remote", gen_args, chars=len(text), trimmed_chars=len(text) - len(trimmed))
+    return trimmed.strip()
+
+
+class StreamTrimmer:
+    """
+    Filters a stream of text chunks: text is passed on once it can no longer
+    be the start of a stop string, and nothing after a stop string is.
+    """
+
+    def __init__(self, stop):
+        self.stop = tuple(s for s in stop if s)
+        self.pending = ""
+        self.stopped = False
+        self.seen = 0
+
+    def feed(self, chunk):
+        if self.stopped:
+            return ""
+        self.seen += len(chunk)
+        text, self.stopped = trim(self.pending + chunk, self.stop)
+        if self.stopped:
+            self.pending = ""
+            return text
+        hold = 0
+        for s in self.stop:
+            for n in range(min(len(s) - 1, len(text)), hold, -1):
+                if text.endswith(s[:n]):
+                    hold = n
+                    break
+        self.pending = text[len(text) - hold:] if hold else ""
+        return text[:len(text) - hold]
+
+    def flush(self):
+        text, self.pending = self.pending, ""
+        return text
+
+
+def stop_stats():
+    with _lock:
+        stats = dict(STATS)
+    stats["stopped"] = stats["local_stopped"] + stats["remote_stopped"]
+    return stats
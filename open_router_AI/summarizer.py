@@ -0,0 +1,190 @@
+# summarizer.py
+#
+# Incremental rolling summary of a chat.
+#
+# Only the last HISTORY_TURNS turns go into the prompt verbatim; older turns
+# live in Chat.summary. Chat.summary_upto is the id of the last message already
+# folded in, so each fold only sends the turns that left the window since the
+# previous one, never the whole chat again.
+#
+# Folding runs on the work queue after the reply ("summarize" jobs, coalesced
+# per chat). If a turn arrives before its job has run, summary_for_prompt()
+# appends the missing turns as topics in memory, without calling a model.
+#
+# SUMMARY_BACKEND picks the summarizer:
+#   "openai" - gpt-3.5-turbo (needs OPENAI_API_KEY)
+#   "local"  - the local MODEL_REGISTRY model SUMMARY_MODEL, on the inference pool
+#   "topics" - no model, a list of what the user asked about
+# Any failure falls back to "topics".
+
+import logging
+import os
+import threading
+
+from sqlalchemy import func
+
+from models.db import SessionLocal, Chat, messages_between, recent_messages, to_turns
+import work_queue
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "6"))
+# Cap on turns folded into the summary at once (first turn of a chat that
+# predates the rolling summary).
+MAX_FOLD_TURNS = 50
+SUMMARY_BACKEND = os.getenv("SUMMARY_BACKEND", "openai")
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "mistral-7b-instruct")
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "150"))
+
+STATS = {"folds": 0, "folded_turns": 0, "fallbacks": 0, "inline_topics": 0, "stale": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        STATS[key] += n
+
+
+def topics_fold(summary, turns):
+    topics = "; ".join(f"User asked about: {t['user']}" for t in turns)
+    if summary:
+        return f"{summary}; {topics}"
+    return "Previously discussed topics: " + topics
+
+
+def _fold_prompt(summary, turns):
+    conv = "".join(f"User: {t['user']}\nAssistant: {t['assistant']}\n" for t in turns)
+    previous = f"Summary so far:\n{summary}\n\n" if summary else ""
+    return (
+        f"{previous}Update the summary with the following conversation, "
+        f"concisely, for memory retention:\n{conv}\nSummary:"
+    )
+
+
+def _openai_fold(summary, turns):
+    import openai
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+
+    response = openai.ChatCompletion.create(
+        model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": _fold_prompt(summary, turns)}],
+        temperature=0.5,
+        max_tokens=SUMMARY_MAX_TOKENS
+    )
+    return response.choices[0].message.content.strip()
+
+
+def _local_fold(summary, turns):
+    from inference import _generate_local_sync, submit_inference
+    from models.registry import get_model
+
+    model, tokenizer = get_model(SUMMARY_MODEL)
+    if isinstance(model, str):
+        raise ValueError(f"SUMMARY_MODEL '{SUMMARY_MODEL}' is not a local model")
+    gen_args = {"max_new_tokens": SUMMARY_MAX_TOKENS, "do_sample": False}
+    # Same pool and queue limit as chat generation so summaries never oversubscribe the model
+    return submit_inference(
+        _generate_local_sync, model, tokenizer, _fold_prompt(summary, turns), gen_args
+    ).result()
+
+
+BACKENDS = {"openai": _openai_fold, "local": _local_fold, "topics": topics_fold}
+
+
+def fold(summary, turns):
+    """
+    Return `summary` updated with `turns` ({"user", "assistant"} dicts).
+    """
+    if not turns:
+        return summary
+    try:
+        folded = BACKENDS[SUMMARY_BACKEND](summary, turns)
+        if folded:
+            return folded
+    except Exception as e:
+        logger.warning(f"Summarizer '{SUMMARY_BACKEND}' failed ({e}), listing topics instead")
+    _count("fallbacks")
+    return topics_fold(summary, turns)
+
+
+def window_rows(db, chat_id, max_turns=HISTORY_TURNS):
+    """
+    Messages of the recent window, oldest first, starting with a user message.
+    """
+    rows = recent_messages(db, chat_id, max_turns * 2)
+    while rows and rows[0].sender != "user":
+        rows.pop(0)
+    return rows
+
+
+def _evicted(db, chat_id, summary_upto, max_turns):
+    rows = window_rows(db, chat_id, max_turns)
+    if not rows:
+        return []
+    return messages_between(db, chat_id, summary_upto or 0, rows[0].id, limit=MAX_FOLD_TURNS * 2)
+
+
+def summary_for_prompt(chat_id, summary, summary_upto, max_turns=HISTORY_TURNS):
+    """
+    The summary to put in this turn's prompt. Cheap: turns evicted since the
+    last fold are listed as topics rather than summarized here.
+    """
+    db = SessionLocal()
+    try:
+        evicted = _evicted(db, chat_id, summary_upto, max_turns)
+    finally:
+        db.close()
+    if not evicted:
+        return summary
+    _count("inline_topics")
+    return topics_fold(summary, to_turns(evicted))
+
+
+def summarize_chat(chat_id, max_turns=HISTORY_TURNS):
+    """
+    Fold the turns that left the recent window into Chat.summary.
+    """
+    db = SessionLocal()
+    try:
+        chat = db.query(Chat).filter_by(id=chat_id).first()
+        if chat is None:
+            return
+        upto = chat.summary_upto or 0
+        evicted = _evicted(db, chat_id, upto, max_turns)
+        if not evicted:
+            return
+        summary = fold(chat.summary, to_turns(evicted))
+        # Only write if nobody else folded meanwhile
+        updated = (
+            db.query(Chat)
+            .filter(Chat.id == chat_id, func.coalesce(Chat.summary_upto, 0) == upto)
+            .update({Chat.summary: summary, Chat.summary_upto: evicted[-1].id}, synchronize_session=False)
+        )
+        db.commit()
+        if updated:
+            _count("folds")
+            _count("folded_turns", len(evicted) // 2)
+        else:
+            _count("stale")
+    finally:
+        db.close()
+
+
+def summarize_batch(payloads):
+    for chat_id in dict.fromkeys(p["chat_id"] for p in payloads):
+        summarize_chat(chat_id)
+
+
+def enqueue_summary(chat_id):
+    """
+    Blocking (one DB insert), coalesced per chat.
+    """
+    work_queue.enqueue("summarize", {"chat_id": chat_id}, coalesce_key=f"summary:{chat_id}")
+
+
+def summarizer_stats():
+    with _stats_lock:
+        return dict(STATS, backend=SUMMARY_BACKEND)
+
+
+work_queue.register("summarize", summarize_batch)
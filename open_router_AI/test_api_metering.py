@@ -0,0 +1,177 @@
+import asyncio
+import json
+import unittest
+
+import api_metering
+from api_metering import RateLimiter
+
+
+async def ok_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+def http_scope(path="/models", method="GET", headers=(), query=b"", client="10.0.0.1"):
+    return {
+        "type": "http", "method": method, "path": path, "query_string": query,
+        "headers": list(headers), "client": (client, 1234),
+    }
+
+
+def body_receive(body, chunk=None):
+    chunks = [body[i:i + chunk] for i in range(0, len(body), chunk)] if chunk else [body]
+    messages = [
+        {"type": "http.request", "body": c, "more_body": i < len(chunks) - 1}
+        for i, c in enumerate(chunks)
+    ]
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    return receive
+
+
+def call(app, scope, receive=None):
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive or body_receive(b""), send))
+    return sent
+
+
+class TakeTests(unittest.TestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(ok_app, rpm=60, burst=3, routes={}, models={}, exempt=())
+        self.limits = [(("*", "a"), (1.0, 3))]
+
+    def test_burst(self):
+        for _ in range(3):
+            self.assertEqual(self.limiter.take(self.limits, 100.0), 0)
+        self.assertAlmostEqual(self.limiter.take(self.limits, 100.0), 1.0)
+
+    def test_refill(self):
+        for _ in range(3):
+            self.limiter.take(self.limits, 100.0)
+        self.assertAlmostEqual(self.limiter.take(self.limits, 100.5), 0.5)
+        self.assertEqual(self.limiter.take(self.limits, 101.0), 0)
+        # Refill stops at the burst
+        for _ in range(3):
+            self.assertEqual(self.limiter.take(self.limits, 1000.0), 0)
+        self.assertGreater(self.limiter.take(self.limits, 1000.0), 0)
+
+    def test_all_or_nothing(self):
+        route = (("/send-message", "a"), (1.0, 1))
+        self.assertEqual(self.limiter.take(self.limits + [route], 100.0), 0)
+        self.assertGreater(self.limiter.take(self.limits + [route], 100.0), 0)
+        # The rejected request took nothing from the global bucket
+        self.assertEqual(self.limiter.take(self.limits, 100.0), 0)
+        self.assertEqual(self.limiter.take(self.limits, 100.0), 0)
+        self.assertGreater(self.limiter.take(self.limits, 100.0), 0)
+
+    def test_idle_buckets_expire(self):
+        self.limiter.take(self.limits, 100.0)
+        self.limiter.take([(("*", "b"), (1.0, 3))], 104.0)
+        self.assertEqual(self.limiter.report()["keys"], 1)
+        self.assertEqual(self.limiter.stats["expired"], 1)
+
+
+class ModelKeyTests(unittest.TestCase):
+    def model_key(self, body, content_type, chunk=None):
+        limiter = RateLimiter(ok_app, exempt=())
+        scope = http_scope("/send-message", "POST", headers=[
+            (b"content-type", content_type), (b"content-length", str(len(body)).encode()),
+        ])
+        receive = body_receive(body, chunk)
+
+        async def run():
+            model, replay = await limiter._model_key(scope, receive)
+            replayed = b""
+            while True:
+                message = await replay()
+                if message["type"] != "http.request":
+                    break
+                replayed += message["body"]
+                if not message.get("more_body"):
+                    break
+            return model, replayed
+
+        model, replayed = asyncio.run(run())
+        self.assertEqual(replayed, body)
+        return model
+
+    def test_urlencoded(self):
+        body = b"message=hi+there&model_key=hermes"
+        self.assertEqual(self.model_key(body, b"application/x-www-form-urlencoded", chunk=7), "hermes")
+
+    def test_json(self):
+        body = json.dumps({"message": "hi", "model_key": "hermes"}).encode()
+        self.assertEqual(self.model_key(body, b"application/json"), "hermes")
+        self.assertIsNone(self.model_key(b"[1, 2]", b"application/json"))
+        self.assertIsNone(self.model_key(b"{not json", b"application/json"))
+
+    def test_multipart(self):
+        body = (
+            b"--b\r\nContent-Disposition: form-data; name=\"model_key\"\r\n\r\nhermes\r\n"
+            b"--b\r\nContent-Disposition: form-data; name=\"message\"\r\n"
+            b"Content-Type: text/plain\r\n\r\nhi there\r\n--b--\r\n"
+        )
+        self.assertEqual(self.model_key(body, b"multipart/form-data; boundary=b"), "hermes")
+
+    def test_query_and_header(self):
+        limiter = RateLimiter(ok_app, exempt=())
+        model, _ = asyncio.run(limiter._model_key(http_scope(query=b"model_key=a"), None))
+        self.assertEqual(model, "a")
+        model, _ = asyncio.run(limiter._model_key(http_scope(headers=[(b"x-model-key", b"b")]), None))
+        self.assertEqual(model, "b")
+
+
+class MiddlewareTests(unittest.TestCase):
+    def test_429_with_retry_after(self):
+        limiter = RateLimiter(ok_app, rpm=6, burst=1, routes={}, models={}, exempt=())
+        self.assertEqual(call(limiter, http_scope())[0]["status"], 200)
+        start, body = call(limiter, http_scope())
+        self.assertEqual(start["status"], 429)
+        headers = dict(start["headers"])
+        self.assertEqual(headers[b"retry-after"], b"10")
+        self.assertEqual(json.loads(body["body"]), {"detail": "Rate limit exceeded", "retry_after": 10})
+        # Other clients have their own bucket
+        self.assertEqual(call(limiter, http_scope(client="10.0.0.2"))[0]["status"], 200)
+
+    def test_model_limit(self):
+        limiter = RateLimiter(ok_app, rpm=600, burst=100, routes={}, models={"hermes": [6, 1]}, exempt=())
+        scope = lambda model: http_scope("/send-message", headers=[(b"x-model-key", model)])
+        self.assertEqual(call(limiter, scope(b"hermes"))[0]["status"], 200)
+        self.assertEqual(call(limiter, scope(b"hermes"))[0]["status"], 429)
+        self.assertEqual(call(limiter, scope(b"mistral"))[0]["status"], 200)
+
+    def test_exempt_and_segments(self):
+        limiter = RateLimiter(ok_app, rpm=600, burst=100, routes={"/chat": [6, 1]}, models={}, exempt=("/static",))
+        for _ in range(3):
+            self.assertEqual(call(limiter, http_scope("/static/app.js"))[0]["status"], 200)
+            self.assertEqual(call(limiter, http_scope("/chat-debug"))[0]["status"], 200)
+        self.assertEqual(call(limiter, http_scope("/chat/1"))[0]["status"], 200)
+        self.assertEqual(call(limiter, http_scope("/chat"))[0]["status"], 429)
+        self.assertEqual(limiter.stats["exempt"], 3)
+
+    def test_non_http_passes(self):
+        seen = []
+
+        async def app(scope, receive, send):
+            seen.append(scope["type"])
+
+        asyncio.run(RateLimiter(app, rpm=0, burst=0)({"type": "lifespan"}, None, None))
+        self.assertEqual(seen, ["lifespan"])
+
+
+class UnderTests(unittest.TestCase):
+    def test_segments(self):
+        self.assertTrue(api_metering._under("/chat", ("/chat",)))
+        self.assertTrue(api_metering._under("/chat/x", ("/chat",)))
+        self.assertFalse(api_metering._under("/chat-debug", ("/chat",)))
+        self.assertTrue(api_metering._under("/static/a.js", ("/static/",)))
+
+
+if __name__ == "__main__":
+    unittest.main()
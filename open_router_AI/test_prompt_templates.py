@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+import unittest
+
+import prompt_templates
+
+PERSONA = {"persona": "Bob is a hard-boiled detective who never smiles and always gets his man."}
+HISTORY = [
+    {"user": "Who are you?", "assistant": "Bob. Detective."},
+    {"user": "Any cases today?", "assistant": "A missing cat on 5th street."},
+    {"user": "Did you find it?", "assistant": "Always do."},
+]
+MESSAGE = "What now?"
+SUMMARY = "The user hired Bob last week."
+
+# Rendered size (characters) of the fixture above per template. A template that
+# grows past its entry is a prompt-size regression: every extra character is
+# prefilled on every turn.
+MAX_PROMPT_CHARS = {
+    "alpaca": 344,
+    "chatml": 338,
+    "deepseek": 338,
+    "falcon": 376,
+    "hermes": 317,
+    "huggingface": 364,
+    "llama2": 334,
+    "oasst": 383,
+    "phi": 331,
+    "plain": 343,
+    "zephyr": 338,
+}
+
+
+class PromptTemplateTests(unittest.TestCase):
+    def render(self, name, summary=SUMMARY):
+        return prompt_templates.format_prompt(name, PERSONA, HISTORY, MESSAGE, summary)
+
+    def test_every_builtin_has_a_size_budget(self):
+        self.assertEqual(set(prompt_templates.BUILTIN_TEMPLATES), set(MAX_PROMPT_CHARS))
+
+    def test_prompt_size(self):
+        for name, limit in MAX_PROMPT_CHARS.items():
+            with self.subTest(template=name):
+                self.assertLessEqual(len(self.render(name)), limit)
+
+    def test_context_appears_once(self):
+        for name in MAX_PROMPT_CHARS:
+            with self.subTest(template=name):
+                prompt = self.render(name)
+                self.assertEqual(prompt.count(PERSONA["persona"]), 1)
+                self.assertEqual(prompt.count(SUMMARY), 1)
+                for turn in HISTORY:
+                    self.assertEqual(prompt.count(turn["user"]), 1)
+                    self.assertEqual(prompt.count(turn["assistant"]), 1)
+                self.assertEqual(prompt.count(MESSAGE), 1)
+
+    def test_prompt_starts_with_persona_prefix(self):
+        for name in MAX_PROMPT_CHARS:
+            with self.subTest(template=name):
+                self.assertTrue(self.render(name).startswith(prompt_templates.persona_prefix(name, PERSONA)))
+
+    def test_stop_sequences_catch_the_next_user_turn(self):
+        # A reply that runs on into a made-up user line must hit a stop string
+        for name in MAX_PROMPT_CHARS:
+            with self.subTest(template=name):
+                template = prompt_templates.get_template(name)
+                next_turn = template.segments(PERSONA, [], MESSAGE)[-1]
+                opener = next_turn[:next_turn.index(MESSAGE)]
+                self.assertTrue(any(stop in opener for stop in template.stop))
+
+    def test_unknown_template_falls_back_to_plain(self):
+        self.assertEqual(self.render("no-such-template"), self.render("plain"))
+
+    def test_custom_template_from_disk(self):
+        previous = prompt_templates.CUSTOM_TEMPLATES_DIR
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "mytpl.json"), "w") as f:
+                json.dump({"system": "[{persona}]", "turn": "<{user}|{assistant}>", "prompt": "<{message}|"}, f)
+            prompt_templates.CUSTOM_TEMPLATES_DIR = tmp
+            try:
+                self.assertIn("mytpl", prompt_templates.template_names())
+                self.assertEqual(
+                    prompt_templates.format_prompt("mytpl", PERSONA, HISTORY[:1], MESSAGE),
+                    f"[{PERSONA['persona']}]<Who are you?|Bob. Detective.><What now?|"
+                )
+            finally:
+                prompt_templates.CUSTOM_TEMPLATES_DIR = previous
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+
+import prompt_tokens
+
+PERSONA = {"persona": "Bob is a hard-boiled detective."}
+HISTORY = [
+    {"user": "Who are you?", "assistant": "Bob. Detective."},
+    {"user": "Any cases today?", "assistant": "A missing cat."},
+]
+MESSAGE = "What now?"
+BOS = 1
+
+
+class CharTokenizer:
+    """One id per character, BOS as the only special token."""
+
+    chat_template = None
+
+    def __call__(self, text, add_special_tokens=True):
+        return {"input_ids": ([BOS] if add_special_tokens else []) + [ord(c) for c in text]}
+
+
+class NoSystemTokenizer(CharTokenizer):
+    """A chat template without a system role, like Mistral's."""
+
+    chat_template = "[INST]"
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=False):
+        out = ["<s>"]
+        for m in messages:
+            if m["role"] == "system":
+                raise ValueError("Conversation roles must alternate user/assistant")
+            out.append(f"[INST] {m['content']} [/INST]" if m["role"] == "user" else f"{m['content']}</s>")
+        return "".join(out)
+
+
+class SentencePieceTokenizer:
+    """
+    Llama/Mistral-style: spaces become "▁", every encode gets a "▁"
+    prefix space, a "▁" merges with the character after it and newlines
+    are byte tokens.
+    """
+
+    chat_template = None
+
+    def __init__(self):
+        self.vocab = {"<s>": BOS}
+        self.pieces = {BOS: "<s>"}
+
+    def _id(self, piece):
+        if piece not in self.vocab:
+            self.vocab[piece] = len(self.vocab) + 1
+            self.pieces[self.vocab[piece]] = piece
+        return self.vocab[piece]
+
+    def tokenize(self, text):
+        text = "▁" + text.replace(" ", "▁")
+        pieces, i = [], 0
+        while i < len(text):
+            if text[i] == "▁" and i + 1 < len(text) and text[i + 1] not in "▁\n":
+                pieces.append(text[i:i + 2])
+                i += 2
+            else:
+                pieces.append("<0x0A>" if text[i] == "\n" else text[i])
+                i += 1
+        return pieces
+
+    def __call__(self, text, add_special_tokens=True):
+        return {"input_ids": ([BOS] if add_special_tokens else []) + [self._id(p) for p in self.tokenize(text)]}
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.pieces[i] for i in ids]
+
+
+class BuildPromptTests(unittest.TestCase):
+    def setUp(self):
+        # Module state is keyed by id(tokenizer), which fakes of earlier tests may share
+        prompt_tokens._cache.clear()
+        prompt_tokens._verified.clear()
+        prompt_tokens._anchors.clear()
+
+    def build(self, tokenizer, template, history, summary=None):
+        text, ids, header = prompt_tokens.build_prompt(tokenizer, template, PERSONA, history, MESSAGE, summary)
+        # Segment encoding must equal encoding the prompt in one go
+        special = template != prompt_tokens.NATIVE_TEMPLATE or tokenizer.chat_template is None
+        self.assertEqual(ids, tokenizer(text, add_special_tokens=special)["input_ids"])
+        self.assertEqual(ids[:len(header)], header)
+        return text, ids
+
+    def test_single_segment(self):
+        tokenizer = NoSystemTokenizer()
+        # A chat with history first, so the one-time full-encode check has passed
+        self.build(tokenizer, prompt_tokens.NATIVE_TEMPLATE, HISTORY)
+        text, ids = self.build(tokenizer, prompt_tokens.NATIVE_TEMPLATE, [])
+        self.assertEqual(len(ids), len(text))
+        self.assertEqual(text.count(PERSONA["persona"]), 1)
+
+    def test_header_plus_tail(self):
+        text, ids = self.build(CharTokenizer(), "plain", [])
+        self.assertEqual(len(ids), len(text) + 1)
+
+    def test_multi_turn(self):
+        for tokenizer, template in ((CharTokenizer(), "plain"), (NoSystemTokenizer(), prompt_tokens.NATIVE_TEMPLATE)):
+            with self.subTest(template=template):
+                for _ in range(2):  # second pass reuses cached segments
+                    text, ids = self.build(tokenizer, template, HISTORY, "They met yesterday.")
+                for turn in HISTORY:
+                    self.assertEqual(text.count(turn["assistant"]), 1)
+                self.assertEqual(text.count(MESSAGE), 1)
+
+    def test_sentencepiece_prefix_space(self):
+        tokenizer = SentencePieceTokenizer()
+        # Encoding a segment on its own adds a prefix space the full prompt does not have
+        self.assertNotEqual(tokenizer("\nUser: hi", add_special_tokens=False)["input_ids"],
+                            tokenizer("x\nUser: hi", add_special_tokens=False)["input_ids"][1:])
+        full_encodes = prompt_tokens.STATS["full_encodes"]
+        for _ in range(2):
+            self.build(tokenizer, "plain", HISTORY, "They met yesterday.")
+        self.assertTrue(prompt_tokens._verified[(id(tokenizer), "plain")])
+        self.assertEqual(prompt_tokens.STATS["full_encodes"], full_encodes)
+        self.assertGreater(prompt_tokens.STATS["segment_hits"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
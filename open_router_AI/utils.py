@@ -1,25 +1,16 @@
-import json
-import os
-import requests
-from pathlib import Path
-
-from transformers import PreTrainedTokenizer
-
-from persona_startup import autopopulate_defaults
-import torch
+from character_memory import CHARACTER_MEMORY_TOP_N, select as select_character_memory
+from persona_store import persona_store
+from session_cache import session_cache
 
 def save_persona(name: str, persona_data: dict):
     """
     Persist a persona JSON under personas/{name}.json.
     """
-    os.makedirs("personas", exist_ok=True)
-    path = os.path.join("personas", f"{name}.json")
-    with open(path, "w") as f:
-        json.dump(persona_data, f, indent=2)
+    persona_store.save(name, persona_data)
 
 
 def reflect_on_session(
-    model: torch.nn.Module,
+    model,
     tokenizer,
     persona: dict,
     history: list[dict],
@@ -28,11 +19,14 @@ def reflect_on_session(
     """
     Ask the model to produce a brief reflection on the recent conversation turns,
     to be added into character_memory.
-    Only works for local models with a valid tokenizer object.
+    Only works for local models with a valid tokenizer object; returns None otherwise.
     """
+    import torch
+    from transformers import PreTrainedTokenizer
+
     # Safeguard: skip if tokenizer is not a real HF tokenizer
     if not isinstance(tokenizer, PreTrainedTokenizer):
-        return "[Reflection skipped: tokenizer is not local]"
+        return None
 
     # Build a small prompt
     prompt_lines = [
@@ -67,12 +61,11 @@ def reflect_on_session(
     return reflection
 
 
-history_store = {}
-
 def load_persona(name):
-    path = Path("personas") / f"{name}.json"
-    with path.open() as f:
-        return json.load(f)
+    persona = persona_store.get(name)
+    if persona is None:
+        raise FileNotFoundError(f"Persona '{name}' not found")
+    return persona
 
 def build_prompt_with_history(persona, history, message, summary=None):
     lines = []
@@ -80,8 +73,11 @@ def build_prompt_with_history(persona, history, message, summary=None):
     # Base persona description
     lines.append(persona["persona"].strip())
 
-    # Optional character memory
-    memory = persona.get("character_memory", [])
+    # Optional character memory, only the entries relevant to this message
+    if persona.get("name"):
+        memory = select_character_memory(persona["name"], message)
+    else:
+        memory = persona.get("character_memory", [])[-CHARACTER_MEMORY_TOP_N:]
     if memory:
         lines.append("\n[Memory]\n" + "\n".join(memory))
 
@@ -107,48 +103,11 @@ def build_prompt_with_history(persona, history, message, summary=None):
     return "\n".join(lines)
 
 def get_history(character, user_id="demo", session_id="default"):
-    return history_store.get((character, user_id, session_id), [])
+    return list(session_cache.get(("history", character, user_id, session_id), []))
 
 def append_history(character, user_input, assistant_reply, user_id="demo", session_id="default"):
-    key = (character, user_id, session_id)
-    if key not in history_store:
-        history_store[key] = []
-    history_store[key].append({"user": user_input, "assistant": assistant_reply})
-
-def maybe_summarize(history, max_turns=6):
-    if len(history) <= max_turns:
-        return None, history
-    early = history[:-max_turns]
-    recent = history[-max_turns:]
-    summary_parts = [f"User asked about: {turn['user']}" for turn in early]
-    summary = "Previously discussed topics: " + "; ".join(summary_parts)
-    return summary, recent
-
-def maybe_summarize(history, max_turns=6):
-    if len(history) <= max_turns:
-        return None, history
-
-    early = history[:-max_turns]
-    recent = history[-max_turns:]
-
-    try:
-        import os
-        import openai
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-
-        conv = "".join(f"User: {t['user']}\nAssistant: {t['assistant']}\n" for t in early)
-        prompt = f"Summarize the following conversation concisely for memory retention:\n{conv}\nSummary:"
-
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.5,
-            max_tokens=150
-        )
-        summary = response.choices[0].message.content.strip()
-    except Exception:
-        summary = "Previously discussed topics: " + "; ".join(
-            f"User asked about: {t['user']}" for t in early
-        )
+    # Only lives in the cache, so spill it to disk rather than losing it on eviction
+    key = ("history", character, user_id, session_id)
+    history = session_cache.get(key, [])
+    session_cache.put(key, history + [{"user": user_input, "assistant": assistant_reply}], spill=True)
 
-    return summary, recent
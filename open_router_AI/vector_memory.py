@@ -1,35 +1,488 @@
-import chromadb
-from sentence_transformers import SentenceTransformer
+import hashlib
+import os
+import queue
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import timezone
 
-client = chromadb.Client()
-collection = client.get_or_create_collection("chat_memory")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+# "persistent" keeps memories on disk under VECTOR_STORE_PATH across restarts,
+# "memory" is the old ephemeral chromadb.Client()
+VECTOR_STORE_MODE = os.getenv("VECTOR_STORE_MODE", "persistent")
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "vector_store")
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "512"))
+# "chroma", or "numpy" for the memory-mapped brute-force index in numpy_index.py
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+# float16 or int8 rows for the numpy backend
+VECTOR_DTYPE = os.getenv("VECTOR_DTYPE", "float16")
+# Open partition handles kept around
+PARTITION_CACHE_SIZE = int(os.getenv("PARTITION_CACHE_SIZE", "1024"))
+LEGACY_COLLECTION = "chat_memory"
 
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
+# chromadb and the SentenceTransformer are created on first use (or by the
+# background warm-up in app.py), not at import time.
+_client = None
+_numpy_store = None
+_collection = None
+_embedder = None
+_partitions = OrderedDict()
+_lock = threading.Lock()
 
-def store_message(character, user, message, response):
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        with _lock:
+            if _embedder is None:
+                from sentence_transformers import SentenceTransformer
+                _embedder = SentenceTransformer("all-MiniLM-L6-v2")
+    return _embedder
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                import chromadb
+                if VECTOR_STORE_MODE == "persistent":
+                    # segments are opened lazily, nothing is bulk-loaded here
+                    _client = chromadb.PersistentClient(path=VECTOR_STORE_PATH)
+                else:
+                    _client = chromadb.Client()
+    return _client
+
+
+def get_numpy_store():
+    global _numpy_store
+    if _numpy_store is None:
+        with _lock:
+            if _numpy_store is None:
+                from numpy_index import NumpyVectorStore
+                _numpy_store = NumpyVectorStore(os.path.join(VECTOR_STORE_PATH, "numpy"), dtype=VECTOR_DTYPE)
+    return _numpy_store
+
+
+def get_collection():
+    """
+    The old single collection holding every memory; only read by migrate().
+    """
+    global _collection
+    if _collection is None:
+        _collection = get_client().get_or_create_collection(LEGACY_COLLECTION)
+    return _collection
+
+
+def partition_name(character, user):
+    """
+    Memories are partitioned per (character, user): one collection each, so a
+    query only searches that user's memories with that character.
+    """
+    digest = hashlib.sha1(f"{character}\x00{user}".encode("utf-8")).hexdigest()
+    return f"mem_{digest[:32]}"
+
+
+def get_partition(character, user, create=True):
+    """
+    The collection for (character, user) in the configured VECTOR_BACKEND,
+    or None if it does not exist and create is False.
+    """
+    name = partition_name(character, user)
+    with _lock:
+        collection = _partitions.get(name)
+        if collection is not None:
+            _partitions.move_to_end(name)
+            return collection
+    if VECTOR_BACKEND == "numpy":
+        collection = get_numpy_store().partition(name, create=create)
+        if collection is None:
+            return None
+    elif create:
+        client = get_client()
+        collection = client.get_or_create_collection(name, metadata={"character": character, "user": user})
+    else:
+        try:
+            collection = get_client().get_collection(name)
+        except Exception:
+            return None
+    with _lock:
+        _partitions[name] = collection
+        while len(_partitions) > PARTITION_CACHE_SIZE:
+            _partitions.popitem(last=False)
+    return collection
+
+
+class EmbeddingService:
+    """
+    Micro-batching front of the SentenceTransformer.
+
+    Callers (request threads, the work queue) block on embed()/embed_many();
+    a single thread collects their texts for up to EMBED_MAX_WAIT_MS or
+    EMBED_BATCH_SIZE texts and runs one encode() for all of them. Recently
+    embedded texts are served from an LRU cache, so e.g. the query embedding
+    of a user message is computed once for retrieval and the response cache.
+    """
+
+    def __init__(self, batch_size=EMBED_BATCH_SIZE, max_wait_ms=EMBED_MAX_WAIT_MS, cache_size=EMBED_CACHE_SIZE):
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.cache_size = cache_size
+        self._queue = queue.Queue()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._worker = None
+        self.stats = {
+            "requests": 0, "cache_hits": 0, "batches": 0, "embedded": 0,
+            "max_batch": 0, "encode_seconds": 0.0, "wait_seconds": 0.0,
+        }
+
+    def _cached(self, text):
+        with self._lock:
+            self.stats["requests"] += 1
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+                self.stats["cache_hits"] += 1
+            return vector
+
+    def _remember(self, text, vector):
+        with self._lock:
+            self._cache[text] = vector
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name="embedder", daemon=True)
+                    self._worker.start()
+
+    def embed_many(self, texts):
+        """
+        Embeddings (numpy float32 vectors) for `texts`, in order.
+        """
+        self._ensure_worker()
+        results = [None] * len(texts)
+        pending = []
+        for i, text in enumerate(texts):
+            vector = self._cached(text)
+            if vector is not None:
+                results[i] = vector
+            else:
+                future = Future()
+                self._queue.put((text, future, time.perf_counter()))
+                pending.append((i, future))
+        for i, future in pending:
+            results[i] = future.result()
+        return results
+
+    def embed(self, text):
+        return self.embed_many([text])[0]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=max(timeout, 0)) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            started = time.perf_counter()
+            try:
+                vectors = get_embedder().encode(texts)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            by_text = dict(zip(texts, vectors))
+            for text, vector in by_text.items():
+                self._remember(text, vector)
+            with self._lock:
+                self.stats["batches"] += 1
+                self.stats["embedded"] += len(texts)
+                self.stats["max_batch"] = max(self.stats["max_batch"], len(texts))
+                self.stats["encode_seconds"] += done - started
+                self.stats["wait_seconds"] += sum(started - queued for _, _, queued in batch)
+            for text, future, _ in batch:
+                future.set_result(by_text[text])
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["cached"] = len(self._cache)
+        batches = stats["batches"] or 1
+        stats["avg_batch"] = round(stats["embedded"] / batches, 2)
+        stats["avg_encode_ms"] = round(stats["encode_seconds"] / batches * 1000, 2)
+        misses = stats["requests"] - stats["cache_hits"]
+        stats["avg_wait_ms"] = round(stats["wait_seconds"] / (misses or 1) * 1000, 2)
+        return stats
+
+
+embedding_service = EmbeddingService()
+
+
+def embed(text):
+    return embedding_service.embed(text)
+
+
+def embed_many(texts):
+    return embedding_service.embed_many(texts)
+
+
+def warm_up():
+    if VECTOR_BACKEND == "numpy":
+        get_numpy_store()
+    else:
+        get_client()
+    get_embedder().encode("warm up")
+
+
+def memory_id(message_id):
+    """
+    Stable document id for the turn whose user message has id `message_id`,
+    so live inserts and the backfill never duplicate a turn.
+    """
+    return f"msg-{message_id}"
+
+
+def store_message(character, user, message, response, doc_id=None):
     text = f"User: {message}\nAssistant: {response}"
-    emb = embedder.encode(text).tolist()
-    doc_id = str(uuid.uuid4())
-    collection.add(
+    emb = embed(text).tolist()
+    doc_id = doc_id or str(uuid.uuid4())
+    get_partition(character, user).upsert(
         documents=[text],
         embeddings=[emb],
-        metadatas=[{"character": character, "user": user}],
+        metadatas=[{"character": character, "user": user, "ts": time.time()}],
         ids=[doc_id]
     )
 
+def store_messages(items):
+    """
+    Batch version of store_message: items are (character, user, message, response)
+    or (character, user, message, response, doc_id) tuples, embedded with one
+    encode() call and inserted with one upsert().
+    """
+    if not items:
+        return
+    texts = [f"User: {item[2]}\nAssistant: {item[3]}" for item in items]
+    embs = [vector.tolist() for vector in embed_many(texts)]
+    ids = [item[4] if len(item) > 4 and item[4] else str(uuid.uuid4()) for item in items]
+    _upsert_partitioned(
+        [(item[0], item[1]) for item in items], texts, embs, ids
+    )
+
+
+def _upsert_partitioned(owners, texts, embs, ids, timestamps=None):
+    """
+    Route documents to their (character, user) partitions, one upsert per partition.
+    `ts` (unix time of the turn, used by memory_compaction) defaults to now.
+    """
+    now = time.time()
+    timestamps = timestamps or [None] * len(ids)
+    groups = {}
+    for i, owner in enumerate(owners):
+        groups.setdefault(owner, []).append(i)
+    for (character, user), idx in groups.items():
+        get_partition(character, user).upsert(
+            documents=[texts[i] for i in idx],
+            embeddings=[embs[i] for i in idx],
+            metadatas=[{"character": character, "user": user, "ts": timestamps[i] or now} for i in idx],
+            ids=[ids[i] for i in idx]
+        )
+
+
+def list_partitions():
+    """
+    Names of all memory partitions in the configured backend.
+    """
+    if VECTOR_BACKEND == "numpy":
+        return get_numpy_store().partitions()
+    # list_collections() returns names in newer chromadb, Collection objects in older
+    names = [getattr(c, "name", c) for c in get_client().list_collections()]
+    return [name for name in names if name.startswith("mem_")]
+
+
+def open_partition(name):
+    if VECTOR_BACKEND == "numpy":
+        return get_numpy_store().partition(name, create=False)
+    try:
+        return get_client().get_collection(name)
+    except Exception:
+        return None
+
 def retrieve_similar(character, user, query, top_k=3):
-    emb = embedder.encode(query).tolist()
-    results = collection.query(
-    query_embeddings=[emb],
-    n_results=top_k,
-    where={
-        "$and": [
-            {"character": {"$eq": character}},
-            {"user": {"$eq": user}}
-        ]
-    }
-)
+    partition = get_partition(character, user, create=False)
+    if partition is None:
+        return []
+    count = partition.count()
+    if not count:
+        return []
+    emb = embed(query).tolist()
+    results = partition.query(query_embeddings=[emb], n_results=min(top_k, count))
 
     return results.get("documents", [[]])[0]
 #  simple memory system using chromadb and sentence-transformers to support semantic memory recall per (character, user) session. 
+
+
+def iter_stored_turns(batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Yield lists of (character, user, message, response, doc_id, ts) for every
+    completed turn in chat.db, reading `messages` in id order one page at a time.
+    """
+    from models.db import SessionLocal, Chat, Message
+
+    db = SessionLocal()
+    try:
+        last_id = 0
+        pending_user = {}  # chat_id -> user Message waiting for its reply
+        while True:
+            rows = (
+                db.query(Message, Chat)
+                .join(Chat, Message.chat_id == Chat.id)
+                .filter(Message.id > last_id)
+                .order_by(Message.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0].id
+            turns = []
+            for m, chat in rows:
+                if m.sender == "user":
+                    pending_user[m.chat_id] = m
+                elif m.chat_id in pending_user:
+                    user_msg = pending_user.pop(m.chat_id)
+                    ts = user_msg.timestamp.replace(tzinfo=timezone.utc).timestamp() if user_msg.timestamp else None
+                    turns.append((chat.character, chat.user_id, user_msg.content, m.content, memory_id(user_msg.id), ts))
+            if turns:
+                yield turns
+    finally:
+        db.close()
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Rebuild vector memory from the `messages` table: large encode() batches and
+    one upsert per batch. Safe to re-run, ids are derived from message ids.
+    """
+    embedder = get_embedder()
+    total = 0
+    started = time.perf_counter()
+    for turns in iter_stored_turns(batch_size):
+        texts = [f"User: {t[2]}\nAssistant: {t[3]}" for t in turns]
+        embs = embedder.encode(texts, batch_size=min(batch_size, 256)).tolist()
+        _upsert_partitioned([(t[0], t[1]) for t in turns], texts, embs, [t[4] for t in turns], [t[5] for t in turns])
+        total += len(turns)
+        print(f"[BACKFILL] {total} turns embedded ({time.perf_counter() - started:.1f}s)")
+    return total
+
+
+def migrate(batch_size=BACKFILL_BATCH_SIZE, drop=False):
+    """
+    Move memories from the old global `chat_memory` collection into their
+    (character, user) partitions, keeping ids and embeddings. With drop=True
+    the global collection is deleted afterwards.
+    """
+    client = get_client()
+    try:
+        legacy = client.get_collection(LEGACY_COLLECTION)
+    except Exception:
+        print("[MIGRATE] no global collection, nothing to do")
+        return 0
+    total = 0
+    offset = 0
+    while True:
+        page = legacy.get(include=["documents", "embeddings", "metadatas"], limit=batch_size, offset=offset)
+        if not page["ids"]:
+            break
+        owners = [(m.get("character"), m.get("user")) for m in page["metadatas"]]
+        _upsert_partitioned(
+            owners, page["documents"], [list(e) for e in page["embeddings"]], page["ids"],
+            [m.get("ts") for m in page["metadatas"]]
+        )
+        total += len(page["ids"])
+        offset += len(page["ids"])
+        print(f"[MIGRATE] {total} memories moved")
+    if drop:
+        client.delete_collection(LEGACY_COLLECTION)
+    return total
+
+
+def benchmark(n_turns=100_000, n_partitions=1000, queries=200, dim=384):
+    """
+    Compare top-5 query latency of one global collection filtered by metadata
+    against per-(character, user) partitions in chroma and in the numpy backend,
+    on random vectors in a throwaway store. Use n_turns=1_000_000 for the
+    production-size numbers.
+    """
+    import tempfile
+    import chromadb
+    import numpy as np
+    from numpy_index import NumpyVectorStore
+
+    rng = np.random.default_rng(0)
+    root = tempfile.mkdtemp(prefix="memory-bench-")
+    client = chromadb.PersistentClient(path=root)
+    numpy_store = NumpyVectorStore(os.path.join(root, "numpy"), dtype=VECTOR_DTYPE)
+    flat = client.create_collection("bench_global")
+    owners = rng.integers(0, n_partitions, size=n_turns)
+    for start in range(0, n_turns, 5000):
+        vecs = rng.standard_normal((min(5000, n_turns - start), dim)).astype("float32")
+        part = owners[start:start + len(vecs)]
+        ids = [str(i) for i in range(start, start + len(vecs))]
+        flat.add(ids=ids, embeddings=vecs.tolist(), metadatas=[{"owner": int(o)} for o in part])
+        for owner in np.unique(part):
+            mask = part == owner
+            owner_ids = [i for i, m in zip(ids, mask) if m]
+            client.get_or_create_collection(f"bench_{owner}").add(ids=owner_ids, embeddings=vecs[mask].tolist())
+            numpy_store.partition(f"bench_{owner}").upsert(
+                ids=owner_ids, embeddings=vecs[mask], documents=owner_ids
+            )
+
+    def timed(fn):
+        samples = []
+        for _ in range(queries):
+            owner = int(rng.integers(0, n_partitions))
+            q = rng.standard_normal(dim).astype("float32").tolist()
+            started = time.perf_counter()
+            fn(owner, q)
+            samples.append((time.perf_counter() - started) * 1000)
+        return np.percentile(samples, 50), np.percentile(samples, 95)
+
+    g50, g95 = timed(lambda o, q: flat.query(query_embeddings=[q], n_results=5, where={"owner": o}))
+    p50, p95 = timed(lambda o, q: client.get_collection(f"bench_{o}").query(query_embeddings=[q], n_results=5))
+    n50, n95 = timed(lambda o, q: numpy_store.partition(f"bench_{o}").query(query_embeddings=[q], n_results=5))
+    print(f"{n_turns} turns / {n_partitions} partitions, {queries} queries")
+    print(f"global + where : p50 {g50:.2f} ms  p95 {g95:.2f} ms")
+    print(f"partitioned    : p50 {p50:.2f} ms  p95 {p95:.2f} ms")
+    print(f"numpy ({VECTOR_DTYPE}) : p50 {n50:.2f} ms  p95 {n95:.2f} ms")
+
+
+if __name__ == "__main__":
+    import sys
+
+    command, args = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else (None, [])
+    if command == "backfill":
+        backfill(int(args[0]) if args else BACKFILL_BATCH_SIZE)
+    elif command == "migrate":
+        migrate(drop="--drop" in args)
+    elif command == "bench":
+        benchmark(*[int(a) for a in args])
+    else:
+        print("usage: python vector_memory.py backfill [batch_size] | migrate [--drop] | bench [turns] [partitions]")
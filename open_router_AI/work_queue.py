@@ -0,0 +1,228 @@
+# work_queue.py
+#
+# Durable background queue for work that does not have to happen before the
+# HTTP response: embedding + storing the turn in vector memory, reflections,
+# summaries and memory maintenance (see post_processing.py).
+#
+# Jobs live in the `jobs` table of chat.db, so nothing is lost on restart. One
+# worker thread per process drains the table: jobs of the same kind are handed
+# to their handler as a batch, and jobs enqueued with a coalesce_key replace
+# the payload of a pending job with the same key instead of adding another one.
+#
+# Several processes (gunicorn workers) share the table. A job is claimed with
+# a conditional UPDATE, so only one process runs it, and the claim is a lease:
+# a job still "running" WORK_LEASE_SECONDS after it was claimed belonged to a
+# process that died and is made pending again. Failed jobs are kept for
+# WORK_FAILED_TTL seconds for inspection, then deleted.
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, or_
+
+from models.db import SessionLocal, Job
+
+logger = logging.getLogger(__name__)
+
+WORK_BATCH_SIZE = int(os.getenv("WORK_BATCH_SIZE", "64"))
+WORK_POLL_SECONDS = float(os.getenv("WORK_POLL_SECONDS", "2"))
+WORK_MAX_ATTEMPTS = int(os.getenv("WORK_MAX_ATTEMPTS", "3"))
+# Longer than any batch takes to run
+WORK_LEASE_SECONDS = float(os.getenv("WORK_LEASE_SECONDS", "900"))
+WORK_FAILED_TTL = float(os.getenv("WORK_FAILED_TTL", str(7 * 86400)))
+# How often lapsed leases and old failed jobs are looked for
+WORK_MAINTAIN_SECONDS = 60
+
+_handlers = {}
+_wake = threading.Event()
+_stop = threading.Event()
+_worker = None
+
+STATS = {
+    "enqueued": 0, "coalesced": 0, "done": 0, "failed": 0, "retried": 0, "batches": 0,
+    "lost_claims": 0, "requeued": 0, "purged": 0,
+}
+
+
+def register(kind, handler):
+    """
+    Register handler(payloads: list[dict]) for a job kind. It is called with
+    every claimed pending job of that kind at once.
+    """
+    _handlers[kind] = handler
+
+
+def enqueue(kind, payload, coalesce_key=None):
+    db = SessionLocal()
+    try:
+        coalesced = 0
+        if coalesce_key is not None:
+            # Conditional, so a job claimed meanwhile is not changed under its handler
+            coalesced = (
+                db.query(Job)
+                .filter_by(kind=kind, coalesce_key=coalesce_key, status="pending")
+                .update({Job.payload: json.dumps(payload)}, synchronize_session=False)
+            )
+        if coalesced:
+            STATS["coalesced"] += 1
+        else:
+            db.add(Job(kind=kind, coalesce_key=coalesce_key, payload=json.dumps(payload), status="pending"))
+            STATS["enqueued"] += 1
+        db.commit()
+    finally:
+        db.close()
+    _wake.set()
+
+
+def _claim():
+    db = SessionLocal()
+    try:
+        candidates = [
+            job_id for (job_id,) in
+            db.query(Job.id).filter_by(status="pending").order_by(Job.id).limit(WORK_BATCH_SIZE)
+        ]
+        now = datetime.utcnow()
+        claimed = []
+        for job_id in candidates:
+            # Matches nothing if another process claimed the job first
+            won = (
+                db.query(Job)
+                .filter(Job.id == job_id, Job.status == "pending")
+                .update({
+                    Job.status: "running",
+                    Job.claimed_at: now,
+                    Job.attempts: func.coalesce(Job.attempts, 0) + 1,
+                }, synchronize_session=False)
+            )
+            if won:
+                claimed.append(job_id)
+            else:
+                STATS["lost_claims"] += 1
+        db.commit()
+        if not claimed:
+            return []
+        jobs = db.query(Job).filter(Job.id.in_(claimed)).order_by(Job.id).all()
+        return [(job.id, job.kind, json.loads(job.payload), job.attempts) for job in jobs]
+    finally:
+        db.close()
+
+
+def _finish(job_ids, error=None):
+    db = SessionLocal()
+    try:
+        if error is None:
+            db.query(Job).filter(Job.id.in_(job_ids)).delete(synchronize_session=False)
+            STATS["done"] += len(job_ids)
+        else:
+            for job in db.query(Job).filter(Job.id.in_(job_ids)):
+                job.error = error
+                if job.attempts >= WORK_MAX_ATTEMPTS:
+                    job.status = "failed"
+                    STATS["failed"] += 1
+                else:
+                    job.status = "pending"
+                    STATS["retried"] += 1
+        db.commit()
+    finally:
+        db.close()
+
+
+def drain_once():
+    """
+    Claim one batch of pending jobs and run their handlers. Returns the number
+    of jobs processed.
+    """
+    claimed = _claim()
+    by_kind = {}
+    for job_id, kind, payload, _ in claimed:
+        by_kind.setdefault(kind, []).append((job_id, payload))
+    for kind, jobs in by_kind.items():
+        job_ids = [job_id for job_id, _ in jobs]
+        handler = _handlers.get(kind)
+        if handler is None:
+            _finish(job_ids, error=f"no handler for {kind}")
+            continue
+        STATS["batches"] += 1
+        try:
+            handler([payload for _, payload in jobs])
+        except Exception as e:
+            logger.exception(f"[WORK] {kind} batch failed")
+            _finish(job_ids, error=str(e))
+        else:
+            _finish(job_ids)
+    return len(claimed)
+
+
+def maintain():
+    """
+    Make jobs whose lease lapsed pending again and delete failed jobs older
+    than WORK_FAILED_TTL. Safe to run from every process.
+    """
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        requeued = (
+            db.query(Job)
+            .filter(Job.status == "running", or_(
+                Job.claimed_at.is_(None),
+                Job.claimed_at < now - timedelta(seconds=WORK_LEASE_SECONDS),
+            ))
+            .update({Job.status: "pending"}, synchronize_session=False)
+        )
+        purged = (
+            db.query(Job)
+            .filter(Job.status == "failed", Job.updated_at < now - timedelta(seconds=WORK_FAILED_TTL))
+            .delete(synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+    STATS["requeued"] += requeued
+    STATS["purged"] += purged
+
+
+def _run():
+    maintained = 0
+    while not _stop.is_set():
+        try:
+            if time.monotonic() - maintained > WORK_MAINTAIN_SECONDS:
+                maintain()
+                maintained = time.monotonic()
+            processed = drain_once()
+        except Exception:
+            logger.exception("[WORK] drain failed")
+            processed = 0
+        if not processed:
+            _wake.wait(WORK_POLL_SECONDS)
+            _wake.clear()
+
+
+def start_worker():
+    global _worker
+    if _worker is None or not _worker.is_alive():
+        _stop.clear()
+        _worker = threading.Thread(target=_run, name="work-queue", daemon=True)
+        _worker.start()
+
+
+def stop_worker(timeout=5):
+    _stop.set()
+    _wake.set()
+    if _worker is not None:
+        _worker.join(timeout)
+
+
+def queue_stats():
+    db = SessionLocal()
+    try:
+        pending = db.query(Job).filter_by(status="pending").count()
+        running = db.query(Job).filter_by(status="running").count()
+        failed = db.query(Job).filter_by(status="failed").count()
+    finally:
+        db.close()
+    return dict(STATS, pending=pending, running=running, failed_jobs=failed)
+